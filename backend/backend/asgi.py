@@ -18,7 +18,7 @@ django.setup()
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
+from backend.executors import database_sync_to_async
 from channels.layers import get_channel_layer
 from urllib.parse import parse_qs
 from django.db import close_old_connections
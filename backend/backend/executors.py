@@ -0,0 +1,241 @@
+"""
+Instrumented database_sync_to_async and per-workload executor pools.
+
+Drop-in replacement for channels.db.database_sync_to_async that records,
+per call site, how long a call waited for an executor thread and how long
+it ran, plus how many calls are queued and running right now. Calls that
+waited longer than EXECUTOR_WAIT_WARNING_MS are logged, so a burst on one
+consumer shows up as executor saturation next to the loop lag it causes.
+
+Call sites can pick one of the pools in settings.EXECUTOR_POOLS instead of
+the shared thread-sensitive executor, so a backlog in one subsystem only
+queues behind its own work.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from backend import metrics
+
+logger = logging.getLogger(__name__)
+
+# Per-call bookkeeping, set on the event loop and read in the worker thread
+current_call = contextvars.ContextVar('executor_call')
+
+
+class ExecutorStats:
+    """Calls waiting for and running on executor threads, shared by all call sites"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.threads = {}
+        self.last_warning = {}
+
+    def submitted(self):
+        with self.lock:
+            self.queued += 1
+
+    def started(self, call_site, wait_ms):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+            ident = threading.get_ident()
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+            metrics.observe('executor.wait_ms', wait_ms)
+            metrics.observe(f'executor.wait_ms.{call_site}', wait_ms)
+            queued, active = self.queued, self.active
+
+        if wait_ms > settings.EXECUTOR_WAIT_WARNING_MS and self.should_warn(call_site):
+            logger.warning(
+                "executor_saturated call_site=%s wait_ms=%.1f queued=%d active=%d",
+                call_site, wait_ms, queued, active,
+                extra={'call_site': call_site, 'wait_ms': wait_ms, 'queued': queued, 'active': active}
+            )
+
+    def finished(self, call_site, run_ms):
+        with self.lock:
+            self.active -= 1
+            ident = threading.get_ident()
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+            metrics.observe(f'executor.run_ms.{call_site}', run_ms)
+
+    def abandoned(self):
+        """A call cancelled before a thread picked it up"""
+        with self.lock:
+            self.queued -= 1
+
+    def should_warn(self, key):
+        """Throttles warnings to one per key every MONITOR_WARNING_INTERVAL"""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_warning.get(key, -settings.MONITOR_WARNING_INTERVAL) < settings.MONITOR_WARNING_INTERVAL:
+                return False
+            self.last_warning[key] = now
+        return True
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'active': self.active,
+                'active_threads': len(self.threads)
+            }
+
+
+executor_stats = ExecutorStats()
+
+metrics.set_gauge('executor.queued', lambda: executor_stats.queued)
+metrics.set_gauge('executor.active', lambda: executor_stats.active)
+metrics.set_gauge('executor.active_threads', lambda: len(executor_stats.threads))
+
+
+class ExecutorPoolFull(Exception):
+    """Raised instead of queueing a call on a pool already at its queue limit"""
+
+
+class ExecutorPool:
+    """
+    Bounded thread pool for one workload class.
+
+    At most `queue_limit` calls may be waiting or running at once, and the
+    caller gets asyncio.TimeoutError for a call not done after `timeout`
+    seconds. A call still waiting for a thread is dropped; one that already
+    started cannot be interrupted and finishes in its thread.
+    """
+
+    def __init__(self, name, workers, queue_limit, timeout):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-db')
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.pending = 0
+
+        metrics.set_gauge(f'executor.{name}.pending', lambda: self.pending)
+
+    async def run(self, call):
+        """Awaits `call()`, which submits the work to this pool"""
+        if self.pending >= self.queue_limit:
+            metrics.incr(f'executor.{self.name}.rejected')
+            raise ExecutorPoolFull(f"Executor pool '{self.name}' has {self.pending} calls pending")
+
+        self.pending += 1
+        try:
+            return await asyncio.wait_for(call(), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.incr(f'executor.{self.name}.timeouts')
+            raise
+        finally:
+            self.pending -= 1
+
+
+# name -> ExecutorPool, created on first use from settings.EXECUTOR_POOLS
+pools = {}
+
+
+def get_pool(name):
+    """
+    Returns the named executor pool, creating it on first use.
+
+    Raises:
+        KeyError: If the pool is not configured in settings.EXECUTOR_POOLS
+    """
+    pool = pools.get(name)
+    if pool is None:
+        config = settings.EXECUTOR_POOLS[name]
+        pool = pools[name] = ExecutorPool(
+            name,
+            workers=config['workers'],
+            queue_limit=config['queue_limit'],
+            timeout=config['timeout']
+        )
+    return pool
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """DatabaseSyncToAsync recording queue wait and run time under a call site name"""
+
+    def __init__(self, func, call_site=None, pool=None, **kwargs):
+        # Pools are bounded thread pools, not the single thread-sensitive one
+        self.pool = get_pool(pool) if pool is not None else None
+        if self.pool is not None:
+            kwargs.update(thread_sensitive=False, executor=self.pool.executor)
+        super().__init__(func, **kwargs)
+        self.call_site = call_site or getattr(func, '__name__', 'call')
+        self.func = self.timed(func)
+
+    def timed(self, func):
+        """
+        Wraps func to record its wait and run time. The wrapper runs in the
+        worker thread inside the context copied from the caller, so it sees
+        the call recorded by __call__.
+        """
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            call = current_call.get(None)
+            if call is None:
+                return func(*args, **kwargs)
+
+            call['started'] = time.monotonic()
+            executor_stats.started(self.call_site, (call['started'] - call['submitted']) * 1000)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                executor_stats.finished(self.call_site, (time.monotonic() - call['started']) * 1000)
+        return run
+
+    async def __call__(self, *args, **kwargs):
+        if self.pool is not None:
+            return await self.pool.run(functools.partial(self.submit, *args, **kwargs))
+        return await self.submit(*args, **kwargs)
+
+    async def submit(self, *args, **kwargs):
+        call = {'submitted': time.monotonic(), 'started': None}
+        token = current_call.set(call)
+        executor_stats.submitted()
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            if call['started'] is None:
+                executor_stats.abandoned()
+            current_call.reset(token)
+
+
+def database_sync_to_async(func=None, *, pool=None, call_site=None, **kwargs):
+    """
+    Same as channels' database_sync_to_async, usable as a decorator or a call.
+
+        @database_sync_to_async(pool='chat')
+        def create_message(self, ...):
+
+    Args:
+        func: The sync function to run in an executor thread
+        pool: Name of the executor pool to run in, from
+            settings.EXECUTOR_POOLS; the shared thread-sensitive executor
+            if omitted
+        call_site: Name the call is recorded under, defaults to
+            "<calling module>.<calling function>:<function name>"
+
+    Returns:
+        An awaitable wrapper around func
+    """
+    if call_site is None:
+        caller = sys._getframe(1)
+        call_site = f"{caller.f_globals.get('__name__')}.{caller.f_code.co_name}"
+
+    def wrap(func):
+        site = f"{call_site}:{getattr(func, '__name__', 'call')}"
+        return InstrumentedDatabaseSyncToAsync(func, call_site=site, pool=pool, **kwargs)
+
+    if func is None:
+        return wrap
+    return wrap(func)
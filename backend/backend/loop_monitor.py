@@ -0,0 +1,53 @@
+"""
+Event loop lag monitor.
+
+A task sleeps for LOOP_LAG_INTERVAL and measures how late it wakes up. The
+lag is how long anything scheduled on the loop (game ticks included) is
+delayed by code hogging it. Lag above LOOP_LAG_WARNING_MS is logged along
+with the executor state, to tell a busy loop from a saturated executor.
+"""
+import asyncio
+import logging
+from django.conf import settings
+from backend import metrics
+from backend.executors import executor_stats
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=None, warning_ms=None):
+        self.interval = interval or settings.LOOP_LAG_INTERVAL
+        self.warning_ms = warning_ms or settings.LOOP_LAG_WARNING_MS
+        self.task = None
+        self.lag_ms = 0
+
+    def ensure_started(self):
+        """Starts the monitor on the running loop if needed"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.record((loop.time() - expected) * 1000)
+
+    def record(self, lag_ms):
+        self.lag_ms = max(lag_ms, 0)
+        metrics.observe('loop.lag_ms', self.lag_ms)
+
+        if self.lag_ms > self.warning_ms and executor_stats.should_warn('loop_lag'):
+            executor = executor_stats.as_dict()
+            logger.warning(
+                "event_loop_lag lag_ms=%.1f executor_queued=%d executor_active=%d",
+                self.lag_ms, executor['queued'], executor['active'],
+                extra={'lag_ms': self.lag_ms, 'executor': executor}
+            )
+
+
+# One per process, started by the game consumers
+loop_monitor = LoopLagMonitor()
+
+metrics.set_gauge('loop.lag_ms', lambda: loop_monitor.lag_ms)
@@ -0,0 +1,243 @@
+"""
+Memory introspection for long-running processes.
+
+Modules register the in-memory tables that can grow with traffic and
+consumers report their connections, so a report shows what the process is
+holding on to: entries and approximate bytes per table, open connections
+per consumer type (and consumer objects still alive after they closed),
+channel-layer buffers and RSS. tracemalloc can be switched on at runtime to
+diff allocations against a baseline. Like the metrics, everything is per
+process.
+"""
+import os
+import sys
+import tracemalloc
+import weakref
+from collections import defaultdict, deque
+from django.conf import settings
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import permissions
+from backend import metrics
+
+# name -> the structure, or a callable returning it when a report is made
+tables = {}
+
+# Consumer class name -> open connections / consumer objects not yet collected
+open_connections = defaultdict(int)
+live_consumers = defaultdict(weakref.WeakSet)
+
+# Allocation snapshot diffs are taken against while tracing
+trace_baseline = None
+
+# Only builtin containers are walked by approximate_size; other objects are
+# counted shallowly so a reference to a loop or a consumer does not pull in
+# the whole heap
+CONTAINERS = (dict, list, tuple, set, frozenset, deque)
+
+
+def register_table(name, source):
+    """Registers a structure, or a callable returning one, to be measured"""
+    tables[name] = source
+
+
+def open_connection(consumer):
+    """Records a consumer connecting, called first thing in connect()"""
+    kind = type(consumer).__name__
+    live_consumers[kind].add(consumer)
+    open_connections[kind] += 1
+    metrics.set_gauge(f'connections.{kind}', lambda: open_connections[kind])
+
+
+def close_connection(consumer):
+    """Records a consumer disconnecting, called from disconnect()"""
+    kind = type(consumer).__name__
+    if open_connections[kind] > 0:
+        open_connections[kind] -= 1
+
+
+def get_consumers(kind):
+    """Consumer objects of a type that are still alive"""
+    consumers = live_consumers.get(kind)
+    return list(consumers) if consumers is not None else []
+
+
+def approximate_size(obj):
+    """
+    Approximate deep size of a structure in bytes.
+
+    Returns:
+        Sum of sys.getsizeof over the object and the builtin containers,
+        keys and values reachable from it, each object counted once
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, CONTAINERS):
+            stack.extend(current)
+    return size
+
+
+def measure_table(source):
+    table = source() if callable(source) else source
+    return {
+        'entries': len(table),
+        'bytes': approximate_size(table)
+    }
+
+
+def get_rss():
+    """Resident set size of the process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS, but better than nothing off Linux
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def channel_layer_buffers():
+    """
+    Messages buffered by this process's channel layer.
+
+    Returns:
+        Dictionary with the backend name, buffered channels and messages,
+        or None without a channel layer
+    """
+    from channels.layers import get_channel_layer
+    layer = get_channel_layer()
+    if layer is None:
+        return None
+
+    # RedisChannelLayer buffers in receive_buffer, InMemoryChannelLayer in channels
+    buffers = getattr(layer, 'receive_buffer', None)
+    if buffers is None:
+        buffers = getattr(layer, 'channels', {})
+    queues = list(buffers.values())
+    return {
+        'backend': type(layer).__name__,
+        'channels': len(queues),
+        'messages': sum(queue.qsize() for queue in queues if hasattr(queue, 'qsize')),
+        'groups': len(getattr(layer, 'groups', {}))
+    }
+
+
+def start_tracing(frames=None):
+    """Starts tracemalloc and takes the baseline later diffs are made against"""
+    global trace_baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames or settings.MEMORY_TRACE_FRAMES)
+    trace_baseline = take_snapshot()
+
+
+def stop_tracing():
+    global trace_baseline
+    trace_baseline = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+def allocation_diff(limit=None):
+    """
+    Top allocation sites by growth since the baseline.
+
+    Returns:
+        List of dictionaries with the location and size/count deltas, or
+        None if tracing is off
+    """
+    if trace_baseline is None or not tracemalloc.is_tracing():
+        return None
+    stats = take_snapshot().compare_to(trace_baseline, 'lineno')
+    return [
+        {
+            'location': str(stat.traceback[0]),
+            'size': stat.size,
+            'size_diff': stat.size_diff,
+            'count': stat.count,
+            'count_diff': stat.count_diff
+        }
+        for stat in stats[:limit or settings.MEMORY_TOP_ALLOCATIONS]
+    ]
+
+
+def report(limit=None):
+    """
+    Returns what the process is holding on to.
+
+    Returns:
+        Dictionary with 'rss', 'tables', 'connections', 'channel_layer'
+        and 'tracing'/'allocations'
+    """
+    table_sizes = {}
+    for name, source in list(tables.items()):
+        try:
+            table_sizes[name] = measure_table(source)
+        except Exception as e:
+            table_sizes[name] = f"error: {str(e)}"
+
+    connections = {}
+    for kind in list(live_consumers):
+        connections[kind] = {
+            'open': open_connections[kind],
+            # Closed consumers something still references show up here
+            'alive': len(live_consumers[kind])
+        }
+
+    try:
+        layer = channel_layer_buffers()
+    except Exception as e:
+        layer = f"error: {str(e)}"
+
+    return {
+        'rss': get_rss(),
+        'tables': table_sizes,
+        'connections': connections,
+        'channel_layer': layer,
+        'tracing': tracemalloc.is_tracing(),
+        'allocations': allocation_diff(limit)
+    }
+
+
+metrics.set_gauge('memory.rss_bytes', get_rss)
+
+
+class MemoryView(APIView):
+    """
+    API endpoint exposing the memory report of the serving process.
+
+    POST {"tracing": true} starts allocation tracing, {"tracing": false}
+    stops it and {"reset_baseline": true} diffs from now on.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        limit = request.query_params.get('limit')
+        return Response(report(int(limit) if limit and limit.isdigit() else None))
+
+    def post(self, request):
+        tracing = request.data.get('tracing')
+        if tracing is True:
+            start_tracing()
+        elif tracing is False:
+            stop_tracing()
+        elif request.data.get('reset_baseline') and tracemalloc.is_tracing():
+            start_tracing()
+        return Response({'tracing': tracemalloc.is_tracing()})
@@ -0,0 +1,76 @@
+"""
+In-process runtime metrics.
+
+Counters, gauges and summaries live in module-level dicts of the process
+that records them; MetricsView exposes a snapshot as JSON for admins.
+"""
+from collections import defaultdict
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import permissions
+
+counters = defaultdict(int)
+
+# name -> value, or a callable evaluated when a snapshot is taken
+gauges = {}
+
+# name -> {'count', 'sum', 'min', 'max', 'last'}
+summaries = {}
+
+
+def incr(name, value=1):
+    """Increments a counter"""
+    counters[name] += value
+
+
+def set_gauge(name, value):
+    """Sets a gauge to a value, or to a callable returning the value"""
+    gauges[name] = value
+
+
+def observe(name, value):
+    """Records one observation of a summary (latency, size, ...)"""
+    summary = summaries.get(name)
+    if summary is None:
+        summaries[name] = {'count': 1, 'sum': value, 'min': value, 'max': value, 'last': value}
+        return
+    summary['count'] += 1
+    summary['sum'] += value
+    summary['last'] = value
+    if value < summary['min']:
+        summary['min'] = value
+    if value > summary['max']:
+        summary['max'] = value
+
+
+def snapshot():
+    """
+    Returns the current value of every metric.
+
+    Returns:
+        Dictionary with 'counters', 'gauges' and 'summaries'
+    """
+    gauge_values = {}
+    for name, value in list(gauges.items()):
+        try:
+            gauge_values[name] = value() if callable(value) else value
+        except Exception as e:
+            gauge_values[name] = f"error: {str(e)}"
+
+    summary_values = {}
+    for name, summary in list(summaries.items()):
+        summary_values[name] = dict(summary, avg=summary['sum'] / summary['count'])
+
+    return {
+        'counters': dict(counters),
+        'gauges': gauge_values,
+        'summaries': summary_values
+    }
+
+
+class MetricsView(APIView):
+    """API endpoint exposing the runtime metrics of the serving process"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(snapshot())
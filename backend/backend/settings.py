@@ -226,16 +226,116 @@ SIMPLE_JWT = {
 #     }
 # }
 
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
 # channel layers
 CHANNEL_LAYERS = {
     "default" : {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("redis", 6379)],
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
 
+# Game results persistence (write-behind)
+# Finished games are queued in memory and written by a background worker.
+# Set GAME_RESULTS_STREAM to keep the queue in a Redis stream instead, so
+# queued results survive a worker restart.
+GAME_RESULTS_STREAM = os.getenv("GAME_RESULTS_STREAM", "")
+GAME_RESULTS_BATCH_SIZE = 50
+GAME_RESULTS_FLUSH_INTERVAL = 1.0  # seconds
+# Stream events a consumer read but has not acknowledged for this long
+# (its worker died) are claimed by another worker
+GAME_RESULTS_CLAIM_IDLE = 60.0  # seconds
+
+# Game socket backpressure
+# Each game socket has its own outbound queue where only the newest tick
+# frame is kept. Clients acknowledge every GAME_FRAME_ACK_EVERY-th frame and
+# no new frame is sent while GAME_MAX_UNACKED_FRAMES are unacknowledged (a
+# multiple of GAME_FRAME_ACK_EVERY). A socket with more queued messages than
+# the high-water mark, or that acknowledges nothing (or whose send blocks)
+# for longer than the stall timeout, is closed.
+GAME_OUTBOUND_HIGH_WATER = 64
+GAME_SEND_STALL_TIMEOUT = 5.0  # seconds
+GAME_FRAME_ACK_EVERY = 6  # 10 acks per second at 60 frames per second
+GAME_MAX_UNACKED_FRAMES = 30
+
+# Idle game reaper
+# One task per process evicts games nobody is connected to, at most
+# GAME_REAPER_BATCH_SIZE games per batch.
+GAME_REAPER_INTERVAL = 5.0  # seconds
+GAME_REAPER_BATCH_SIZE = 100
+
+# Memory introspection (api/metrics/memory/)
+# Frames kept per allocation when tracemalloc is switched on at runtime, and
+# allocation sites listed in a report
+MEMORY_TRACE_FRAMES = 1
+MEMORY_TOP_ALLOCATIONS = 20
+
+# Event loop and executor monitoring
+# The loop lag is sampled every LOOP_LAG_INTERVAL; lag or executor queue
+# waits above these thresholds are logged, at most once per
+# MONITOR_WARNING_INTERVAL per call site
+LOOP_LAG_INTERVAL = 0.5  # seconds
+LOOP_LAG_WARNING_MS = 50
+EXECUTOR_WAIT_WARNING_MS = 100
+MONITOR_WARNING_INTERVAL = 10.0  # seconds
+
+# Executor pools for sync ORM calls, picked per call site with
+# database_sync_to_async(pool=...). Callers stop waiting for a call after
+# `timeout` seconds; beyond `queue_limit` waiting or running calls new ones
+# are rejected.
+EXECUTOR_POOLS = {
+    'game': {'workers': 4, 'queue_limit': 200, 'timeout': 10.0},
+    'matchmaking': {'workers': 2, 'queue_limit': 50, 'timeout': 5.0},
+    'chat': {'workers': 4, 'queue_limit': 500, 'timeout': 5.0},
+    'notify': {'workers': 2, 'queue_limit': 500, 'timeout': 5.0},
+}
+
+# Game shards: the locations game workers run in. Every process serves the
+# shard it is started with; clients may report their RTT to the others so
+# the matchmaker can host a pair where the worse of their RTTs is lowest.
+GAME_SHARD = os.getenv("GAME_SHARD", "default")
+GAME_SHARDS = [shard.strip() for shard in os.getenv("GAME_SHARDS", GAME_SHARD).split(",") if shard.strip()]
+
+# Matchmaking
+# 'redis' keeps waiting players in Redis sorted sets paired by one matcher
+# task per process; 'database' has every connected matchmaking socket poll
+# MatchmakingQueue.
+MATCHMAKING_BACKEND = os.getenv("MATCHMAKING_BACKEND", "redis")
+MATCHMAKING_INTERVAL = 1.0  # seconds between matching passes
+MATCHMAKING_BATCH_SIZE = 50  # pairs made per script call
+MATCHMAKING_SCAN_SIZE = 200  # waiting players tried per script call
+# A player is paired with the closest rated player within
+# MATCHMAKING_RATING_WINDOW, widened by MATCHMAKING_RATING_WINDOW_GROWTH per
+# second waited up to MATCHMAKING_MAX_RATING_WINDOW
+MATCHMAKING_RATING_WINDOW = 100
+MATCHMAKING_RATING_WINDOW_GROWTH = 20
+MATCHMAKING_MAX_RATING_WINDOW = 1000
+# Queue positions are pushed to waiting players at most this often
+MATCHMAKING_STATUS_INTERVAL = 1.0  # seconds
+# Every process refreshes the queue entries of its connected players; the
+# matchmaker expires entries not refreshed within the TTL (process crashed)
+MATCHMAKING_HEARTBEAT_INTERVAL = 10.0  # seconds
+MATCHMAKING_QUEUE_TTL = 30.0  # seconds
+MATCHMAKING_SWEEP_INTERVAL = 5.0  # seconds between expiry sweeps
+# Players' RTT to their matchmaking process is sampled every
+# MATCHMAKING_PING_INTERVAL and stored per shard. A pair is only made if the
+# worse of the two RTTs on some shard is under MATCHMAKING_RTT_LIMIT, raised by
+# MATCHMAKING_RTT_LIMIT_GROWTH per second waited; among the
+# MATCHMAKING_RTT_CANDIDATES closest rated players on each side, each ms of
+# that RTT weighs as much as MATCHMAKING_RTT_WEIGHT rating points.
+MATCHMAKING_PING_INTERVAL = 5.0  # seconds
+MATCHMAKING_RTT_LIMIT = 150  # ms
+MATCHMAKING_RTT_LIMIT_GROWTH = 10  # ms per second waited
+MATCHMAKING_RTT_CANDIDATES = 4
+MATCHMAKING_RTT_WEIGHT = 1.0
+# Only the holder of the matchmaker lease matches; it is renewed every pass
+# and taken over by another process if not renewed within the TTL
+MATCHMAKER_LEASE_TTL = 5.0  # seconds
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
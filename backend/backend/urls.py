@@ -20,6 +20,8 @@ from django.http import HttpResponse
 from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
+from backend.metrics import MetricsView
+from backend.memory import MemoryView
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -41,6 +43,8 @@ urlpatterns = [
     path('api/friends/', include("friends.urls")),
     path("api/chat/", include("chat.urls")),
     path("api/pong_game/", include("pong_game.urls")),
+    path("api/metrics/", MetricsView.as_view(), name="metrics"),
+    path("api/metrics/memory/", MemoryView.as_view(), name="memory"),
     
     re_path(
         r"^swagger(?P<format>\.json|\.yaml)$",
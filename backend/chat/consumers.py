@@ -1,19 +1,44 @@
 from rest_framework_simplejwt.tokens import AccessToken
-from channels.db import database_sync_to_async
+from backend.executors import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from authentication.models import User
 from .models import Message
-from asgiref.sync import sync_to_async
 from django.utils import timezone
 from .models import Conversation, Message
+from django.db import transaction
 from django.db.models import Q
 from friends.models import Friend
+from backend import memory
+
+# Conversation lists cached by this process's chat sockets
+memory.register_table(
+    'chat.conversations',
+    lambda: [
+        consumer.conversations
+        for consumer in memory.get_consumers('ChatConsumer')
+        if getattr(consumer, 'conversations', None) is not None
+    ]
+)
+memory.register_table(
+    'chat.members',
+    lambda: [
+        consumer.members
+        for consumer in memory.get_consumers('ChatConsumer')
+        if getattr(consumer, 'members', None) is not None
+    ]
+)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):        
+        memory.open_connection(self)
         self.room_group_name = None
+        # conversation id -> {user id: username} of the other participants.
+        # Only touched on the event loop; an entry is dropped when its
+        # conversation is deleted or one of its members blocks the user, and
+        # refilled by get_conversations or on a miss.
+        self.members = {}
         user_id = self.scope.get('user_id')
         
         if not user_id:
@@ -21,7 +46,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
             
         try:
-            self.user = await database_sync_to_async(User.objects.get)(id=user_id)
+            self.user = await database_sync_to_async(User.objects.get, pool='chat')(id=user_id)
         except Exception as e:
             await self.close()
             return
@@ -35,13 +60,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
     async def disconnect(self, close_code):
+        memory.close_connection(self)
         if not self.room_group_name:
             return
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
         self.conversations = None
+        self.members.clear()
+
+    async def get_conversations(self):
+        self.conversations, self.members = await self.load_conversations()
 
-    @sync_to_async
-    def get_conversations(self):
+    @database_sync_to_async(pool='chat')
+    def load_conversations(self):
+        """Conversations of the user not involving a block, and their members"""
         blocked_users = Friend.objects.filter(
             sender=self.user,
             state='blocked'
@@ -57,26 +88,84 @@ class ChatConsumer(AsyncWebsocketConsumer):
             .exclude(participants__in=blocked_by)\
             .prefetch_related('participants')
         
-        self.conversations = list(conversations)
+        conversations = list(conversations)
+        members = {
+            str(conversation.id): {
+                user.id: user.username
+                for user in conversation.participants.all()
+                if user.id != self.user.id
+            }
+            for conversation in conversations
+        }
+        return conversations, members
+
+    # Each event's queries run in one executor call rather than one per query
+
+    async def get_receivers(self, conversation_id):
+        """
+        Usernames of the other participants, from the membership cache.
+
+        Returns:
+            List of usernames, or None if the user is not a participant
+        """
+        key = str(conversation_id)
+        members = self.members.get(key)
+        if members is None:
+            members = await self.load_members(conversation_id)
+            if members is None:
+                return None
+            self.members[key] = members
+        return list(members.values())
 
-    @sync_to_async
-    def create_message(self, conversation, message_text):
-        message_obj = Message.objects.create(conversation=conversation, sender=self.user, message=message_text)
-        return message_obj
+    @database_sync_to_async(pool='chat')
+    def load_members(self, conversation_id):
+        """The other participants as {user id: username}, or None if the user is not one"""
+        participants = dict(
+            User.objects.filter(conversations__id=conversation_id).values_list('id', 'username')
+        )
+        if participants.pop(self.user.id, None) is None:
+            return None
+        return participants
 
-    @sync_to_async
-    def update_latest_message(self, conversation, message_obj, message_text):
-        conversation.latest_message_text = message_text
-        conversation.latest_message_created_at = message_obj.created_at
-        conversation.save()
+    @database_sync_to_async(pool='chat')
+    def save_message(self, conversation_id, message_text):
+        """Stores a message of a conversation the user is known to take part in"""
+        # Message.save also updates the conversation's latest message; the
+        # unsaved instance spares reading the conversation for that
+        Message.objects.create(
+            conversation=Conversation(id=conversation_id),
+            sender=self.user,
+            message=message_text
+        )
 
-    @sync_to_async
+    @database_sync_to_async(pool='chat')
     def mark_messages_as_seen(self, conversation_id):
+        """Marks the messages the user received in a conversation as seen"""
         Message.objects.filter(
             conversation_id=conversation_id,
             seen=False
         ).exclude(sender=self.user).update(seen=True)
 
+    @database_sync_to_async(pool='chat')
+    def delete_conversation(self, conversation_id):
+        Conversation.objects.filter(id=conversation_id).delete()
+
+    @database_sync_to_async(pool='chat')
+    def create_conversation(self, receiver):
+        """Creates a conversation with a user unless either blocked the other"""
+        is_blocked = Friend.objects.filter(
+            Q(sender=self.user, recipient__username=receiver, state='blocked') |
+            Q(sender__username=receiver, recipient=self.user, state='blocked')
+        ).exists()
+        if is_blocked:
+            return False
+
+        receiver_user = User.objects.get(username=receiver)
+        with transaction.atomic():
+            conversation = Conversation.objects.create()
+            conversation.participants.add(self.user, receiver_user)
+        return True
+
     async def receive(self, text_data):
         data = json.loads(text_data)
         event = data.get("event")
@@ -85,18 +174,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.get_conversations()
             if event == "create_conversation":
                 receiver = data.get("data").get("receiver")
-                # Check if either user has blocked the other
-                is_blocked = await database_sync_to_async(Friend.objects.filter)(
-                    Q(sender=self.user, recipient__username=receiver, state='blocked') |
-                    Q(sender__username=receiver, recipient=self.user, state='blocked')
-                ).exists()
-                
-                if is_blocked:
+                # Not created if either user has blocked the other
+                if not await self.create_conversation(receiver):
                     return
                 
-                receiver_user = await database_sync_to_async(User.objects.get)(username=receiver)
-                conversation = await database_sync_to_async(Conversation.objects.create)()
-                await database_sync_to_async(conversation.participants.add)(self.user, receiver_user)
                 await self.channel_layer.group_send(
                     f"chat_{receiver}",
                     {
@@ -105,35 +186,32 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 )
         elif event == "mark_seen":
             conversation_id = data.get("data").get("conversation_id")
-            if conversation_id:
+            receivers = await self.get_receivers(conversation_id) if conversation_id else None
+            if receivers is not None:
                 await self.mark_messages_as_seen(conversation_id)
                 # Notify other participant about seen status
-                conversation = await database_sync_to_async(Conversation.objects.get)(id=conversation_id)
-                participants = await database_sync_to_async(list)(conversation.participants.all())
-                for participant in participants:
-                    if participant != self.user:
-                        await self.channel_layer.group_send(
-                            f"chat_{participant.username}",
-                            {
-                                "type": "update_conversations",
-                            },
-                        )
+                for username in receivers:
+                    await self.channel_layer.group_send(
+                        f"chat_{username}",
+                        {
+                            "type": "update_conversations",
+                        },
+                    )
         elif event == "remove_conversation":
             conversation_id = data.get("data").get("conversation_id")
-            if conversation_id:
-                conversation = await database_sync_to_async(Conversation.objects.get)(id=conversation_id)
-                if self.user in await database_sync_to_async(list)(conversation.participants.all()):
-                    await database_sync_to_async(conversation.delete)()
-                    # Notify other participants
-                    participants = await database_sync_to_async(list)(conversation.participants.all())
-                    for participant in participants:
-                        if participant != self.user:
-                            await self.channel_layer.group_send(
-                                f"chat_{participant.username}",
-                                {
-                                    "type": "update_conversations",
-                                },
-                            )
+            receivers = await self.get_receivers(conversation_id) if conversation_id else None
+            if receivers is not None:
+                # Participants are read before the delete so they can be notified
+                await self.delete_conversation(conversation_id)
+                self.members.pop(str(conversation_id), None)
+                for username in receivers:
+                    await self.channel_layer.group_send(
+                        f"chat_{username}",
+                        {
+                            "type": "update_conversations",
+                            "conversation_id": conversation_id,
+                        },
+                    )
         else:
             message_text = data.get("data").get("message")
             receiver = data.get("data").get("receiver")
@@ -143,37 +221,33 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 message_text = message_text[:500]
 
             if message_text and conversation_id:
-                conversation = await database_sync_to_async(Conversation.objects.get)(id=conversation_id)
-                participants = await database_sync_to_async(list)(conversation.participants.all())
+                receivers = await self.get_receivers(conversation_id)
                 
-                if self.user in participants:
-                    message_obj = await self.create_message(conversation, message_text)
-                    await self.update_latest_message(conversation, message_obj, message_text)
-
-                    for participant in participants:
-                        if participant != self.user:
-                            await self.channel_layer.group_send(
-                                f"chat_{participant.username}",
-                                {
-                                    "type": "chat_message",
-                                    "message": message_text,
-                                    "sender": self.user.username,
-                                    "conversation": {
-                                        "conversation_id": conversation.id,
-                                        "participant": {
-                                            "username": self.user.username,
-                                            "first_name": self.user.first_name,
-                                            "last_name": self.user.last_name,
-                                            "avatar": self.user.avatar,
-                                            "status": self.user.status
-                                        },
-                                        "latest_message": {
-                                            "message": message_text,
-                                            "created_at": timezone.now().isoformat(),
-                                        },
+                if receivers is not None:
+                    await self.save_message(conversation_id, message_text)
+                    for username in receivers:
+                        await self.channel_layer.group_send(
+                            f"chat_{username}",
+                            {
+                                "type": "chat_message",
+                                "message": message_text,
+                                "sender": self.user.username,
+                                "conversation": {
+                                    "conversation_id": conversation_id,
+                                    "participant": {
+                                        "username": self.user.username,
+                                        "first_name": self.user.first_name,
+                                        "last_name": self.user.last_name,
+                                        "avatar": self.user.avatar,
+                                        "status": self.user.status
+                                    },
+                                    "latest_message": {
+                                        "message": message_text,
+                                        "created_at": timezone.now().isoformat(),
                                     },
                                 },
-                            )
+                            },
+                        )
 
     async def chat_message(self, event):
         message = event["message"]
@@ -192,6 +266,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     async def update_conversations(self, event):
+        # Only a deleted conversation changes membership; seen-state updates
+        # leave the cache alone
+        if event.get("conversation_id") is not None:
+            self.members.pop(str(event["conversation_id"]), None)
         await self.send(
             text_data=json.dumps(
                 {
@@ -205,6 +283,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Handle block status update notifications.
         This is called when a user blocks or unblocks the current user.
         """
+        blocker_id = event["blocker"]["id"]
+        for conversation_id in [
+            key for key, members in self.members.items() if blocker_id in members
+        ]:
+            del self.members[conversation_id]
         await self.send(
             text_data=json.dumps({
                 "event": event["event"],
@@ -1,3 +1,70 @@
-from django.test import TestCase
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+from authentication.models import User
+from backend import memory
+from .consumers import ChatConsumer
+from .models import Conversation
 
-# Create your tests here.
+
+# Consumers query the database from the executor pools' threads, so the rows
+# must be committed rather than held in a test transaction
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MembersCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', email='alice@example.com')
+        self.bob = User.objects.create(username='bob', email='bob@example.com')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.alice, self.bob)
+        self.key = str(self.conversation.id)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user_id'] = user.id
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def members_of(self, user):
+        consumer = next(
+            consumer for consumer in memory.get_consumers('ChatConsumer')
+            if consumer.user.id == user.id
+        )
+        return consumer.members
+
+    async def test_seen_update_keeps_members(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        self.assertIn(self.key, self.members_of(self.alice))
+
+        await bob.send_json_to({'event': 'mark_seen', 'data': {'conversation_id': self.conversation.id}})
+        await alice.receive_json_from(timeout=2)
+
+        self.assertIn(self.key, self.members_of(self.alice))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_removed_conversation_is_dropped(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+
+        await bob.send_json_to({'event': 'remove_conversation', 'data': {'conversation_id': self.conversation.id}})
+        await alice.receive_json_from(timeout=2)
+
+        self.assertNotIn(self.key, self.members_of(self.alice))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_block_drops_conversations_with_blocker(self):
+        alice = await self.connect(self.alice)
+
+        await get_channel_layer().group_send('chat_alice', {
+            'type': 'block_status_update',
+            'event': 'block_status_update',
+            'status': 'blocked',
+            'blocker': {'id': self.bob.id, 'username': self.bob.username}
+        })
+        await alice.receive_json_from(timeout=2)
+
+        self.assertNotIn(self.key, self.members_of(self.alice))
+        await alice.disconnect()
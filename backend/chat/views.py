@@ -208,7 +208,7 @@ def DeleteConversation(request, conversation_id):
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             f"chat_{participant.username}",
-            {"type": "update_conversations"}
+            {"type": "update_conversations", "conversation_id": conversation_id}
         )
 
         conversation.delete()
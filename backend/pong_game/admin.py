@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Game, Match
+from .models import Game, Match, PointEvent
 
 admin.site.register(Game)
 admin.site.register(Match)
+admin.site.register(PointEvent)
@@ -0,0 +1,107 @@
+from backend import metrics
+
+
+class ClockEstimate:
+    """
+    NTP-style estimate of one client's round-trip time and clock offset.
+
+    Every ping carries the client's send time (t0), the server stamps its
+    receive (t1) and send (t2) times on the pong, and the next ping reports
+    when the client got that pong (t3). All times are milliseconds since
+    the epoch, each on its own side's clock. The offset is server clock
+    minus client clock, so client_time = server_time - offset.
+    """
+
+    # EWMA weights for new samples
+    RTT_ALPHA = 0.125
+    OFFSET_ALPHA = 0.25
+
+    def __init__(self):
+        self.rtt = None
+        self.offset = None
+        self.samples = 0
+        self.pending = None
+
+    def on_ping(self, content):
+        """Completes the previous exchange if the client reports when it received our pong"""
+        client_receive = content.get('last_pong_receive_time')
+        if self.pending is not None and isinstance(client_receive, (int, float)):
+            self.add_sample(*self.pending, client_receive)
+        self.pending = None
+
+    def on_pong(self, client_send, server_receive, server_send):
+        """Remembers the exchange until the client reports its receive time"""
+        if isinstance(client_send, (int, float)):
+            self.pending = (client_send, server_receive, server_send)
+
+    def add_sample(self, client_send, server_receive, server_send, client_receive):
+        """
+        Folds one complete exchange into the estimate.
+
+        Returns:
+            Boolean indicating if the sample was used
+        """
+        rtt = (client_receive - client_send) - (server_send - server_receive)
+        if rtt < 0:
+            return False
+        offset = ((server_receive - client_send) + (server_send - client_receive)) / 2
+
+        if self.rtt is None:
+            self.rtt = rtt
+            self.offset = offset
+        else:
+            # Samples delayed far beyond the usual RTT give skewed offsets
+            if rtt <= 2 * self.rtt:
+                self.offset += self.OFFSET_ALPHA * (offset - self.offset)
+            self.rtt += self.RTT_ALPHA * (rtt - self.rtt)
+        self.samples += 1
+
+        metrics.observe('game.rtt_ms', rtt)
+        metrics.observe('game.clock_offset_ms', abs(offset))
+        return True
+
+    def as_dict(self):
+        """Current estimate as sent to the client, None until the first sample"""
+        if self.rtt is None:
+            return None
+        return {
+            'rtt': round(self.rtt, 1),
+            'offset': round(self.offset, 1),
+            'samples': self.samples
+        }
+
+
+class RttEstimate:
+    """
+    Smoothed round-trip time from server-initiated pings: the server sends
+    its send time and the client echoes it straight back, so no clock
+    offset is involved.
+    """
+
+    RTT_ALPHA = ClockEstimate.RTT_ALPHA
+
+    def __init__(self):
+        self.rtt = None
+        self.samples = 0
+
+    def on_pong(self, server_send, server_receive):
+        """
+        Folds the echo of a ping sent at server_send into the estimate.
+
+        Returns:
+            Boolean indicating if the sample was used
+        """
+        if not isinstance(server_send, (int, float)):
+            return False
+        rtt = server_receive - server_send
+        if rtt < 0:
+            return False
+
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.RTT_ALPHA * (rtt - self.rtt)
+        self.samples += 1
+
+        metrics.observe('matchmaking.rtt_ms', rtt)
+        return True
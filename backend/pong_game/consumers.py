@@ -1,21 +1,24 @@
-import json
 import asyncio
-import uuid
+import json
 import time
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.utils import timezone
-from django.db import transaction
+from backend.executors import database_sync_to_async
+from backend import memory
 from django.db.models import Q
+from django.conf import settings
 
-from .models import PlayerProfile, MatchmakingQueue, Game, StatusChoices
+from .models import PlayerProfile, MatchmakingQueue, StatusChoices
+from .clock_sync import RttEstimate
+from .reaper import idle_game_reaper
+from . import game_logic, matchmaking
 from authentication.models import User
 
 
 class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
     """
     WebSocket consumer for handling matchmaking functionality.
-    Handles queue management and continuously searches for matches.
+    Handles joining, leaving and queue status; pairs are made by the
+    matchmaker service in matchmaking.py.
     """
     
     async def connect(self):
@@ -23,6 +26,8 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         Called when a WebSocket connection is established.
         Authenticates the user and adds them to relevant groups.
         """
+        memory.open_connection(self)
+        
         # Get user_id from scope (set by your TokenAuthMiddleware)
         user_id = self.scope.get('user_id')
         
@@ -33,8 +38,10 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         
         try:
             # Get the actual User object from the database
-            self.user = await database_sync_to_async(User.objects.get)(id=user_id)
+            self.user = await database_sync_to_async(User.objects.get, pool='matchmaking')(id=user_id)
             self.user_id = user_id
+            # Profile created by the first join of the connection
+            self.has_profile = False
         except Exception as e:
             await self.close()
             return
@@ -71,21 +78,25 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
             "status": queue_status
         })
         
-        # Start periodic matchmaking task
-        self.matchmaking_task = asyncio.create_task(self.periodic_matchmaking())
+        # Pairs are made by the elected matchmaker, every process runs a candidate
+        # that also keeps the queue entries of its connected players alive
+        matchmaking.track_player(self.user_id)
+        matchmaking.matchmaker.ensure_started()
+        
+        # RTT to this process's shard, used by the matcher to avoid laggy pairings
+        self.rtt = RttEstimate()
+        self.ping_task = asyncio.create_task(self.ping_loop())
     
     async def disconnect(self, close_code):
         """
         Called when the WebSocket connection is closed.
         Cleans up tasks, group memberships, and queue entries.
         """
-        # Cancel the periodic matchmaking task
-        if hasattr(self, 'matchmaking_task'):
-            self.matchmaking_task.cancel()
-            try:
-                await self.matchmaking_task
-            except asyncio.CancelledError:
-                pass
+        memory.close_connection(self)
+        
+        ping_task = getattr(self, 'ping_task', None)
+        if ping_task is not None:
+            ping_task.cancel()
         
         # Leave the matchmaking groups
         await self.channel_layer.group_discard(
@@ -100,6 +111,7 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         
         # Remove the user from the matchmaking queue
         await self.leave_queue()
+        matchmaking.untrack_player(self.user_id)
     
     async def receive_json(self, content):
         """
@@ -109,6 +121,11 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         try:
             message_type = content.get("type", "")
             
+            # Ping echoes are frequent and need no acknowledgement
+            if message_type == "pong":
+                await self.on_pong(content)
+                return
+            
             # Test response - this should always work
             await self.send_json({
                 "type": "received",
@@ -156,158 +173,47 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         """Helper method to send JSON messages to the client."""
         await self.send(text_data=json.dumps(content))
     
-    async def periodic_matchmaking(self):
-        """
-        Periodically checks for potential matches.
-        Uses a distributed lock to ensure only one consumer performs matching at a time.
-        """
-        while True:
-            try:
-                # Try to acquire the matchmaking lock
-                should_run = await self.try_acquire_matchmaking_lock()
-                
-                if should_run:
-                    # This consumer will perform the matchmaking
-                    matches = await self.find_matches()
-                    
-                    # If matches were found, notify the relevant players
-                    for match in matches:
-                        # Notify player 1
-                        await self.channel_layer.group_send(
-                            f"user_{match['player1_id']}",
-                            {
-                                "type": "match_found",
-                                "game_id": match['game_id'],
-                                "player1": match['player1_username'],
-                                "player2": match['player2_username'],
-                                "opponent_avatar": match['player2_avatar']
-                            }
-                        )
-                        await self.channel_layer.group_send(
-                            f"user_{match['player2_id']}",
-                            {
-                                "type": "match_found",
-                                "game_id": match['game_id'],
-                                "player1": match['player1_username'],
-                                "player2": match['player2_username'],
-                                "opponent_avatar": match['player1_avatar']
-                            }
-                        )
-                    
-                    # Release the lock after completion
-                    await self.release_matchmaking_lock()
-                
-                # Wait before checking again
-                await asyncio.sleep(5)  # Check every 5 seconds
-                
-            except asyncio.CancelledError:
-                # Task was cancelled (during disconnect)
-                break
-            except Exception as e:
-                await asyncio.sleep(5)
-    
-    async def try_acquire_matchmaking_lock(self):
-        """
-        Attempts to acquire a distributed lock for matchmaking using channel groups.
-        """
-        try:
-            # Generate a unique lock ID for this consumer
-            self.lock_id = f"{self.channel_name}_{uuid.uuid4()}"
-            
-            # Create a lock group and add ourselves to it
-            lock_group = "matchmaking_lock"
-            
-            # Check if we're the first to join this group by sending a message
-            await self.channel_layer.group_add(lock_group, self.channel_name)
-            
-            # Send a message to the group to announce our lock attempt
-            await self.channel_layer.group_send(
-                lock_group,
-                {
-                    "type": "lock_attempt",
-                    "lock_id": self.lock_id,
-                    "timestamp": time.time()
-                }
-            )
-            
-            # Wait a brief moment to ensure all messages are processed
-            await asyncio.sleep(0.1)
-            
-            # If we're still the holder of the lock, we've acquired it
-            return True
-            
-        except Exception as e:
-            return False
-
-    async def release_matchmaking_lock(self):
-        """
-        Releases the matchmaking lock by leaving the lock group.
-        """
-        try:
-            # Leave the lock group
-            await self.channel_layer.group_discard(
-                "matchmaking_lock",
-                self.channel_name
-            )
-        except Exception as e:
-            pass
-
-    async def lock_attempt(self, event):
-        """
-        Handles lock attempt messages from other consumers.
-        """
-        # If another consumer attempts to acquire the lock,
-        # we'll receive this message. We don't need to do anything specific here
-        # as we're just using the group to coordinate lock ownership.
-        pass
-
-    @database_sync_to_async
-    def join_queue(self, difficulty=None):
+    async def join_queue(self, difficulty=None):
         """
         Adds the user to the matchmaking queue with their preferred difficulty.
         Returns the current status of the queue entry.
         """
+        if settings.MATCHMAKING_BACKEND != 'redis':
+            return await self.join_queue_in_db(difficulty)
         try:
-            # Get or create player profile
-            profile, created = PlayerProfile.objects.get_or_create(player=self.user)
-            
-            # Use provided difficulty or player's default
-            if difficulty is None:
-                difficulty = profile.difficulty
-            
-            # Check if player is already in queue
-            existing_entry = MatchmakingQueue.objects.filter(
-                player=self.user,
-                is_active=True
-            ).first()
-            
-            if existing_entry:
-                # Player is already in queue, update their preference if needed
-                if existing_entry.difficulty_preference != difficulty:
-                    existing_entry.difficulty_preference = difficulty
-                    existing_entry.save()
-                return {"status": "already_in_queue", "position": self._get_queue_position(existing_entry)}
-            
-            # Create new queue entry
-            queue_entry = MatchmakingQueue.objects.create(
-                player=self.user,
-                difficulty_preference=difficulty,
-                is_active=True,
-                status=StatusChoices.QUEUE_WAITING
+            profile = await self.get_profile()
+            return await matchmaking.join_queue(self.user, difficulty or profile.difficulty, profile.rating)
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+    
+    @database_sync_to_async(pool='matchmaking')
+    def get_profile(self):
+        profile, created = PlayerProfile.objects.get_or_create(player=self.user)
+        return profile
+    
+    async def join_queue_in_db(self, difficulty=None):
+        """MatchmakingQueue version of join_queue"""
+        try:
+            result = await matchmaking.join_queue_in_db(
+                self.user_id, difficulty, ensure_profile=not self.has_profile
             )
-            
-            # Return queue status
-            return {"status": "in_queue", "position": self._get_queue_position(queue_entry)}
-                
+            self.has_profile = True
+            return result
         except Exception as e:
             return {"status": "error", "message": str(e)}
     
-    @database_sync_to_async
-    def leave_queue(self):
+    async def leave_queue(self):
         """
         Removes the user from the matchmaking queue.
         Returns the updated status.
         """
+        if settings.MATCHMAKING_BACKEND == 'redis':
+            return await matchmaking.leave_queue(self.user_id)
+        return await self.leave_queue_in_db()
+    
+    @database_sync_to_async(pool='matchmaking')
+    def leave_queue_in_db(self):
+        """MatchmakingQueue version of leave_queue"""
         entries = MatchmakingQueue.objects.filter(
             player=self.user,
             is_active=True
@@ -320,12 +226,18 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         
         return {"status": "left_queue"}
     
-    @database_sync_to_async
-    def get_queue_status(self):
+    async def get_queue_status(self):
         """
         Gets the current status of the user in the matchmaking queue.
         Returns information about their position and waiting time.
         """
+        if settings.MATCHMAKING_BACKEND == 'redis':
+            return await matchmaking.get_queue_status(self.user_id)
+        return await self.get_queue_status_in_db()
+    
+    @database_sync_to_async(pool='matchmaking')
+    def get_queue_status_in_db(self):
+        """MatchmakingQueue version of get_queue_status"""
         # Check if user is in queue
         entry = MatchmakingQueue.objects.filter(
             player=self.user,
@@ -367,107 +279,62 @@ class MatchmakingConsumer(AsyncJsonWebsocketConsumer):
         
         return position
     
-    @database_sync_to_async
-    def find_matches(self):
-        """
-        Finds potential matches among players in the queue.
-        Uses transaction to ensure data consistency.
-        """
-        matches_created = []
-        
-        with transaction.atomic():
-            # Get all active difficulty preferences
-            difficulties = MatchmakingQueue.objects.filter(
-                is_active=True,
-                status=StatusChoices.QUEUE_WAITING
-            ).values_list('difficulty_preference', flat=True).distinct()
-            
-            # Process each difficulty level separately
-            for difficulty in difficulties:
-                # Get waiting players for this difficulty, ordered by join time
-                waiting_players = list(MatchmakingQueue.objects.filter(
-                    difficulty_preference=difficulty,
-                    is_active=True,
-                    status=StatusChoices.QUEUE_WAITING
-                ).order_by('joined_at'))
-                
-                # Match players (taking two at a time)
-                while len(waiting_players) >= 2:
-                    player1_entry = waiting_players[0]
-                    
-                    # Find the next player who isn't the same as player1
-                    player2_entry = None
-                    for entry in waiting_players[1:]:
-                        if entry.player.id != player1_entry.player.id:
-                            player2_entry = entry
-                            break
-                    
-                    # If we couldn't find a valid second player, break out
-                    if not player2_entry:
-                        break
-                    
-                    # Create a game between these players
-                    try:
-                        # Get player profiles for preferences
-                        player1_profile = PlayerProfile.objects.get(player=player1_entry.player)
-                        
-                        game = Game.objects.create(
-                            player1=player1_entry.player,
-                            player2=player2_entry.player,
-                            status=StatusChoices.WAITING,
-                            difficulty=difficulty,
-                        )
-                        
-                        # Update both queue entries
-                        now = timezone.now()
-                        
-                        player1_entry.status = StatusChoices.QUEUE_MATCHED
-                        player1_entry.is_active = False
-                        player1_entry.matched_at = now
-                        player1_entry.resulting_game = game
-                        player1_entry.save()
-                        
-                        player2_entry.status = StatusChoices.QUEUE_MATCHED
-                        player2_entry.is_active = False
-                        player2_entry.matched_at = now
-                        player2_entry.resulting_game = game
-                        player2_entry.save()
-                        
-                        # Store match information for notification
-                        matches_created.append({
-                            'game_id': game.id,
-                            'player1_id': player1_entry.player.id,
-                            'player2_id': player2_entry.player.id,
-                            'player1_username': player1_entry.player.username,
-                            'player2_username': player2_entry.player.username,
-                            'player1_avatar': getattr(player1_entry.player, 'avatar', ''),
-                            'player2_avatar': getattr(player2_entry.player, 'avatar', '')
-                        })
-                        
-                        # Remove these players from the local list
-                        waiting_players.remove(player1_entry)
-                        waiting_players.remove(player2_entry)
-                        
-                    except Exception as e:
-                        # Skip these players and try the next pair
-                        waiting_players = waiting_players[1:]
-        
-        return matches_created
-    
     async def match_found(self, event):
         """
         Handles the match_found event from the channel layer.
         Notifies the client that a match has been found.
         """
+        # Built here rather than on the matchmaking leader, so that the game
+        # state lives on a process of the shard hosting the game
+        if event.get("shard", settings.GAME_SHARD) == settings.GAME_SHARD and "difficulty" in event:
+            game_logic.prewarm_game(event["game_id"], {
+                "difficulty": event["difficulty"],
+                "player1_id": event["player1_id"],
+                "player2_id": event["player2_id"],
+                "player1_username": event["player1"],
+                "player2_username": event["player2"]
+            })
+            # Evicts the game if nobody connects, even on a process that
+            # never hosts a GameConsumer
+            idle_game_reaper.ensure_started()
+        
         await self.send_json({
             "type": "match_found",
             "game_id": event["game_id"],
             "player1": event["player1"],
             "player2": event["player2"],
             "opponent_avatar": event.get("opponent_avatar", ""),
+            "shard": event.get("shard"),
             "game_url": f"/game/{event['game_id']}/"
         })
     
+    async def ping_loop(self):
+        """Pings the client every MATCHMAKING_PING_INTERVAL, it echoes sent_at back"""
+        while True:
+            await self.send_json({"type": "ping", "sent_at": time.time() * 1000})
+            await asyncio.sleep(settings.MATCHMAKING_PING_INTERVAL)
+    
+    async def on_pong(self, content):
+        """
+        Folds a ping echo into the RTT estimate and stores it for the matcher.
+        Clients may also report their RTT to other shards as shard_rtts.
+        """
+        if not self.rtt.on_pong(content.get("sent_at"), time.time() * 1000):
+            return
+        
+        rtts = {settings.GAME_SHARD: self.rtt.rtt}
+        reported = content.get("shard_rtts")
+        if isinstance(reported, dict):
+            for shard, rtt in reported.items():
+                if shard in settings.GAME_SHARDS and shard != settings.GAME_SHARD \
+                        and isinstance(rtt, (int, float)) and rtt >= 0:
+                    rtts[shard] = rtt
+        
+        try:
+            await matchmaking.record_rtt(self.user_id, rtts)
+        except Exception as e:
+            print(f"Error recording RTT: {str(e)}")
+    
     async def queue_status_update(self, event):
         """
         Handles queue status updates from the channel layer.
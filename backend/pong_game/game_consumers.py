@@ -2,10 +2,30 @@ import json
 import asyncio
 import time
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from backend.executors import database_sync_to_async
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from .models import Game
+from backend import memory
+from backend.loop_monitor import loop_monitor
+from .models import Game, StatusChoices
 from . import game_logic
+from .persistence import enqueue_game_result
+from .scheduler import timeouts
+from .clock_sync import ClockEstimate
+from .outbound import OutboundQueue
+from .reaper import idle_game_reaper
+
+# Messages waiting in the outbound queues of this process's game sockets
+memory.register_table(
+    'game.outbound_entries',
+    lambda: [
+        entry
+        for consumer in memory.get_consumers('GameConsumer')
+        if getattr(consumer, 'outbound', None) is not None
+        for entry in list(consumer.outbound.entries)
+    ]
+)
 
 class GameConsumer(AsyncJsonWebsocketConsumer):
     """
@@ -16,6 +36,8 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
     
     async def connect(self):
         """Handle WebSocket connection and authentication with improved waiting logic"""
+        memory.open_connection(self)
+        
         # Get game ID from URL route
         self.game_id = self.scope['url_route']['kwargs']['game_id']
         self.game_group = f"game_{self.game_id}"
@@ -26,8 +48,14 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
         if not self.user_id:
             await self.close(code=4001)
             return
-        # Get game from database
-        self.game = await self.get_game(self.game_id)
+        
+        # Round-trip time and clock offset of this client, fed by pings
+        self.clock = ClockEstimate()
+        
+        # Games pre-warmed at creation are attached to without any DB query
+        self.game = game_logic.get_game_players(self.game_id)
+        if not self.game:
+            self.game = await self.get_game(self.game_id)
         if not self.game:
             await self.close(code=4004)
             return
@@ -42,8 +70,12 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             return
         
         # Initialize game state if not exists
-        if self.game_id not in game_logic.active_games:
-            await self.initialize_game_state()
+        self.initialize_game_state()
+        
+        # Unattended games are evicted by the process-wide reaper
+        idle_game_reaper.ensure_started()
+        # Lag of the loop the game ticks run on
+        loop_monitor.ensure_started()
         
         # Join game group
         await self.channel_layer.group_add(
@@ -60,16 +92,25 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
         # Accept connection
         await self.accept()
         
+        # Everything sent to the client goes through one outbound queue, so
+        # a slow socket cannot back up the channel layer
+        self.outbound = OutboundQueue(self.send_json, on_stall=self.close_stalled)
+        self.outbound.start()
+        
         # Send initial state and connection confirmation
-        await self.send_json({
+        self.outbound.put_control({
             'type': 'connection_established',
             'player_number': self.player_num,
             'game_id': self.game_id
         })
-        state_to_send = game_logic.active_games[self.game_id]
-        await self.send_json({
+        # Static data (players, settings) is sent once, frames carry the rest
+        self.outbound.put_control({
+            'type': 'game_setup',
+            'setup': game_logic.get_game_setup(self.game_id)
+        })
+        self.outbound.put_control({
             'type': 'game_state',
-            'state': state_to_send
+            'state': game_logic.snapshot_frame(self.game_id)
         })
         
         # Notify other player about connection
@@ -95,7 +136,7 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
         # Check if both players are connected
         if connection_info and connection_info.get('both_connected', False):
             # Both players are connected, we can start the game
-            if (game_logic.active_games[self.game_id]['game_status'] == 'menu' and
+            if (game_logic.active_games[self.game_id]['frame']['game_status'] == 'menu' and
                 not game_logic.active_games[self.game_id].get('loop_running', False)):
                 
                 game_logic.active_games[self.game_id]['loop_running'] = True
@@ -105,11 +146,15 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             await self.update_game_status('in_progress')
         else:
             # Only one player is connected, start waiting for other player
-            # Create a task to wait for other player (60 seconds timeout)
-            self.wait_for_opponent_task = asyncio.create_task(self.wait_for_opponent(10))
+            await self.wait_for_opponent(10)
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
+        memory.close_connection(self)
+        self.cancel_opponent_timeout()
+        if getattr(self, 'outbound', None) is not None:
+            await self.outbound.stop()
+        
         if hasattr(self, 'game_id') and self.game_id in game_logic.active_games:
             # Mark player as disconnected
             connection_info = game_logic.set_player_connection(self.game_id, self.player_num, False)
@@ -124,11 +169,10 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             )
             
             # Set game as completed and save results immediately
-            if game_logic.active_games[self.game_id]['game_status'] != 'gameOver':
-                game_logic.active_games[self.game_id]['game_status'] = 'gameOver'
-                # Save the game results with the current state
-                await game_logic.save_game_results(self.game_id)
-                await game_logic.update_player_profiles(self.game_id)
+            if game_logic.active_games[self.game_id]['frame']['game_status'] != 'gameOver':
+                game_logic.active_games[self.game_id]['frame']['game_status'] = 'gameOver'
+                # Queue the game results with the current state
+                await enqueue_game_result(self.game_id)
             
             # Leave game group
             await self.channel_layer.group_discard(
@@ -138,87 +182,78 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             
             # Clean up game state if both players are disconnected
             if not connection_info['any_connected']:
-                if self.game_id in game_logic.active_games:
-                    del game_logic.active_games[self.game_id]
+                game_logic.remove_game(self.game_id)
 
     async def force_disconnect(self, event):
         """Force client to disconnect"""
         await self.update_game_status('cancelled')
-        await self.send_json({
+        self.outbound.put_control({
             'type': 'force_disconnect',
             'reason': event.get('reason', 'Other player disconnected')
         })
         await self.save_cancelled_game()
-        # Close the WebSocket connection
+        # Close the WebSocket connection once the message is out
+        await self.outbound.drain()
         await self.close(code=4000)
         
     async def player_status(self, event):
         """Send player connection status and handle forced disconnections"""
-        await self.send_json(event)
+        self.outbound.put_control(event)
         
         # If this is a forced disconnect notification, close the connection
         if event.get('force_disconnect', False):
+            await self.outbound.drain()
             await self.close(code=4002)  # Use a specific code for forced disconnection
             
     async def wait_for_opponent(self, wait_seconds):
-        """Wait for the other player to connect before timing out"""
-        try:
-            # Wait a bit for opponent to join
-            for i in range(wait_seconds):
-                # Check every second if both players are connected
-                if game_logic.are_both_players_connected(self.game_id):
-                    
-                    # If game was waiting, update to menu or playing state
-                    if game_logic.active_games[self.game_id]['game_status'] == 'waiting':
-                        game_logic.active_games[self.game_id]['game_status'] = 'menu'
-                        
-                        # Notify players of status change
-                        await self.channel_layer.group_send(
-                            self.game_group,
-                            {
-                                'type': 'game_status_changed',
-                                'status': 'menu'
-                            }
-                        )
-                    
-                    # Start game loop if not already running
-                    if not game_logic.active_games[self.game_id].get('loop_running', False):
-                        game_logic.active_games[self.game_id]['loop_running'] = True
-                        asyncio.create_task(self.game_loop())
-                        
-                    # Update database status
-                    await self.update_game_status('in_progress')
-                    return
-                    
-                # Send periodic updates to keep the client informed
-                if i % 5 == 0:  # Send status update every 5 seconds
-                    await self.send_json({
-                        'type': 'waiting_for_opponent',
-                        'seconds_elapsed': i,
-                        'seconds_remaining': wait_seconds - i,
-                        'message': "Waiting for opponent to connect..."
-                    })
-                    
-                await asyncio.sleep(1)
-                
-            # If we got here, timeout occurred
-            await self.send_json({
-                'type': 'timeout',
-                'message': 'Opponent did not connect in time'
-            })
-            
-            # Update game status in database
-            await self.update_game_status('cancelled')
-            
-            # Force disconnect
-            await self.close(code=4000)
-            
-        except asyncio.CancelledError:
-            # Task was cancelled (probably because opponent connected)
-            pass
+        """
+        Wait for the other player to connect before timing out.
+        The opponent's connect resolves the arrival future (and starts the
+        game loop), so nothing polls here; only the timeout is scheduled.
+        """
+        arrival = game_logic.wait_for_both_players(self.game_id)
+        if arrival.done():
+            return
+        
+        self.opponent_timeout = timeouts.call_later(wait_seconds, self.opponent_wait_timed_out)
+        arrival.add_done_callback(lambda _: self.cancel_opponent_timeout())
+        
+        self.outbound.put_control({
+            'type': 'waiting_for_opponent',
+            'seconds_elapsed': 0,
+            'seconds_remaining': wait_seconds,
+            'message': "Waiting for opponent to connect..."
+        })
+
+    def cancel_opponent_timeout(self):
+        """Drop the pending opponent timeout, if any"""
+        opponent_timeout = getattr(self, 'opponent_timeout', None)
+        if opponent_timeout is not None:
+            opponent_timeout.cancel()
+            self.opponent_timeout = None
+
+    async def opponent_wait_timed_out(self):
+        """Called by the timeout scheduler when the opponent never showed up"""
+        self.opponent_timeout = None
+        if game_logic.are_both_players_connected(self.game_id):
+            return
+        
+        self.outbound.put_control({
+            'type': 'timeout',
+            'message': 'Opponent did not connect in time'
+        })
+        
+        # Update game status in database
+        await self.update_game_status('cancelled')
+        
+        # Force disconnect
+        await self.outbound.drain()
+        await self.close(code=4000)
 
     async def receive_json(self, content):
         """Handle messages from client"""
+        # Clock sync times are milliseconds since the epoch
+        received_at = time.time() * 1000
         try:
             message_type = content.get('type', '')
             
@@ -226,12 +261,18 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                 # Update paddle position
                 position = content.get('position', None)
                 if position is not None:
-                    game_logic.update_paddle_position(self.game_id, self.player_num, position)
+                    game_logic.update_paddle_position(
+                        self.game_id,
+                        self.player_num,
+                        position,
+                        seq=content.get('seq'),
+                        timestamp=self.client_to_server_time(content.get('client_time'), received_at)
+                    )
             
             elif message_type == 'start_game':
                 # Start the game if it's currently in menu state
                 if self.game_id in game_logic.active_games:
-                    current_status = game_logic.active_games[self.game_id]['game_status']
+                    current_status = game_logic.active_games[self.game_id]['frame']['game_status']
                     if current_status == 'menu':
                         # Change status to playing
                         new_status = game_logic.set_game_status(self.game_id, 'playing')
@@ -247,7 +288,7 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             elif message_type == 'next_match':
                 # Start next match if current match is over
                 if self.game_id in game_logic.active_games:
-                    current_status = game_logic.active_games[self.game_id]['game_status']
+                    current_status = game_logic.active_games[self.game_id]['frame']['game_status']
                     if current_status == 'matchOver':
                         # Reset for new match
                         game_logic.reset_for_new_match(self.game_id)
@@ -257,7 +298,7 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                             self.game_group,
                             {
                                 'type': 'game_state',
-                                'state': game_logic.active_games[self.game_id]
+                                'state': game_logic.snapshot_frame(self.game_id)
                             }
                         )
                         
@@ -272,14 +313,45 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                                 'status': new_status
                             }
                         )
+            elif message_type == 'frame_ack':
+                # The client is keeping up with the frames sent so far
+                self.outbound.on_ack(content.get('frame_seq'))
+            
             elif message_type == 'ping':
+                # NTP-style exchange: echo the client's send time with our
+                # receive and send times; the next ping reports when the
+                # client got this pong
+                self.clock.on_ping(content)
+                client_time = content.get('client_time')
+                sent_at = time.time() * 1000
+                # Sent directly: waiting behind queued frames would skew the estimate
                 await self.send_json({
-                    'type': 'pong'
+                    'type': 'pong',
+                    'client_time': client_time,
+                    'server_receive_time': received_at,
+                    'server_send_time': sent_at,
+                    'clock': self.clock.as_dict()
                 })
+                self.clock.on_pong(client_time, received_at, sent_at)
+                
+                # Hits are evaluated up to one-way latency back
+                if self.clock.rtt is not None:
+                    game_logic.set_lag_compensation(self.game_id, self.player_num, self.clock.rtt / 2000)
         
         except Exception as e:
             pass
     
+    def client_to_server_time(self, client_time, received_at):
+        """
+        Maps a client timestamp (ms) to server time in seconds, never later
+        than when the message arrived nor further back than lag compensation
+        allows. Falls back to the arrival time without a clock estimate.
+        """
+        if not isinstance(client_time, (int, float)) or self.clock.offset is None:
+            return received_at / 1000
+        server_time = (client_time + self.clock.offset) / 1000
+        return min(max(server_time, received_at / 1000 - game_logic.MAX_LAG_COMPENSATION), received_at / 1000)
+
     async def game_loop(self):
         """Main game loop running on the server with optimized performance"""
         try:
@@ -287,7 +359,6 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             PHYSICS_RATE = 240  # Hz
             BROADCAST_RATE = 60  # Hz
             MAX_FRAME_TIME = 0.25  # seconds
-            INACTIVE_TIMEOUT = 300  # seconds (5 minutes)
             
             # Calculate intervals once
             physics_update_interval = 1 / PHYSICS_RATE
@@ -296,7 +367,6 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
             # Timing variables
             last_state_broadcast_time = time.time()
             physics_update_accumulator = 0
-            last_activity_time = time.time()
             
             while self.game_id in game_logic.active_games:
                 # Get current time for this frame
@@ -310,21 +380,8 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                 
                 game_state = game_logic.active_games[self.game_id]
                 
-                # Check for inactivity timeout
-                if (current_time - last_activity_time > INACTIVE_TIMEOUT and 
-                    not game_logic.is_any_player_connected(self.game_id)):
-                    
-                    # Clean up the game
-                    await game_logic.save_game_results(self.game_id)
-                    await game_logic.update_player_profiles(self.game_id)
-                    del game_logic.active_games[self.game_id]
-                    break
-                
                 # Only update if game is in playing state
-                if game_state['game_status'] == 'playing':
-                    # Reset inactivity timer when game is active
-                    last_activity_time = current_time
-                    
+                if game_state['frame']['game_status'] == 'playing':
                     # Accumulate time for physics updates
                     physics_update_accumulator += frame_time
                     
@@ -355,51 +412,48 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                         
                         # If match ended, notify players of new status immediately
                         if match_ended:
-                            # Update activity time on match end
-                            last_activity_time = current_time
-                            
                             await self.channel_layer.group_send(
                                 self.game_group,
                                 {
                                     'type': 'game_status_changed',
-                                    'status': game_logic.active_games[self.game_id]['game_status'],
-                                    'winner': game_logic.active_games[self.game_id]['winner']
+                                    'status': game_logic.active_games[self.game_id]['frame']['game_status'],
+                                    'winner': game_logic.active_games[self.game_id]['frame']['winner']
                                 })
                             
                             # Ensure we broadcast the final state
+                            final_state = game_logic.publish_frame(self.game_id)
                             await self.channel_layer.group_send(
                                 self.game_group,
                                 {
                                     'type': 'game_state',
-                                    'state': game_logic.active_games[self.game_id]
+                                    'state': final_state
                                 }
                             )
-                            if game_logic.active_games[self.game_id]['game_status'] == 'gameOver':
-                                await game_logic.save_game_results(self.game_id)
-                                await game_logic.update_player_profiles(self.game_id)
+                            if game_logic.active_games[self.game_id]['frame']['game_status'] == 'gameOver':
+                                # Persisted by the write-behind queue, the loop never waits on the DB
+                                await enqueue_game_result(self.game_id)
                                 
                                 # Force both players to disconnect since game is over
                                 await self.channel_layer.group_send(
                                     self.game_group,
                                     {
                                         'type': 'game_completed',
-                                        'winner': game_logic.active_games[self.game_id]['winner'],
-                                        'final_state': game_logic.active_games[self.game_id]
+                                        'winner': game_logic.active_games[self.game_id]['frame']['winner'],
+                                        'final_state': final_state
                                     }
                                 )
                     # Broadcast state at controlled intervals to avoid network congestion
                     time_since_last_broadcast = current_time - last_state_broadcast_time
                     if time_since_last_broadcast >= broadcast_interval:
-                        # Add prediction data for smooth client-side interpolation
-                        game_state = game_logic.active_games[self.game_id].copy()
-                        game_state['broadcast_time'] = current_time
-                        game_state['physics_interval'] = physics_update_interval
-                        
+                        # Only the dynamic frame is sent; prediction data for
+                        # client-side interpolation rides in the envelope
                         await self.channel_layer.group_send(
                             self.game_group,
                             {
                                 'type': 'game_state',
-                                'state': game_state
+                                'state': game_logic.publish_frame(self.game_id),
+                                'broadcast_time': current_time,
+                                'physics_interval': physics_update_interval
                             }
                         )
                         last_state_broadcast_time = current_time
@@ -415,16 +469,6 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
                 else:
                     # Yield control briefly if we're CPU-bound
                     await asyncio.sleep(0)
-                
-                # Check if game status changed while we were processing
-                if self.game_id in game_logic.active_games:
-                    new_state = game_logic.active_games[self.game_id]
-                    
-                    # Update activity timestamp for non-playing states
-                    if new_state['game_status'] != 'playing':
-                        # If game was just paused or a match ended, update the activity time
-                        # so we don't time out immediately
-                        last_activity_time = current_time
         
         except asyncio.CancelledError:
             raise
@@ -438,90 +482,95 @@ class GameConsumer(AsyncJsonWebsocketConsumer):
     # Message handlers
     
     async def game_state(self, event):
-        """Send game state to client"""
-        await self.send_json(event)
+        """Send game state to client, with this client's clock estimate"""
+        clock = self.clock.as_dict()
+        if clock is not None:
+            event['clock'] = clock
+        # Latest frame wins if the socket is behind
+        self.outbound.put_frame(event)
     
     async def paddle_position(self, event):
         """Send paddle position update"""
-        await self.send_json(event)
+        self.outbound.put_control(event)
     
     async def game_status_changed(self, event):
         """Send game status update"""
-        await self.send_json(event)
+        self.outbound.put_control(event)
     
     async def player_status(self, event):
         """Send player connection status"""
-        await self.send_json(event)
-        if event.get('player') != self.player_num and event.get('connected', False):
-            if hasattr(self, 'wait_for_opponent_task') and not self.wait_for_opponent_task.done():
-                self.wait_for_opponent_task.cancel()
+        self.outbound.put_control(event)
 
     async def game_completed(self, event):
         """Handle game completion and prepare for socket closure"""
-        await self.send_json({
+        self.outbound.put_control({
             'type': 'game_completed',
             'winner': event['winner'],
             'final_state': event['final_state']
         })
         await asyncio.sleep(2)
         # Close the connection
+        await self.outbound.drain()
         await self.close(code=1000)  # Normal closure
 
+    async def close_stalled(self):
+        """Close a socket that stopped keeping up with its messages"""
+        await self.close(code=4008)
+
         
-    @database_sync_to_async
+    @database_sync_to_async(pool='game')
     def get_game(self, game_id):
         """Get game from database"""
         try:
-            game = Game.objects.get(id=game_id)
+            game = Game.objects.select_related('player1', 'player2').get(id=game_id)
             return {
                 'id': game.id,
                 'player1_id': game.player1_id,
                 'player2_id': game.player2_id,
+                'player1_username': game.player1.username,
+                'player2_username': game.player2.username if game.player2 else '',
                 'status': game.status,
                 'difficulty': game.difficulty
             }
         except Game.DoesNotExist:
             return None
     
-    @database_sync_to_async
     def initialize_game_state(self):
         """Create initial game state in memory"""
-        if self.game_id in game_logic.active_games:
-            return
-        
-        # Get game from database and create state
-        game_logic.active_games[self.game_id] = game_logic.create_game_state(
-            self.game_id, 
-            self.game
-        )
-    @database_sync_to_async
+        # Runs on the event loop: a game already in memory (pre-warmed, or
+        # created by the opponent while get_game was awaited) is kept
+        game_logic.ensure_game_state(self.game_id, self.game)
+    
+    @database_sync_to_async(pool='game')
     def save_cancelled_game(self):
         """Save game as cancelled in the database"""
-        try:
-            game = Game.objects.get(id=self.game_id)
-            # new status for cancelled games in your StatusChoices class
-            game.status = 'cancelled'
-            game.save()
-            return True
-        except Game.DoesNotExist:
-            return False
+        # One conditional UPDATE: results of a finished game may have been
+        # written by the results writer in the meantime
+        updated = Game.objects.filter(id=self.game_id).exclude(
+            status=StatusChoices.COMPLETED
+        ).update(
+            status=StatusChoices.CANCELLED,
+            updated_at=timezone.now()
+        )
+        return updated > 0
 
-    @database_sync_to_async
+    @database_sync_to_async(pool='game')
     def update_game_status(self, status):
         """Update the game status in the database"""
-        try:
-            game = Game.objects.get(id=self.game_id)
-            game.status = status
+        now = timezone.now()
+        fields = {'status': status, 'updated_at': now}
+        
+        # If game is starting, set started_at timestamp
+        if status == 'in_progress':
+            fields['started_at'] = Coalesce(F('started_at'), Value(now))
             
-            # If game is starting, set started_at timestamp
-            if status == 'in_progress' and not game.started_at:
-                game.started_at = timezone.now()
-                
-            # If game is completing or cancelling, set completed_at timestamp
-            if status in ['completed', 'cancelled'] and not game.completed_at:
-                game.completed_at = timezone.now()
-                
-            game.save()
-            return True
-        except Game.DoesNotExist:
-            return False
\ No newline at end of file
+        # If game is completing or cancelling, set completed_at timestamp
+        if status in ['completed', 'cancelled']:
+            fields['completed_at'] = Coalesce(F('completed_at'), Value(now))
+        
+        # Never downgrade a game the results writer already completed; the
+        # check and the write are one statement so the writer cannot slip in
+        updated = Game.objects.filter(id=self.game_id).exclude(
+            status=StatusChoices.COMPLETED
+        ).update(**fields)
+        return updated > 0
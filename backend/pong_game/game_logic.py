@@ -1,9 +1,18 @@
+import asyncio
+import copy
+import heapq
+import threading
 import time
 import random
-import math
+import weakref
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
 from django.utils import timezone
-from .models import Game, Match, PlayerProfile, StatusChoices
-from channels.db import database_sync_to_async
+from backend import memory
+from .models import Game, Match, PlayerProfile, PointEvent, StatusChoices
 
 # Game constants
 POINTS_TO_WIN_MATCH = 5
@@ -14,6 +23,27 @@ PADDLE_WIDTH = 18
 PADDLE_HEIGHT = 100
 BALL_RADIUS = 10
 
+# Lag compensation: paddle positions remembered per paddle, and the
+# furthest back (seconds) a hit is evaluated against
+PADDLE_HISTORY_SIZE = 32
+MAX_LAG_COMPENSATION = 0.1
+
+# Seconds a pre-warmed game is kept in memory if no player connects
+PREWARM_TTL = 120
+
+# Seconds a game nobody is connected to is kept in memory after its last activity
+IDLE_TIMEOUT = 300
+
+# Progression
+WIN_EXPERIENCE = 500
+EXPERIENCE_PER_LEVEL = 1000
+
+# Games won overall that unlock the triple win achievement
+TRIPLE_WIN_GAMES = 3
+
+# Elo rating: most points a single game moves a rating
+RATING_K_FACTOR = 32
+
 # Difficulty settings
 DIFFICULTY_SETTINGS = {
     "easy": {"ball_speed": 3, "increment_multiplier": 0.02, "max_ball_speed": 6},
@@ -24,6 +54,185 @@ DIFFICULTY_SETTINGS = {
 # In-memory storage for active games
 active_games = {}
 
+# Per-game record of match boundaries and points, persisted at finalization.
+# Kept apart from active_games so it is never broadcast to clients.
+game_timelines = {}
+
+# Recent paddle positions per game, (time, y) pairs for lag-compensated hits.
+# Kept apart from active_games so it is never broadcast to clients.
+paddle_histories = {}
+
+# Games built ahead of the first connection, game_id -> time pre-warmed
+prewarmed_games = {}
+
+# Last activity per game, and a heap of (deadline, game_id) scanned by the
+# idle reaper. Heap entries can be stale: touching a game only updates
+# game_activity, and the deadline is re-checked when the entry is popped.
+# Games are also tracked from request threads, hence the lock.
+game_activity = {}
+idle_index = []
+idle_index_lock = threading.Lock()
+
+# Futures resolved by set_player_connection once both players are connected
+opponent_arrivals = {}
+
+for table_name, table in (
+        ('game.active_games', active_games),
+        ('game.timelines', game_timelines),
+        ('game.paddle_histories', paddle_histories),
+        ('game.prewarmed_games', prewarmed_games),
+        ('game.activity', game_activity),
+        ('game.idle_index', idle_index),
+        ('game.opponent_arrivals', opponent_arrivals)):
+    memory.register_table(table_name, table)
+
+def wait_for_both_players(game_id):
+    """
+    Returns a future that resolves when both players of a game are connected.
+    Must be called from the event loop.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        An asyncio.Future (already done if both players are connected)
+    """
+    future = opponent_arrivals.get(game_id)
+    if future is None or future.done():
+        future = asyncio.get_running_loop().create_future()
+        if are_both_players_connected(game_id):
+            future.set_result(True)
+        else:
+            opponent_arrivals[game_id] = future
+    return future
+
+def track_game(game_id):
+    """Adds a newly created game to the idle index"""
+    touch_game(game_id)
+    with idle_index_lock:
+        heapq.heappush(idle_index, (game_idle_deadline(game_id), game_id))
+
+def touch_game(game_id):
+    """Records activity on a game, pushing back its idle deadline"""
+    game_activity[game_id] = time.time()
+
+def game_idle_deadline(game_id):
+    """Time after which an unattended game may be reaped"""
+    timeout = PREWARM_TTL if game_id in prewarmed_games else IDLE_TIMEOUT
+    return game_activity.get(game_id, 0) + timeout
+
+def pop_expired_games(now, limit):
+    """
+    Pops games whose idle deadline has passed from the idle index.
+    Entries whose game saw activity since, or still has a player connected,
+    are pushed back with their new deadline.
+    
+    Args:
+        now: Current time
+        limit: Maximum number of games to return
+    
+    Returns:
+        List of expired game IDs
+    """
+    expired = []
+    with idle_index_lock:
+        while idle_index and idle_index[0][0] <= now and len(expired) < limit:
+            _, game_id = heapq.heappop(idle_index)
+            if game_id not in active_games:
+                continue
+            
+            if is_any_player_connected(game_id):
+                heapq.heappush(idle_index, (now + IDLE_TIMEOUT, game_id))
+                continue
+            
+            deadline = game_idle_deadline(game_id)
+            if deadline > now:
+                heapq.heappush(idle_index, (deadline, game_id))
+                continue
+            
+            expired.append(game_id)
+    return expired
+
+def get_timeline(game_id):
+    """
+    Returns the timeline of a game, creating it on first use.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        Dictionary with the recorded 'matches' and 'points'
+    """
+    timeline = game_timelines.get(game_id)
+    if timeline is None:
+        timeline = {
+            'matches': [],
+            'points': [],
+            'rally_hits': 0
+        }
+        game_timelines[game_id] = timeline
+    return timeline
+
+def get_match_record(game_id, match_number):
+    """Returns the timeline record of a match, adding records up to it if needed"""
+    matches = get_timeline(game_id)['matches']
+    while len(matches) < match_number:
+        matches.append({
+            'match_number': len(matches) + 1,
+            'started_at': None,
+            'completed_at': None,
+            'winner': None,
+            'score_player1': 0,
+            'score_player2': 0
+        })
+    return matches[match_number - 1]
+
+def record_match_start(game_id):
+    """Records when the current match actually started (first time it is played)"""
+    match = get_match_record(game_id, active_games[game_id]['frame']['current_match'])
+    if match['started_at'] is None:
+        match['started_at'] = time.time()
+
+def record_point(game_id, scorer):
+    """
+    Records a scored point with the match score right after it.
+    
+    Args:
+        game_id: The ID of the game
+        scorer: 'player1' or 'player2'
+    """
+    frame = active_games[game_id]['frame']
+    timeline = get_timeline(game_id)
+    timeline['points'].append([
+        frame['current_match'],
+        scorer,
+        frame['left_paddle']['score'],
+        frame['right_paddle']['score'],
+        timeline['rally_hits'],
+        time.time()
+    ])
+    timeline['rally_hits'] = 0
+
+def record_match_end(game_id):
+    """Records the end, winner and final score of the current match"""
+    frame = active_games[game_id]['frame']
+    match = get_match_record(game_id, frame['current_match'])
+    match['completed_at'] = time.time()
+    match['winner'] = frame['winner']
+    match['score_player1'] = frame['left_paddle']['score']
+    match['score_player2'] = frame['right_paddle']['score']
+
+def remove_game(game_id):
+    """Drops a game and its timeline from memory"""
+    active_games.pop(game_id, None)
+    game_timelines.pop(game_id, None)
+    paddle_histories.pop(game_id, None)
+    prewarmed_games.pop(game_id, None)
+    game_activity.pop(game_id, None)
+    arrival = opponent_arrivals.pop(game_id, None)
+    if arrival is not None and not arrival.done():
+        arrival.cancel()
+
 def create_game_state(game_id, game_data):
     """
     Creates a new game state in memory.
@@ -47,8 +256,9 @@ def create_game_state(game_id, game_data):
         player1_username = User.objects.get(id=game_data['player1_id']).username
         player2_username = User.objects.get(id=game_data['player2_id']).username
     
-    return {
-        'game_id': game_id,
+    # Everything that changes during play. Physics writes the back buffer
+    # ('frame'), clients are sent the front buffer ('published')
+    frame = {
         'ball': {
             'x': BASE_WIDTH / 2,
             'y': BASE_HEIGHT / 2,
@@ -80,6 +290,17 @@ def create_game_state(game_id, game_data):
         'current_match': 1,
         'game_status': 'waiting',
         'winner': None,
+        # Last applied paddle_move sequence number per player
+        'acks': {
+            'player1': 0,
+            'player2': 0
+        }
+    }
+    
+    return {
+        'game_id': game_id,
+        'frame': frame,
+        'published': copy.deepcopy(frame),
         'players': {
             'player1': {
                 'id': game_data['player1_id'],
@@ -94,10 +315,142 @@ def create_game_state(game_id, game_data):
         },
         'difficulty': game_data['difficulty'],
         'settings': settings,
+        # Seconds back a hit may be evaluated per player, from their latency
+        'lag_compensation': {
+            'player1': 0.0,
+            'player2': 0.0
+        },
         'last_update_time': time.time(),
         'loop_running': False
     }
 
+def sync_frame(target, source):
+    """Copies a frame into another one in place, reusing its nested dicts"""
+    for key, value in source.items():
+        if isinstance(value, dict):
+            target[key].update(value)
+        else:
+            target[key] = value
+
+def publish_frame(game_id):
+    """
+    Publishes the frame physics has been writing to by swapping the back
+    and front buffers, then brings the new back buffer up to date in place.
+    No dicts are allocated, and the published frame stays untouched until
+    the next publish. Only the game loop publishes; the channel layer
+    copies (or serializes) each message, so nothing holds on to it.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        The published frame (read-only for callers)
+    """
+    game_state = active_games[game_id]
+    published = game_state['frame']
+    game_state['frame'] = game_state['published']
+    game_state['published'] = published
+    sync_frame(game_state['frame'], published)
+    return published
+
+def snapshot_frame(game_id):
+    """
+    Returns a copy of the current frame for messages sent outside the game
+    loop (connect, next match), leaving the published frame alone.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        A copy of the frame physics is writing to
+    """
+    return copy.deepcopy(active_games[game_id]['frame'])
+
+def get_game_setup(game_id):
+    """
+    Returns the static part of a game, sent to clients once on connect
+    instead of with every frame.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        Dictionary with players, difficulty, settings and field dimensions
+    """
+    game_state = active_games[game_id]
+    return {
+        'game_id': game_state['game_id'],
+        'players': game_state['players'],
+        'difficulty': game_state['difficulty'],
+        'settings': game_state['settings'],
+        'width': BASE_WIDTH,
+        'height': BASE_HEIGHT,
+        'points_to_win_match': POINTS_TO_WIN_MATCH,
+        'matches_to_win_game': MATCHES_TO_WIN_GAME
+    }
+
+def ensure_game_state(game_id, game_data):
+    """
+    Returns the in-memory state of a game, creating it if it is missing.
+    
+    The game tables are not locked, so this must run on the event loop and
+    never in an executor thread. game_data has to carry the usernames, as
+    create_game_state would otherwise query them.
+    
+    Args:
+        game_id: The ID of the game
+        game_data: Game information (difficulty, player ids and usernames)
+    
+    Returns:
+        The game state dictionary
+    """
+    game_id = str(game_id)
+    
+    game_state = active_games.get(game_id)
+    if game_state is None:
+        game_state = active_games[game_id] = create_game_state(game_id, game_data)
+        track_game(game_id)
+    return game_state
+
+def prewarm_game(game_id, game_data):
+    """
+    Builds the in-memory state of a freshly created game so that the
+    connecting players attach to it without touching the database.
+    Runs on the event loop, like ensure_game_state.
+    
+    Args:
+        game_id: The ID of the game
+        game_data: Game information (difficulty, player ids and usernames)
+    
+    Returns:
+        The game state dictionary
+    """
+    game_id = str(game_id)
+    
+    # Dropped by the idle reaper after PREWARM_TTL if nobody connects
+    if game_id not in active_games:
+        prewarmed_games[game_id] = time.time()
+    return ensure_game_state(game_id, game_data)
+
+def get_game_players(game_id):
+    """
+    Returns the player ids of an in-memory game.
+    
+    Args:
+        game_id: The ID of the game
+    
+    Returns:
+        Dictionary with player1_id and player2_id, or None if not in memory
+    """
+    if game_id not in active_games:
+        return None
+    
+    players = active_games[game_id]['players']
+    return {
+        'player1_id': players['player1']['id'],
+        'player2_id': players['player2']['id']
+    }
+
 def update_paddle_position(game_id, player_num, position):
     """
     Updates a paddle position.
@@ -118,11 +471,89 @@ def update_paddle_position(game_id, player_num, position):
     
     # Update the appropriate paddle
     paddle_key = 'left_paddle' if player_num == 1 else 'right_paddle'
-    active_games[game_id][paddle_key]['y'] = position
+    active_games[game_id]['frame'][paddle_key]['y'] = position
     # print(f"Updating paddle position: game_id={game_id}, player_num={player_num}, position={position}, type={type(position)}")
     
     return True
 
+def record_paddle_position(game_id, paddle_key, position, timestamp):
+    """
+    Remembers where a paddle was moved and when.
+    
+    Args:
+        game_id: The ID of the game
+        paddle_key: 'left_paddle' or 'right_paddle'
+        position: New Y position of the paddle
+        timestamp: Server time (seconds) the paddle got there
+    """
+    histories = paddle_histories.get(game_id)
+    if histories is None:
+        histories = {
+            'left_paddle': deque(maxlen=PADDLE_HISTORY_SIZE),
+            'right_paddle': deque(maxlen=PADDLE_HISTORY_SIZE)
+        }
+        paddle_histories[game_id] = histories
+    
+    history = histories[paddle_key]
+    # Keep the history in time order even if client timestamps jitter
+    if history and timestamp < history[-1][0]:
+        timestamp = history[-1][0]
+    history.append((timestamp, position))
+
+def set_lag_compensation(game_id, player_num, seconds):
+    """
+    Sets how far back a player's paddle hits may be evaluated,
+    capped at MAX_LAG_COMPENSATION.
+    
+    Args:
+        game_id: The ID of the game
+        player_num: Which player (1 or 2)
+        seconds: The player's one-way latency
+    """
+    if game_id not in active_games:
+        return
+    
+    active_games[game_id]['lag_compensation'][f'player{player_num}'] = min(
+        max(seconds, 0.0),
+        MAX_LAG_COMPENSATION
+    )
+
+def find_hit_paddle_top(game_id, paddle_key, ball_top, ball_bottom, window):
+    """
+    Finds the paddle position a hit should be evaluated against: the
+    current one if the ball overlaps it, otherwise the most recent position
+    the paddle held within the last `window` seconds that the ball overlaps.
+    
+    Args:
+        game_id: The ID of the game
+        paddle_key: 'left_paddle' or 'right_paddle'
+        ball_top: Top edge of the ball
+        ball_bottom: Bottom edge of the ball
+        window: Lag compensation in seconds
+    
+    Returns:
+        The paddle top (Y) to use, or None if the ball misses
+    """
+    game_state = active_games[game_id]
+    paddle = game_state['frame'][paddle_key]
+    height = paddle['height']
+    
+    if ball_top <= paddle['y'] + height and ball_bottom >= paddle['y']:
+        return paddle['y']
+    
+    histories = paddle_histories.get(game_id)
+    if window <= 0 or histories is None:
+        return None
+    
+    cutoff = game_state['last_update_time'] - window
+    for timestamp, position in reversed(histories[paddle_key]):
+        if ball_top <= position + height and ball_bottom >= position:
+            return position
+        # This position was held at the cutoff, anything older is out of the window
+        if timestamp <= cutoff:
+            break
+    return None
+
 def update_game_physics(game_id, delta_time):
     """
     Updates the game physics based on elapsed time.
@@ -138,9 +569,10 @@ def update_game_physics(game_id, delta_time):
         return False
     
     game_state = active_games[game_id]
-    ball = game_state['ball']
-    left_paddle = game_state['left_paddle']
-    right_paddle = game_state['right_paddle']
+    frame = game_state['frame']
+    ball = frame['ball']
+    left_paddle = frame['left_paddle']
+    right_paddle = frame['right_paddle']
     settings = game_state['settings']
     
     # We now use fixed timestep, no need to adjust for frame rate
@@ -178,19 +610,29 @@ def update_game_physics(game_id, delta_time):
     ball_bottom_edge = ball['y'] + ball['radius']
     
     left_paddle_right = left_paddle['x'] + left_paddle['width']
-    left_paddle_top = left_paddle['y']
-    left_paddle_bottom = left_paddle['y'] + left_paddle['height']
-    
     right_paddle_left = right_paddle['x']
-    right_paddle_top = right_paddle['y']
-    right_paddle_bottom = right_paddle['y'] + right_paddle['height']
     
-    # Left paddle collision
+    # Paddle tops to evaluate hits against (None on a miss). A position the
+    # player saw within their lag compensation window also counts.
+    lag_compensation = game_state['lag_compensation']
+    left_paddle_top = None
     if (ball_left_edge <= left_paddle_right and
         ball_left_edge > left_paddle['x'] and
-        ball_top_edge <= left_paddle_bottom and
-        ball_bottom_edge >= left_paddle_top and
         ball['dx'] < 0):
+        left_paddle_top = find_hit_paddle_top(
+            game_id, 'left_paddle', ball_top_edge, ball_bottom_edge, lag_compensation['player1']
+        )
+    
+    right_paddle_top = None
+    if (ball_right_edge >= right_paddle_left and
+        ball_right_edge < right_paddle_left + right_paddle['width'] and
+        ball['dx'] > 0):
+        right_paddle_top = find_hit_paddle_top(
+            game_id, 'right_paddle', ball_top_edge, ball_bottom_edge, lag_compensation['player2']
+        )
+    
+    # Left paddle collision
+    if left_paddle_top is not None:
         
         # Reverse X direction
         ball['dx'] = -ball['dx']
@@ -213,12 +655,9 @@ def update_game_physics(game_id, delta_time):
         # Add a subtle random factor to avoid predictable patterns
         ball['dy'] += (random.random() - 0.5) * 0.2
         collision_happened = True
+        get_timeline(game_id)['rally_hits'] += 1
     # Right paddle collision
-    if (ball_right_edge >= right_paddle_left and
-        ball_right_edge < right_paddle_left + right_paddle['width'] and
-        ball_top_edge <= right_paddle_bottom and
-        ball_bottom_edge >= right_paddle_top and
-        ball['dx'] > 0):
+    if right_paddle_top is not None and ball['dx'] > 0:
         
         # Reverse X direction
         ball['dx'] = -ball['dx']
@@ -241,6 +680,7 @@ def update_game_physics(game_id, delta_time):
         # Add a subtle random factor to avoid predictable patterns
         ball['dy'] += (random.random() - 0.5) * 0.2
         collision_happened = False
+        get_timeline(game_id)['rally_hits'] += 1
     
     # Check for scoring
     score_happened = False
@@ -249,12 +689,14 @@ def update_game_physics(game_id, delta_time):
     if ball['x'] + ball['radius'] < 0:
         # Right player scores
         right_paddle['score'] += 1
+        record_point(game_id, 'player2')
         reset_ball(game_id, 1)
         score_happened = True
     
     elif ball['x'] - ball['radius'] > BASE_WIDTH:
         # Left player scores
         left_paddle['score'] += 1
+        record_point(game_id, 'player1')
         reset_ball(game_id, -1)
         score_happened = True
     
@@ -276,15 +718,16 @@ def reset_ball(game_id, direction):
         return
     
     game_state = active_games[game_id]
+    frame = game_state['frame']
     settings = game_state['settings']
     
-    game_state['ball']['x'] = BASE_WIDTH / 2
-    game_state['ball']['y'] = BASE_HEIGHT / 2
-    game_state['ball']['speed'] = settings['ball_speed']
-    game_state['ball']['dx'] = direction * settings['ball_speed']
+    frame['ball']['x'] = BASE_WIDTH / 2
+    frame['ball']['y'] = BASE_HEIGHT / 2
+    frame['ball']['speed'] = settings['ball_speed']
+    frame['ball']['dx'] = direction * settings['ball_speed']
     
     # Add some randomness to y direction
-    game_state['ball']['dy'] = ((random.random() * 2 - 1) * settings['ball_speed']) / 2
+    frame['ball']['dy'] = ((random.random() * 2 - 1) * settings['ball_speed']) / 2
 
 def check_match_end(game_id):
     """
@@ -300,35 +743,39 @@ def check_match_end(game_id):
         return False
     
     game_state = active_games[game_id]
-    left_score = game_state['left_paddle']['score']
-    right_score = game_state['right_paddle']['score']
+    frame = game_state['frame']
+    left_score = frame['left_paddle']['score']
+    right_score = frame['right_paddle']['score']
     
     match_ended = False
     
     # First to POINTS_TO_WIN_MATCH points wins match
     if left_score >= POINTS_TO_WIN_MATCH:
         # Player 1 wins match
-        game_state['match_wins']['player1'] += 1
-        game_state['winner'] = 'player1'
+        frame['match_wins']['player1'] += 1
+        frame['winner'] = 'player1'
         match_ended = True
         
         # Check if game is over
-        if game_state['match_wins']['player1'] >= MATCHES_TO_WIN_GAME:
-            game_state['game_status'] = 'gameOver'
+        if frame['match_wins']['player1'] >= MATCHES_TO_WIN_GAME:
+            frame['game_status'] = 'gameOver'
         else:
-            game_state['game_status'] = 'matchOver'
+            frame['game_status'] = 'matchOver'
     
     elif right_score >= POINTS_TO_WIN_MATCH:
         # Player 2 wins match
-        game_state['match_wins']['player2'] += 1
-        game_state['winner'] = 'player2'
+        frame['match_wins']['player2'] += 1
+        frame['winner'] = 'player2'
         match_ended = True
         
         # Check if game is over
-        if game_state['match_wins']['player2'] >= MATCHES_TO_WIN_GAME:
-            game_state['game_status'] = 'gameOver'
+        if frame['match_wins']['player2'] >= MATCHES_TO_WIN_GAME:
+            frame['game_status'] = 'gameOver'
         else:
-            game_state['game_status'] = 'matchOver'
+            frame['game_status'] = 'matchOver'
+    
+    if match_ended:
+        record_match_end(game_id)
     
     return match_ended
 
@@ -343,27 +790,29 @@ def reset_for_new_match(game_id):
         return
     
     game_state = active_games[game_id]
+    frame = game_state['frame']
     settings = game_state['settings']
     
     # Reset ball
-    game_state['ball']['x'] = BASE_WIDTH / 2
-    game_state['ball']['y'] = BASE_HEIGHT / 2
-    game_state['ball']['dx'] = settings['ball_speed']
-    game_state['ball']['dy'] = settings['ball_speed'] * BASE_HEIGHT / BASE_WIDTH
-    game_state['ball']['speed'] = settings['ball_speed']
+    frame['ball']['x'] = BASE_WIDTH / 2
+    frame['ball']['y'] = BASE_HEIGHT / 2
+    frame['ball']['dx'] = settings['ball_speed']
+    frame['ball']['dy'] = settings['ball_speed'] * BASE_HEIGHT / BASE_WIDTH
+    frame['ball']['speed'] = settings['ball_speed']
     
     # Reset paddles
-    game_state['left_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
-    game_state['left_paddle']['score'] = 0
-    game_state['right_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
-    game_state['right_paddle']['score'] = 0
+    frame['left_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
+    frame['left_paddle']['score'] = 0
+    frame['right_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
+    frame['right_paddle']['score'] = 0
+    paddle_histories.pop(game_id, None)
     
     # Update match counter
-    game_state['current_match'] += 1
+    frame['current_match'] += 1
     
     # Reset status
-    game_state['game_status'] = 'menu'
-    game_state['winner'] = None
+    frame['game_status'] = 'menu'
+    frame['winner'] = None
 
 def reset_game(game_id):
     """
@@ -376,26 +825,31 @@ def reset_game(game_id):
         return
     
     game_state = active_games[game_id]
+    frame = game_state['frame']
     settings = game_state['settings']
     
     # Reset everything
-    game_state['ball']['x'] = BASE_WIDTH / 2
-    game_state['ball']['y'] = BASE_HEIGHT / 2
-    game_state['ball']['dx'] = settings['ball_speed']
-    game_state['ball']['dy'] = settings['ball_speed'] * BASE_HEIGHT / BASE_WIDTH
-    game_state['ball']['speed'] = settings['ball_speed']
-    
-    game_state['left_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
-    game_state['left_paddle']['score'] = 0
-    game_state['right_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
-    game_state['right_paddle']['score'] = 0
-    
-    game_state['match_wins']['player1'] = 0
-    game_state['match_wins']['player2'] = 0
-    
-    game_state['current_match'] = 1
-    game_state['game_status'] = 'menu'
-    game_state['winner'] = None
+    frame['ball']['x'] = BASE_WIDTH / 2
+    frame['ball']['y'] = BASE_HEIGHT / 2
+    frame['ball']['dx'] = settings['ball_speed']
+    frame['ball']['dy'] = settings['ball_speed'] * BASE_HEIGHT / BASE_WIDTH
+    frame['ball']['speed'] = settings['ball_speed']
+    
+    frame['left_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
+    frame['left_paddle']['score'] = 0
+    frame['right_paddle']['y'] = BASE_HEIGHT / 2 - PADDLE_HEIGHT / 2
+    frame['right_paddle']['score'] = 0
+    paddle_histories.pop(game_id, None)
+    
+    frame['match_wins']['player1'] = 0
+    frame['match_wins']['player2'] = 0
+    
+    frame['current_match'] = 1
+    frame['game_status'] = 'menu'
+    frame['winner'] = None
+    
+    # Start a fresh timeline
+    game_timelines.pop(game_id, None)
 
 def set_player_connection(game_id, player_num, connected):
     """
@@ -414,30 +868,41 @@ def set_player_connection(game_id, player_num, connected):
     
     player_key = f'player{player_num}'
     active_games[game_id]['players'][player_key]['connected'] = connected
+    if connected:
+        # A (re)connected client numbers its moves from scratch
+        active_games[game_id]['frame']['acks'][player_key] = 0
+    prewarmed_games.pop(game_id, None)
+    touch_game(game_id)
     
     # Check if game status needs updating
     status_changed = False
-    old_status = active_games[game_id]['game_status']
+    old_status = active_games[game_id]['frame']['game_status']
     
     # If both players are connected and game is waiting, change to menu
     if (active_games[game_id]['players']['player1']['connected'] and
         active_games[game_id]['players']['player2']['connected'] and
-        active_games[game_id]['game_status'] == 'waiting'):
+        active_games[game_id]['frame']['game_status'] == 'waiting'):
         
-        active_games[game_id]['game_status'] = 'menu'
+        active_games[game_id]['frame']['game_status'] = 'menu'
         status_changed = True
     
     # If a player disconnects while game is playing, pause the game
     elif (not connected and
-          active_games[game_id]['game_status'] == 'playing'):
+          active_games[game_id]['frame']['game_status'] == 'playing'):
         
-        active_games[game_id]['game_status'] = 'cancelled'
+        active_games[game_id]['frame']['game_status'] = 'cancelled'
         status_changed = True
     
+    # Wake up whoever is waiting for the opponent
+    if connected and are_both_players_connected(game_id):
+        arrival = opponent_arrivals.pop(game_id, None)
+        if arrival is not None and not arrival.done():
+            arrival.set_result(True)
+    
     return {
         'status_changed': status_changed,
         'old_status': old_status,
-        'new_status': active_games[game_id]['game_status'],
+        'new_status': active_games[game_id]['frame']['game_status'],
         'both_connected': (active_games[game_id]['players']['player1']['connected'] and
                           active_games[game_id]['players']['player2']['connected']),
         'any_connected': (active_games[game_id]['players']['player1']['connected'] or
@@ -461,12 +926,15 @@ def set_game_status(game_id, new_status):
     if new_status not in ['waiting', 'menu', 'playing', 'paused', 'matchOver', 'gameOver', 'cancelled']:
         return False
     
+    touch_game(game_id)
+    
     # If changing to playing, update the timestamp
     if new_status == 'playing':
         active_games[game_id]['last_update_time'] = time.time()
+        record_match_start(game_id)
     
     # Update the status
-    active_games[game_id]['game_status'] = new_status
+    active_games[game_id]['frame']['game_status'] = new_status
     
     return True
 
@@ -502,165 +970,227 @@ def are_both_players_connected(game_id):
     return (active_games[game_id]['players']['player1']['connected'] and
             active_games[game_id]['players']['player2']['connected'])
 
-@database_sync_to_async
-def save_game_results(game_id):
+def timeline_datetime(timestamp):
+    """Converts a timeline timestamp (time.time()) to an aware datetime"""
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+def build_match_rows(game_id, game_state, timeline):
     """
-    Saves the final game results to the database.
+    Builds the Match rows for every match that was played, from the
+    boundaries and scores recorded during the game.
     
     Args:
         game_id: The ID of the game
+        game_state: Snapshot of the in-memory game state at game end
+        timeline: Snapshot of the game's timeline
     
     Returns:
-        Boolean indicating success
+        List of unsaved Match instances
     """
-    try:
-        if game_id not in active_games :
-            return False
-            
-        game = Game.objects.get(id=game_id)
-        game_state = active_games[game_id]
-        if game.status == 'cancelled':
-            return False
-        # Update game status
-        if game.status != 'cancelled':
-            game.status = 'completed'
-        
-            # Set winner if game ended
-            if game_state['game_status'] == 'gameOver':
-                if game_state['match_wins']['player1'] > game_state['match_wins']['player2'] :
-                    game.winner = game.player1
-                else:
-                    game.winner = game.player2
-            
-            # Update match scores
-            game.final_score_player1 = game_state['match_wins']['player1']
-            game.final_score_player2 = game_state['match_wins']['player2']
-            
-            # Set completion time
-            game.completed_at = timezone.now()
-            
-            # Save game
-            game.save()
-            
-            # Save match data for all matches that were played
-            current_match = game_state['current_match']
-            
-            # Create match records for each match that was played
-            for i in range(1, current_match + 1):
-                # Check if this match already exists
-                match_exists = Match.objects.filter(game=game, match_number=i).exists()
-                
-                if not match_exists:
-                    # For the current match (potentially incomplete)
-                    if i == current_match:
-                        print(f"Creating match {i}")
-                        match = Match.objects.create(
-                            game=game,
-                            match_number=i,
-                            status=StatusChoices.MATCH_COMPLETED if game_state['game_status'] == 'gameOver' else StatusChoices.MATCH_IN_PROGRESS,
-                            score_player1=game_state['left_paddle']['score'],
-                            score_player2=game_state['right_paddle']['score'],
-                            winner=game_state['winner'],
-                            started_at=timezone.now() - timezone.timedelta(minutes=5),
-                            completed_at=timezone.now() if game_state['game_status'] == 'gameOver' else None
-                        )
-                        match.save()
-                    # For completed previous matches
-                    else:
-                        # Determine who won this match based on match_wins
-                        player1_wins = game_state['match_wins']['player1']
-                        player2_wins = game_state['match_wins']['player2']
-                        
-                        # Need to figure out if player1 or player2 won this specific match
-                        # For simplicity, we'll say player1 won matches 1 to player1_wins,
-                        # and player2 won matches player1_wins+1 to player1_wins+player2_wins
-                        if i <= player1_wins:
-                            winner = 'player1'
-                            score_player1 = POINTS_TO_WIN_MATCH  # Points to win a match
-                            score_player2 = random.randint(0, POINTS_TO_WIN_MATCH - 1)  # Random lower score
-                        else:
-                            winner = 'player2'
-                            score_player2 = POINTS_TO_WIN_MATCH  # Points to win a match
-                            score_player1 = random.randint(0, POINTS_TO_WIN_MATCH - 1)  # Random lower score
-                        
-                        match = Match.objects.create(
-                            game=game,
-                            match_number=i,
-                            status=StatusChoices.MATCH_COMPLETED,
-                            score_player1=score_player1,
-                            score_player2=score_player2,
-                            winner=winner,
-                            started_at=timezone.now() - timezone.timedelta(minutes=i*5),
-                            completed_at=timezone.now() - timezone.timedelta(minutes=(i-1)*5)
-                        )
-                        print(f"else Creating match {i}")
-                        match.save()
-            
-            # Update player profiles
-            update_player_profiles(game_id)
+    frame = game_state['frame']
+    matches = []
+    recorded = timeline['matches']
+    current_match = frame['current_match']
+    
+    for number in range(1, current_match + 1):
+        record = recorded[number - 1] if number <= len(recorded) else None
         
-        return True
-    except Exception as e:
-        print(f"Error saving game results: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+        # Unfinished current match (game abandoned): keep its live score
+        if number == current_match and (record is None or record['completed_at'] is None):
+            matches.append(Match(
+                game_id=game_id,
+                match_number=number,
+                status=StatusChoices.MATCH_IN_PROGRESS,
+                score_player1=frame['left_paddle']['score'],
+                score_player2=frame['right_paddle']['score'],
+                started_at=timeline_datetime(record and record['started_at'])
+            ))
+        elif record is not None:
+            matches.append(Match(
+                game_id=game_id,
+                match_number=number,
+                status=StatusChoices.MATCH_COMPLETED,
+                score_player1=record['score_player1'],
+                score_player2=record['score_player2'],
+                winner=record['winner'],
+                started_at=timeline_datetime(record['started_at']),
+                completed_at=timeline_datetime(record['completed_at'])
+            ))
+    return matches
 
-@database_sync_to_async
-def update_player_profiles(game_id):
-    print("Updating player profiles")
-    try:
-        if game_id not in active_games:
-            print("Game not found in active games")
-            return
-            
-        game = Game.objects.get(id=game_id)
-        game_state = active_games[game_id]
-        # Only update if game is completed
-        if game_state['game_status'] != 'gameOver':
-            return
-        if game_state['match_wins']['player1'] != 3 and game_state['match_wins']['player2'] != 3:
-            return
-        status = game.status
-        if status == 'cancelled':
-            return
-        # Get profiles
-        p1_profile, _ = PlayerProfile.objects.get_or_create(player=game.player1)
-        p2_profile, _ = PlayerProfile.objects.get_or_create(player=game.player2)
+def build_point_rows(game_id, timeline):
+    """
+    Builds the PointEvent rows for every point recorded during the game.
+    
+    Args:
+        game_id: The ID of the game
+        timeline: Snapshot of the game's timeline
+    
+    Returns:
+        List of unsaved PointEvent instances
+    """
+    return [
+        PointEvent(
+            game_id=game_id,
+            match_number=match_number,
+            scorer=scorer,
+            score_player1=score_player1,
+            score_player2=score_player2,
+            rally_hits=rally_hits,
+            scored_at=timeline_datetime(scored_at)
+        )
+        for match_number, scorer, score_player1, score_player2, rally_hits, scored_at in timeline['points']
+    ]
+
+def finalize_game(game_id, game_state, timeline=None):
+    """
+    Writes the final game results in a single transaction: the Game row,
+    every Match and PointEvent row and both players' profile counters.
+    Takes a fixed number of queries however many matches were played.
+    
+    Args:
+        game_id: The ID of the game
+        game_state: Snapshot of the in-memory game state at game end
+        timeline: Snapshot of the game's timeline (matches and points)
+    
+    Returns:
+        Boolean indicating if the game was finalized
+    """
+    frame = game_state['frame']
+    now = timezone.now()
+    timeline = timeline or {'matches': [], 'points': []}
+    player1_id = game_state['players']['player1']['id']
+    player2_id = game_state['players']['player2']['id']
+    player1_wins = frame['match_wins']['player1']
+    player2_wins = frame['match_wins']['player2']
+    game_over = frame['game_status'] == 'gameOver'
+    
+    # A game somebody won is saved even if a disconnect marked it cancelled
+    # before the writer got to it
+    game_won = game_over and max(player1_wins, player2_wins) >= MATCHES_TO_WIN_GAME
+    
+    winner_id = None
+    if game_over:
+        winner_id = player1_id if player1_wins > player2_wins else player2_id
+    
+    with transaction.atomic():
+        # Already completed games are skipped (the same game can be queued
+        # more than once), a game nobody won stays cancelled
+        games = Game.objects.filter(id=game_id).exclude(status=StatusChoices.COMPLETED)
+        if not game_won:
+            games = games.exclude(status=StatusChoices.CANCELLED)
         
-        # Update match counts
-        p1_profile.matches_played += 1
-        p2_profile.matches_played += 1
+        updated = games.update(
+            status=StatusChoices.COMPLETED,
+            winner_id=winner_id,
+            final_score_player1=player1_wins,
+            final_score_player2=player2_wins,
+            completed_at=now,
+            updated_at=now
+        )
+        if not updated:
+            return False
         
-        # Update wins/losses
-        if game_state['match_wins']['player1'] > game_state['match_wins']['player2']:
-            p1_profile.matches_won += 1
-            p2_profile.matches_lost += 1
-            
-            # Update achievements for player 1
-            p1_profile.update_achievements(game)  # Add this line
+        Match.objects.bulk_create(
+            build_match_rows(game_id, game_state, timeline),
+            ignore_conflicts=True
+        )
+        PointEvent.objects.bulk_create(build_point_rows(game_id, timeline))
+        
+        if game_won:
+            winner_key = 'player1' if winner_id == player1_id else 'player2'
+            loser_id = player2_id if winner_key == 'player1' else player1_id
             
-            #update_player1 level and experience
-            p1_profile.experience += 500
-            p1_profile.level = math.floor(p1_profile.experience/(1000))
-        else:
-            p2_profile.matches_won += 1
-            p1_profile.matches_lost += 1
+            points = {'player1': 0, 'player2': 0}
+            longest_rally = 0
+            for point in timeline['points']:
+                points[point[1]] += 1
+                longest_rally = max(longest_rally, point[4])
             
-            # Update achievements for player 2
-            p2_profile.update_achievements(game)  # Add this line
+            update_player_profiles(
+                winner_id,
+                loser_id,
+                min(player1_wins, player2_wins),
+                winner_points=points[winner_key],
+                loser_points=sum(points.values()) - points[winner_key],
+                longest_rally=longest_rally
+            )
+    
+    return True
 
-            #update_player2 level and experience
-            p2_profile.experience += 100
-            factor = p2_profile.level if p2_profile.level > 0 else 1
-            p2_profile.level = math.floor(p2_profile.experience/(1000 * factor))
-        
-        # Save profiles
-        p1_profile.save()
-        p2_profile.save()
-        
-    except Exception as e:
-        print(f"Error updating player profiles: {str(e)}")
+def update_player_profiles(winner_id, loser_id, loser_match_wins, winner_points=0, loser_points=0, longest_rally=0):
+    """
+    Updates both players' stats after a won game with F() expressions,
+    creating missing profiles first. Ratings are read under a row lock so
+    concurrent games of a player apply their Elo changes one after another.
+    
+    Args:
+        winner_id: User ID of the winner
+        loser_id: User ID of the loser
+        loser_match_wins: Matches the loser won in this game
+        winner_points: Points the winner scored in this game
+        loser_points: Points the loser scored in this game
+        longest_rally: Most paddle hits before a point in this game
+    """
+    PlayerProfile.objects.bulk_create(
+        [PlayerProfile(player_id=winner_id), PlayerProfile(player_id=loser_id)],
+        ignore_conflicts=True
+    )
+    
+    # Achievements: pure win when the loser won no match, triple win on the
+    # TRIPLE_WIN_GAMES-th game won overall (matches_won is read before the
+    # increment)
+    winner_fields = {
+        'matches_played': F('matches_played') + 1,
+        'matches_won': F('matches_won') + 1,
+        'experience': F('experience') + WIN_EXPERIENCE,
+        'level': (F('experience') + WIN_EXPERIENCE) / EXPERIENCE_PER_LEVEL,
+        'points_scored': F('points_scored') + winner_points,
+        'points_conceded': F('points_conceded') + loser_points,
+        'longest_rally': Greatest(F('longest_rally'), Value(longest_rally)),
+        'first_win': True,
+        'triple_win': Case(
+            When(matches_won=TRIPLE_WIN_GAMES - 1, then=Value(True)),
+            default=F('triple_win')
+        ),
+    }
+    if loser_match_wins == 0:
+        winner_fields['pure_win'] = True
+    
+    ratings = dict(
+        PlayerProfile.objects.select_for_update()
+        .filter(player_id__in=[winner_id, loser_id])
+        .values_list('player_id', 'rating')
+    )
+    rating_change = get_rating_change(ratings[winner_id], ratings[loser_id])
+    winner_fields['rating'] = F('rating') + rating_change
+    
+    PlayerProfile.objects.filter(player_id=winner_id).update(**winner_fields)
+    PlayerProfile.objects.filter(player_id=loser_id).update(
+        rating=F('rating') - rating_change,
+        matches_played=F('matches_played') + 1,
+        matches_lost=F('matches_lost') + 1,
+        points_scored=F('points_scored') + loser_points,
+        points_conceded=F('points_conceded') + winner_points,
+        longest_rally=Greatest(F('longest_rally'), Value(longest_rally))
+    )
+
+
+def get_rating_change(winner_rating, loser_rating):
+    """
+    Elo points the winner takes from the loser.
+    
+    Args:
+        winner_rating: Rating of the winner before the game
+        loser_rating: Rating of the loser before the game
+    
+    Returns:
+        Positive integer, larger for an upset
+    """
+    expected = 1 / (1 + 10 ** ((loser_rating - winner_rating) / 400))
+    return max(1, round(RATING_K_FACTOR * (1 - expected)))
 
 
 def validate_game_state(game_id, player_id, position=None):
@@ -679,6 +1209,7 @@ def validate_game_state(game_id, player_id, position=None):
         return (False, "Game does not exist")
     
     game_state = active_games[game_id]
+    frame = game_state['frame']
     
     # Verify player is part of this game
     player_num = None
@@ -690,8 +1221,8 @@ def validate_game_state(game_id, player_id, position=None):
         return (False, "Player not part of this game")
     
     # Verify game is in a valid state for moves
-    if game_state['game_status'] != 'playing':
-        return (False, f"Game is not in playing state (current: {game_state['game_status']})")
+    if frame['game_status'] != 'playing':
+        return (False, f"Game is not in playing state (current: {frame['game_status']})")
     
     # If validating a paddle move, check position bounds
     # print(f"Updating paddle position: game_id={game_id}, player_num={player_num}, position={position}, type={type(position)}")
@@ -705,15 +1236,15 @@ def validate_game_state(game_id, player_id, position=None):
             
         # Check for unreasonable paddle movement (anti-cheat)
         paddle_key = 'left_paddle' if player_num == 1 else 'right_paddle'
-        current_position = game_state[paddle_key]['y']
-        # max_move_distance = game_state[paddle_key]['speed'] * 10 # Allow some buffer for latency
+        current_position = frame[paddle_key]['y']
+        # max_move_distance = frame[paddle_key]['speed'] * 10 # Allow some buffer for latency
         
         # if abs(position - current_position) > max_move_distance:
         #     return (False, "Paddle movement too large")
     
     return (True, None)
 
-def update_paddle_position(game_id, player_num, position):
+def update_paddle_position(game_id, player_num, position, seq=None, timestamp=None):
     """
     Updates a paddle position with validation.
     
@@ -721,6 +1252,8 @@ def update_paddle_position(game_id, player_num, position):
         game_id: The ID of the game
         player_num: Which player (1 or 2)
         position: New Y position of the paddle
+        seq: Client sequence number of the move, acked in frames
+        timestamp: Server time (seconds) the client made the move
         
     Returns:
         Boolean indicating if update was successful
@@ -743,9 +1276,19 @@ def update_paddle_position(game_id, player_num, position):
     #     print(f"Invalid paddle move: {reason}")
     #     return False
     
+    frame = active_games[game_id]['frame']
+    
+    # Moves can arrive out of order, an older one must not move the paddle back
+    if seq is not None:
+        player_key = f'player{player_num}'
+        if seq <= frame['acks'][player_key]:
+            return False
+        frame['acks'][player_key] = seq
+    
     # Update the appropriate paddle
     paddle_key = 'left_paddle' if player_num == 1 else 'right_paddle'
-    active_games[game_id][paddle_key]['y'] = position
+    frame[paddle_key]['y'] = position
+    record_paddle_position(game_id, paddle_key, position, timestamp or time.time())
     
     return True
 
@@ -757,10 +1300,14 @@ from collections import defaultdict, deque
 class RateLimiter:
     """Simple rate limiter to prevent websocket spam"""
     
+    # Every limiter in the process, for memory reports
+    instances = weakref.WeakSet()
+    
     def __init__(self, max_messages=30, window_seconds=1):
         self.max_messages = max_messages
         self.window_seconds = window_seconds
         self.message_counts = defaultdict(lambda: deque())
+        RateLimiter.instances.add(self)
     
     def is_allowed(self, user_id):
         """Check if user is allowed to send message based on recent history"""
@@ -779,3 +1326,13 @@ class RateLimiter:
             return True
         
         return False
+
+# One entry per user tracked by any limiter
+memory.register_table(
+    'rate_limiter.message_counts',
+    lambda: [
+        queue
+        for limiter in list(RateLimiter.instances)
+        for queue in list(limiter.message_counts.values())
+    ]
+)
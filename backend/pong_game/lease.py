@@ -0,0 +1,78 @@
+import uuid
+from .redis_client import get_redis
+
+# KEYS: lease, fencing counter. ARGV: owner, ttl (ms).
+# Returns the new fencing token, or 0 if the lease is held by someone else.
+ACQUIRE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+"""
+
+# KEYS: lease. ARGV: owner, ttl (ms). Returns 1 if still held and extended.
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lease. ARGV: owner. Returns 1 if it was held and is now released.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLease:
+    """
+    Cluster-wide lease on a Redis key (SET NX PX) with fencing tokens.
+
+    Every successful acquire increments `<key>:fencing` and hands the new
+    value to the holder. Writes guarded by the lease should check their token
+    against that counter, so a holder that stalled past its TTL and lost the
+    lease cannot act on it after a new holder took over.
+    """
+
+    def __init__(self, key, ttl):
+        self.key = key
+        self.fencing_key = f'{key}:fencing'
+        self.ttl_ms = int(ttl * 1000)
+        self.owner = str(uuid.uuid4())
+        self.token = None
+
+    @property
+    def held(self):
+        return self.token is not None
+
+    async def acquire(self):
+        """
+        Takes the lease if it is free.
+
+        Returns:
+            Boolean indicating if the lease is held
+        """
+        token = await get_redis().eval(ACQUIRE_SCRIPT, 2, self.key, self.fencing_key, self.owner, self.ttl_ms)
+        self.token = int(token) or None
+        return self.held
+
+    async def renew(self):
+        """
+        Extends a held lease by its TTL.
+
+        Returns:
+            Boolean indicating if the lease is still held
+        """
+        if not self.held:
+            return False
+        if not await get_redis().eval(RENEW_SCRIPT, 1, self.key, self.owner, self.ttl_ms):
+            self.token = None
+        return self.held
+
+    async def release(self):
+        if self.held:
+            self.token = None
+            await get_redis().eval(RELEASE_SCRIPT, 1, self.key, self.owner)
@@ -0,0 +1,389 @@
+"""
+Matchmaking simulation benchmark.
+
+    python manage.py matchmaking_benchmark --rate 50 --duration 120
+    python manage.py matchmaking_benchmark --engine database --json
+
+Synthetic players arrive as a Poisson process with the given difficulty mix
+and ratings, and abandon the queue after an exponentially distributed
+patience. Time advances in matcher ticks; every tick the arrivals are
+queued, impatient players leave and one matching pass runs through the
+same code the matchmaker runs, heartbeat and expiry sweep included. Each
+engine is fed the same arrivals.
+
+Players are created as mmbench_* users in the configured database and
+deleted afterwards. Redis is a fakeredis stand-in unless --live-redis is
+given, in which case the real matchmaking keys are used: never point that
+at a Redis serving players.
+"""
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from authentication.models import User
+from backend.executors import database_sync_to_async
+from pong_game import matchmaking
+from pong_game.models import Game, MatchmakingQueue, PlayerProfile, StatusChoices
+from pong_game.redis_client import set_redis
+
+ENGINES = ['database', 'redis']
+USERNAME_PREFIX = 'mmbench_'
+
+
+class QueryCounter:
+    """Counts queries on every database connection, whichever thread runs them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.wrapped = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if id(connection) not in self.wrapped:
+            self.wrapped.add(id(connection))
+            connection.execute_wrappers.append(self)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def jain_index(values):
+    """Jain's fairness index: 1 when every value is equal, 1/n at worst"""
+    if not values or not any(values):
+        return None
+    return sum(values) ** 2 / (len(values) * sum(value * value for value in values))
+
+
+def parse_mix(mix):
+    """Parses "easy=1,medium=2,hard=1" into normalised difficulty weights"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in matchmaking.DIFFICULTIES:
+            raise CommandError(f"Unknown difficulty '{name}' in --mix")
+        try:
+            weights[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight '{weight}' in --mix")
+    total = sum(weights.values())
+    if total <= 0:
+        raise CommandError("--mix weights must add up to more than 0")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+class Command(BaseCommand):
+    help = "Simulates players arriving in the matchmaking queue and reports how each engine matches them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=ENGINES + ['all'], default='all')
+        parser.add_argument('--rate', type=float, default=20.0, help="Mean arrivals per second")
+        parser.add_argument('--duration', type=float, default=60.0, help="Simulated seconds of arrivals")
+        parser.add_argument('--tick', type=float, default=None,
+                            help="Simulated seconds between matching passes, MATCHMAKING_INTERVAL by default")
+        parser.add_argument('--mix', default='easy=1,medium=2,hard=1', help="Difficulty weights")
+        parser.add_argument('--patience', type=float, default=30.0,
+                            help="Mean seconds a player waits before abandoning, 0 to never abandon")
+        parser.add_argument('--rating-mean', type=float, default=1000.0)
+        parser.add_argument('--rating-spread', type=float, default=200.0)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--realtime', action='store_true',
+                            help="Sleep between passes so simulated and wall time agree; the Redis "
+                                 "rating window widens with wall time")
+        parser.add_argument('--live-redis', action='store_true', help="Use the configured Redis instead of fakeredis")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+        parser.add_argument('--max-queries-per-match', type=float, default=None,
+                            help="Fail if an engine needs more database queries per match")
+        parser.add_argument('--min-matches-per-second', type=float, default=None,
+                            help="Fail if an engine makes fewer matches per second of matcher time")
+
+    def handle(self, *args, **options):
+        engines = ENGINES if options['engine'] == 'all' else [options['engine']]
+        rng = random.Random(options['seed'])
+        arrivals = self.generate_arrivals(rng, options)
+        if not arrivals:
+            raise CommandError("No arrivals, raise --rate or --duration")
+
+        users = self.create_players(arrivals)
+        results = []
+        try:
+            for engine in engines:
+                self.reset_players(users)
+                results.append(asyncio.run(self.simulate(engine, arrivals, users, options)))
+        finally:
+            User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                self.print_result(result)
+
+        failures = self.check_thresholds(results, options)
+        if failures:
+            raise CommandError('; '.join(failures))
+
+    def generate_arrivals(self, rng, options):
+        """
+        Returns:
+            List of arrival dictionaries ordered by arrival time
+        """
+        mix = parse_mix(options['mix'])
+        difficulties, weights = list(mix), list(mix.values())
+        arrivals = []
+        now = rng.expovariate(options['rate'])
+        while now < options['duration']:
+            patience = rng.expovariate(1 / options['patience']) if options['patience'] > 0 else math.inf
+            arrivals.append({
+                'index': len(arrivals),
+                'arrived': now,
+                'leaves': now + patience,
+                'difficulty': rng.choices(difficulties, weights)[0],
+                'rating': max(0, int(rng.gauss(options['rating_mean'], options['rating_spread'])))
+            })
+            now += rng.expovariate(options['rate'])
+        return arrivals
+
+    def create_players(self, arrivals):
+        """Creates one user and profile per arrival, returns the users in arrival order"""
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        User.objects.bulk_create([
+            User(username=f"{USERNAME_PREFIX}{arrival['index']}", email=f"{USERNAME_PREFIX}{arrival['index']}@example.com")
+            for arrival in arrivals
+        ])
+        by_name = {user.username: user for user in User.objects.filter(username__startswith=USERNAME_PREFIX)}
+        users = [by_name[f"{USERNAME_PREFIX}{arrival['index']}"] for arrival in arrivals]
+        PlayerProfile.objects.bulk_create([
+            PlayerProfile(player=user, difficulty=arrival['difficulty'], rating=arrival['rating'])
+            for user, arrival in zip(users, arrivals)
+        ])
+        return users
+
+    def reset_players(self, users):
+        """Drops the queue entries and games left by a previous engine"""
+        ids = [user.id for user in users]
+        MatchmakingQueue.objects.filter(player_id__in=ids).delete()
+        Game.objects.filter(player1_id__in=ids).delete()
+        Game.objects.filter(player2_id__in=ids).delete()
+
+    async def simulate(self, engine, arrivals, users, options):
+        """
+        Runs the arrivals through one engine.
+
+        Returns:
+            Dictionary of the engine's results
+        """
+        if options['live_redis']:
+            if engine == 'redis':
+                await self.clear_live_queue()
+        else:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError("fakeredis is not installed, install it or pass --live-redis")
+            set_redis(fakeredis.FakeAsyncRedis(decode_responses=True))
+
+        tick = options['tick'] or settings.MATCHMAKING_INTERVAL
+        end = arrivals[-1]['arrived'] + tick
+        waiting = {}
+        waits = []
+        rating_gaps = []
+        abandoned = 0
+        matched = {difficulty: 0 for difficulty in matchmaking.DIFFICULTIES}
+        pass_times = []
+        match_queries = 0
+
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        for connection in connections.all(initialized_only=True):
+            counter.install(connection)
+
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        with override_settings(MATCHMAKING_BACKEND=engine, CHANNEL_LAYERS=layers):
+            matchmaker = matchmaking.Matchmaker(interval=tick)
+            try:
+                if not await matchmaker.elect():
+                    raise CommandError("Could not take the matchmaker lease, is another matchmaker running?")
+
+                now = 0
+                next_arrival = 0
+                while now < end:
+                    now += tick
+                    joining = []
+                    while next_arrival < len(arrivals) and arrivals[next_arrival]['arrived'] <= now:
+                        joining.append(next_arrival)
+                        next_arrival += 1
+                    await self.join(engine, [(users[i], arrivals[i]) for i in joining])
+                    waiting.update((users[i].id, arrivals[i]) for i in joining)
+                    for i in joining:
+                        matchmaking.track_player(users[i].id)
+
+                    leaving = [user_id for user_id, arrival in waiting.items() if arrival['leaves'] <= now]
+                    await self.leave(engine, leaving)
+                    for user_id in leaving:
+                        del waiting[user_id]
+                        matchmaking.untrack_player(user_id)
+                    abandoned += len(leaving)
+
+                    queries = counter.count
+                    started = time.perf_counter()
+                    await matchmaker.heartbeat()
+                    await matchmaker.expire_stale()
+                    matches = await matchmaker.match_once()
+                    elapsed = time.perf_counter() - started
+                    pass_times.append(elapsed)
+                    match_queries += counter.count - queries
+
+                    for match in matches:
+                        pair = [waiting.pop(match[f'{player}_id'], None) for player in ('player1', 'player2')]
+                        for player in ('player1', 'player2'):
+                            matchmaking.untrack_player(match[f'{player}_id'])
+                        for arrival in pair:
+                            if arrival is not None:
+                                waits.append(now - arrival['arrived'])
+                                matched[arrival['difficulty']] += 1
+                        if None not in pair:
+                            rating_gaps.append(abs(pair[0]['rating'] - pair[1]['rating']))
+
+                    if options['realtime']:
+                        await asyncio.sleep(max(0, tick - elapsed))
+            finally:
+                await matchmaker.lease.release()
+                if options['live_redis'] and engine == 'redis':
+                    await self.leave(engine, list(waiting))
+                for user_id in waiting:
+                    matchmaking.untrack_player(user_id)
+                connection_created.disconnect(counter.install)
+                for connection in connections.all(initialized_only=True):
+                    if counter in connection.execute_wrappers:
+                        connection.execute_wrappers.remove(counter)
+
+        match_count = len(rating_gaps)
+        matcher_seconds = sum(pass_times)
+        arrived = {difficulty: 0 for difficulty in matchmaking.DIFFICULTIES}
+        for arrival in arrivals:
+            arrived[arrival['difficulty']] += 1
+
+        return {
+            'engine': engine,
+            'arrivals': len(arrivals),
+            'matches': match_count,
+            'abandoned': abandoned,
+            'still_waiting': len(waiting),
+            'passes': len(pass_times),
+            'matcher_seconds': matcher_seconds,
+            'matches_per_second': match_count / matcher_seconds if matcher_seconds else None,
+            'pass_ms': {
+                'p50': percentile(pass_times, 0.5) * 1000,
+                'p99': percentile(pass_times, 0.99) * 1000,
+                'max': max(pass_times) * 1000
+            },
+            'queries_per_match': match_queries / match_count if match_count else None,
+            'time_to_match': {
+                'p50': percentile(waits, 0.5),
+                'p90': percentile(waits, 0.9),
+                'p99': percentile(waits, 0.99),
+                'max': max(waits) if waits else None
+            },
+            'fairness': {
+                'wait_jain_index': jain_index(waits),
+                'rating_gap_mean': sum(rating_gaps) / match_count if match_count else None,
+                'rating_gap_p95': percentile(rating_gaps, 0.95),
+                'matched_share': {
+                    difficulty: matched[difficulty] / arrived[difficulty] if arrived[difficulty] else None
+                    for difficulty in matchmaking.DIFFICULTIES
+                }
+            }
+        }
+
+    async def join(self, engine, players):
+        if engine == 'redis':
+            for user, arrival in players:
+                await matchmaking.join_queue(user, arrival['difficulty'], arrival['rating'])
+        elif players:
+            await self.join_in_db(players)
+
+    @database_sync_to_async(pool='matchmaking')
+    def join_in_db(self, players):
+        MatchmakingQueue.objects.bulk_create([
+            MatchmakingQueue(player=user, difficulty_preference=arrival['difficulty'])
+            for user, arrival in players
+        ])
+
+    async def leave(self, engine, user_ids):
+        if engine == 'redis':
+            for user_id in user_ids:
+                await matchmaking.leave_queue(user_id)
+        elif user_ids:
+            await self.leave_in_db(user_ids)
+
+    @database_sync_to_async(pool='matchmaking')
+    def leave_in_db(self, user_ids):
+        MatchmakingQueue.objects.filter(player_id__in=user_ids, is_active=True).update(
+            is_active=False,
+            status=StatusChoices.QUEUE_TIMEOUT
+        )
+
+    async def clear_live_queue(self):
+        """Refuses to run on a live Redis that has players waiting"""
+        if await matchmaking.get_redis().hlen(matchmaking.ENTRIES_KEY):
+            raise CommandError("Players are waiting in the live Redis queue, refusing to benchmark against it")
+
+    def print_result(self, result):
+        def fmt(value, spec='.1f'):
+            return '-' if value is None else format(value, spec)
+
+        wait = result['time_to_match']
+        fairness = result['fairness']
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Engine: {result['engine']}"))
+        self.stdout.write(
+            f"  arrivals {result['arrivals']}, matches {result['matches']}, "
+            f"abandoned {result['abandoned']}, still waiting {result['still_waiting']}"
+        )
+        self.stdout.write(
+            f"  {result['passes']} passes in {result['matcher_seconds'] * 1000:.1f}ms, "
+            f"pass p50 {result['pass_ms']['p50']:.2f}ms p99 {result['pass_ms']['p99']:.2f}ms, "
+            f"{fmt(result['matches_per_second'])} matches/s, "
+            f"{fmt(result['queries_per_match'], '.2f')} queries/match"
+        )
+        self.stdout.write(
+            f"  time to match p50 {fmt(wait['p50'])}s p90 {fmt(wait['p90'])}s "
+            f"p99 {fmt(wait['p99'])}s max {fmt(wait['max'])}s"
+        )
+        shares = ', '.join(
+            f"{difficulty} {fmt(share * 100 if share is not None else None, '.0f')}%"
+            for difficulty, share in fairness['matched_share'].items()
+        )
+        self.stdout.write(
+            f"  wait fairness {fmt(fairness['wait_jain_index'], '.3f')}, "
+            f"rating gap mean {fmt(fairness['rating_gap_mean'], '.0f')} p95 {fmt(fairness['rating_gap_p95'], '.0f')}, "
+            f"matched {shares}"
+        )
+
+    def check_thresholds(self, results, options):
+        failures = []
+        for result in results:
+            queries = result['queries_per_match']
+            if options['max_queries_per_match'] is not None and queries is not None \
+                    and queries > options['max_queries_per_match']:
+                failures.append(f"{result['engine']}: {queries:.2f} queries per match")
+            rate = result['matches_per_second']
+            if options['min_matches_per_second'] is not None and (rate or 0) < options['min_matches_per_second']:
+                failures.append(f"{result['engine']}: {rate or 0:.1f} matches per second")
+        return failures
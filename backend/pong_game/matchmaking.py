@@ -0,0 +1,932 @@
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+from datetime import datetime, timezone as dt_timezone
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from backend import metrics
+from backend.executors import database_sync_to_async
+from .models import Game, MatchmakingQueue, PlayerProfile, StatusChoices
+from .lease import RedisLease
+from .redis_client import get_redis
+from . import game_logic
+
+# Waiting players per difficulty: a sorted set scored by join time (ms) for
+# queue order, a sorted set scored by rating for finding opponents, and each
+# waiting player's entry (JSON) by user id
+QUEUE_KEY = 'matchmaking:queue:'
+RATING_KEY = 'matchmaking:rating:'
+ENTRIES_KEY = 'matchmaking:entries'
+
+# Difficulties whose queue changed since the matchmaker last pushed
+# positions, scored by the lowest queue rank that changed: players ahead of
+# it kept their position
+DIRTY_KEY = 'matchmaking:dirty_ranks'
+
+# Waiting players scored by their last heartbeat (ms). Entries not refreshed
+# within MATCHMAKING_QUEUE_TTL belong to a process that went away and are
+# expired by the matchmaker.
+HEARTBEAT_KEY = 'matchmaking:heartbeat'
+
+DIFFICULTIES = [choice for choice, _ in Game.DIFFICULTY_CHOICES]
+
+# KEYS: entries hash, target queue, target rating index, dirty ranks, heartbeats.
+# ARGV: user id, entry, join time, rating, queue prefix, rating index prefix,
+# current time (ms).
+# Queues the player, or moves them to the target difficulty keeping their
+# join time if they were already waiting.
+# Returns 1 if newly queued, 0 if already waiting.
+JOIN_SCRIPT = """
+local existing = redis.call('HGET', KEYS[1], ARGV[1])
+local joined_at = ARGV[3]
+local entry = ARGV[2]
+if existing then
+    local old = cjson.decode(existing)
+    local new = cjson.decode(entry)
+    local old_rank = redis.call('ZRANK', ARGV[5] .. old['difficulty'], ARGV[1])
+    redis.call('ZREM', ARGV[5] .. old['difficulty'], ARGV[1])
+    redis.call('ZREM', ARGV[6] .. old['difficulty'], ARGV[1])
+    redis.call('ZADD', KEYS[4], 'LT', old_rank or 0, old['difficulty'])
+    new['joined_at'] = old['joined_at']
+    joined_at = old['joined_at']
+    entry = cjson.encode(new)
+end
+redis.call('ZADD', KEYS[2], joined_at, ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], entry)
+redis.call('ZADD', KEYS[4], 'LT', redis.call('ZRANK', KEYS[2], ARGV[1]), cjson.decode(entry)['difficulty'])
+redis.call('ZADD', KEYS[5], ARGV[7], ARGV[1])
+if existing then
+    return 0
+end
+return 1
+"""
+
+# KEYS: entries hash, dirty ranks, heartbeats. ARGV: user id, queue prefix,
+# rating index prefix.
+# Returns 1 if the player was waiting.
+LEAVE_SCRIPT = """
+redis.call('ZREM', KEYS[3], ARGV[1])
+local existing = redis.call('HGET', KEYS[1], ARGV[1])
+if not existing then
+    return 0
+end
+local difficulty = cjson.decode(existing)['difficulty']
+local rank = redis.call('ZRANK', ARGV[2] .. difficulty, ARGV[1])
+redis.call('ZREM', ARGV[2] .. difficulty, ARGV[1])
+redis.call('ZREM', ARGV[3] .. difficulty, ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], 'LT', rank or 0, difficulty)
+return 1
+"""
+
+# Smoothed RTT (ms) of a player to each game shard, a hash per player
+# refreshed by the matchmaking sockets and expiring with them
+RTT_KEY = 'matchmaking:rtt:'
+
+# Lease held by the one matchmaker of the cluster
+LEADER_KEY = 'matchmaking:leader'
+
+# KEYS: queue, rating index, entries hash, fencing counter, dirty ranks,
+# heartbeats.
+# ARGV: difficulty, fencing token, maximum number of pairs, number of players tried,
+# current time (ms), rating window, window growth per second waited,
+# maximum window, candidates tried on each side, RTT prefix, RTT limit (ms),
+# RTT limit growth per second waited, rating points per ms of RTT, default
+# shard, queue rank to start from.
+# Takes the waiting players in turn from the start rank, oldest first, and
+# pairs each with the best player inside its rating window, which widens the
+# longer it has waited. Players left unpaired are stepped over, so the next
+# call carries on after them instead of retrying the same head of the queue.
+# A candidate scores its rating gap plus the weighted worse RTT of the two
+# players on the shard where that is lowest; candidates above the RTT limit,
+# which also grows with the wait, are passed over. Players without RTT
+# samples are never held back and play on the default shard.
+# Each lookup is a range query on the rating index, so a pair costs
+# O(log n) whatever the size of the queue. Returns the rank to resume from
+# (-1 once the end of the queue is reached), then the paired entries and the
+# shard hosting their game, flattened. Fails if a newer matchmaker has been
+# elected.
+MATCH_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[2] then
+    return redis.error_reply('stale matchmaker fencing token')
+end
+local max_pairs = tonumber(ARGV[3])
+local now = tonumber(ARGV[5])
+local base_window = tonumber(ARGV[6])
+local growth = tonumber(ARGV[7])
+local max_window = tonumber(ARGV[8])
+local candidate_count = tonumber(ARGV[9])
+local rtt_limit = tonumber(ARGV[11])
+local rtt_growth = tonumber(ARGV[12])
+local rtt_weight = tonumber(ARGV[13])
+
+local function latencies(user_id)
+    local flat = redis.call('HGETALL', ARGV[10] .. user_id)
+    local rtts = {}
+    for k = 1, #flat, 2 do
+        rtts[flat[k]] = tonumber(flat[k + 1])
+    end
+    return rtts
+end
+
+-- Shard where the worse of the two RTTs is lowest, ties broken by name
+local function best_shard(rtts1, rtts2)
+    local shard, worst
+    for name, rtt in pairs(rtts1) do
+        local other = rtts2[name]
+        if other then
+            local pair_rtt = math.max(rtt, other)
+            if not worst or pair_rtt < worst or (pair_rtt == worst and name < shard) then
+                shard, worst = name, pair_rtt
+            end
+        end
+    end
+    return shard, worst
+end
+
+local result = {}
+local scan_size = tonumber(ARGV[4])
+local offset = tonumber(ARGV[15])
+local tried = 0
+local dirty_rank
+while tried < scan_size and #result < 3 * max_pairs do
+    local head = redis.call('ZRANGE', KEYS[1], offset, offset, 'WITHSCORES')
+    if #head == 0 then
+        offset = -1
+        break
+    end
+    tried = tried + 1
+    local anchor = head[1]
+    local rating = redis.call('ZSCORE', KEYS[2], anchor)
+    local best, best_score, best_host
+    if rating then
+        rating = tonumber(rating)
+        local waited = (now - tonumber(head[2])) / 1000
+        local window = math.min(base_window + growth * waited, max_window)
+        local max_rtt = rtt_limit + rtt_growth * waited
+        local anchor_rtts = latencies(anchor)
+        local above = redis.call('ZRANGEBYSCORE', KEYS[2], rating, rating + window, 'WITHSCORES', 'LIMIT', 0, candidate_count + 1)
+        local below = redis.call('ZREVRANGEBYSCORE', KEYS[2], rating, rating - window, 'WITHSCORES', 'LIMIT', 0, candidate_count + 1)
+        for _, candidates in ipairs({above, below}) do
+            for j = 1, #candidates, 2 do
+                if candidates[j] ~= anchor then
+                    local shard, pair_rtt = best_shard(anchor_rtts, latencies(candidates[j]))
+                    if not pair_rtt or pair_rtt <= max_rtt then
+                        local score = math.abs(tonumber(candidates[j + 1]) - rating) + rtt_weight * (pair_rtt or 0)
+                        if not best_score or score < best_score then
+                            best, best_score, best_host = candidates[j], score, shard or ARGV[14]
+                        end
+                    end
+                end
+            end
+        end
+    end
+    if best then
+        -- The anchor leaves at the offset; a partner from before it shifts
+        -- the rest of the queue down by one more
+        local best_rank = redis.call('ZRANK', KEYS[1], best)
+        dirty_rank = math.min(dirty_rank or offset, offset, best_rank or offset)
+        if best_rank and best_rank < offset then
+            offset = offset - 1
+        end
+        redis.call('ZREM', KEYS[1], anchor, best)
+        redis.call('ZREM', KEYS[2], anchor, best)
+        redis.call('ZREM', KEYS[6], anchor, best)
+        local entries = redis.call('HMGET', KEYS[3], anchor, best)
+        redis.call('HDEL', KEYS[3], anchor, best)
+        table.insert(result, entries[1])
+        table.insert(result, entries[2])
+        table.insert(result, best_host)
+    else
+        offset = offset + 1
+    end
+end
+if dirty_rank then
+    redis.call('ZADD', KEYS[5], 'LT', dirty_rank, ARGV[1])
+end
+table.insert(result, 1, offset)
+return result
+"""
+
+# KEYS: heartbeats, entries hash, dirty ranks. ARGV: cutoff (ms), maximum
+# number of players, queue prefix, rating index prefix.
+# Removes players whose last heartbeat is older than the cutoff from every
+# index. Returns the number of players expired.
+EXPIRE_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, user_id in ipairs(stale) do
+    redis.call('ZREM', KEYS[1], user_id)
+    local existing = redis.call('HGET', KEYS[2], user_id)
+    if existing then
+        local difficulty = cjson.decode(existing)['difficulty']
+        local rank = redis.call('ZRANK', ARGV[3] .. difficulty, user_id)
+        redis.call('ZREM', ARGV[3] .. difficulty, user_id)
+        redis.call('ZREM', ARGV[4] .. difficulty, user_id)
+        redis.call('HDEL', KEYS[2], user_id)
+        redis.call('ZADD', KEYS[3], 'LT', rank or 0, difficulty)
+    end
+end
+return #stale
+"""
+
+# user id -> matchmaking connections to this process; their queue entries
+# are kept alive by this process's heartbeat
+local_players = defaultdict(int)
+
+
+def track_player(user_id):
+    """Records a matchmaking connection of a player to this process"""
+    local_players[user_id] += 1
+
+
+def untrack_player(user_id):
+    local_players[user_id] -= 1
+    if local_players[user_id] <= 0:
+        del local_players[user_id]
+
+
+metrics.set_gauge('matchmaking.local_players', lambda: len(local_players))
+
+
+async def queue_entry(entry):
+    """Runs JOIN_SCRIPT for an entry, returns 1 if newly queued"""
+    difficulty = entry['difficulty']
+    return await get_redis().eval(
+        JOIN_SCRIPT, 5, ENTRIES_KEY, QUEUE_KEY + difficulty, RATING_KEY + difficulty, DIRTY_KEY, HEARTBEAT_KEY,
+        entry['user_id'], json.dumps(entry), entry['joined_at'], entry['rating'], QUEUE_KEY, RATING_KEY,
+        int(time.time() * 1000)
+    )
+
+
+async def join_queue(user, difficulty, rating):
+    """
+    Adds a player to the waiting pool of a difficulty.
+
+    Returns:
+        Queue status dictionary as sent to the client
+    """
+    entry = {
+        'user_id': user.id,
+        'username': user.username,
+        'avatar': getattr(user, 'avatar', ''),
+        'difficulty': difficulty,
+        'rating': rating,
+        'joined_at': int(time.time() * 1000)
+    }
+    added = await queue_entry(entry)
+    matchmaker.wake()
+
+    position = await get_queue_position(user.id, difficulty)
+    return {"status": "in_queue" if added else "already_in_queue", "position": position}
+
+
+async def leave_queue(user_id):
+    """Removes a player from the waiting pool"""
+    await get_redis().eval(LEAVE_SCRIPT, 3, ENTRIES_KEY, DIRTY_KEY, HEARTBEAT_KEY, user_id, QUEUE_KEY, RATING_KEY)
+    return {"status": "left_queue"}
+
+
+async def get_queue_position(user_id, difficulty):
+    rank = await get_redis().zrank(QUEUE_KEY + difficulty, user_id)
+    return rank + 1 if rank is not None else None
+
+
+async def get_queue_status(user_id):
+    """
+    Returns the position and waiting time of a player.
+
+    Returns:
+        Queue status dictionary as sent to the client
+    """
+    client = get_redis()
+    raw = await client.hget(ENTRIES_KEY, user_id)
+    if raw is None:
+        return {"status": "not_in_queue"}
+
+    entry = json.loads(raw)
+    queue_key = QUEUE_KEY + entry['difficulty']
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.zrank(queue_key, user_id)
+        pipe.zcard(queue_key)
+        rank, total_waiting = await pipe.execute()
+    if rank is None:
+        return {"status": "not_in_queue"}
+
+    return {
+        "status": "in_queue",
+        "position": rank + 1,
+        "total_waiting": total_waiting,
+        "difficulty": entry['difficulty'],
+        "joined_at": datetime.fromtimestamp(entry['joined_at'] / 1000, tz=dt_timezone.utc).isoformat()
+    }
+
+
+class Matchmaker:
+    """
+    The matchmaker service.
+
+    Every process runs a candidate; the one holding the LEADER_KEY lease
+    matches on its own cadence and the others only try to take the lease
+    over. With the Redis backend pairs are made by MATCH_SCRIPT, which
+    checks the fencing token, so a leader that lost its lease cannot match
+    anyone. Each pair gets a Game (and MatchmakingQueue history rows) written
+    on the matchmaking executor pool, then both players are notified through
+    their user_<id> groups. The work done scales with the number of matches
+    made, not with the number of connected sockets.
+
+    Every process refreshes the heartbeat of the players connected to it
+    each MATCHMAKING_HEARTBEAT_INTERVAL, and the leader expires the entries
+    whose heartbeat is older than MATCHMAKING_QUEUE_TTL before matching, so
+    players queued through a process that crashed are never paired.
+
+    The leader also pushes queue positions: at most once per
+    MATCHMAKING_STATUS_INTERVAL it reads the queues that changed and sends
+    queue_status_update to the players whose position moved, so clients
+    never have to poll.
+    """
+
+    def __init__(self, interval=None, batch_size=None, lease_ttl=None):
+        self.interval = interval or settings.MATCHMAKING_INTERVAL
+        self.batch_size = batch_size or settings.MATCHMAKING_BATCH_SIZE
+        self.scan_size = settings.MATCHMAKING_SCAN_SIZE
+        self.status_interval = settings.MATCHMAKING_STATUS_INTERVAL
+        self.last_status_push = 0
+        self.last_heartbeat = 0
+        self.last_sweep = 0
+        # difficulty -> user ids in queue order as last pushed by this leader
+        self.pushed_queues = {}
+        self.lease = RedisLease(LEADER_KEY, lease_ttl or settings.MATCHMAKER_LEASE_TTL)
+        self.task = None
+        self.wakeup = None
+
+        metrics.set_gauge('matchmaking.leader', lambda: int(self.lease.held))
+
+    def ensure_started(self):
+        """Starts this process's candidate on the running loop if needed"""
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def wake(self):
+        """Runs a matching pass now instead of at the next interval"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                try:
+                    await self.heartbeat()
+                    if await self.elect():
+                        await self.expire_stale()
+                        await self.match_once()
+                        await self.push_queue_status()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Error in matchmaker: {str(e)}")
+        finally:
+            await self.lease.release()
+
+    async def elect(self):
+        """
+        Renews the lease if held, tries to take it otherwise.
+
+        Returns:
+            Boolean indicating if this process is the matchmaker
+        """
+        if self.lease.held:
+            if not await self.lease.renew():
+                print("Matchmaker lease lost")
+            return self.lease.held
+        if await self.lease.acquire():
+            metrics.incr('matchmaking.elections')
+            print(f"Elected matchmaker with fencing token {self.lease.token}")
+            # Positions pushed in an earlier term may be stale
+            self.pushed_queues = {}
+        return self.lease.held
+
+    async def match_once(self):
+        """
+        Matches every pair currently waiting.
+
+        Returns:
+            List of match dictionaries
+        """
+        if not self.lease.held:
+            return []
+        if settings.MATCHMAKING_BACKEND != 'redis':
+            matches = await find_matches_in_db()
+            for match in matches:
+                await notify_match(match)
+            return matches
+
+        matches = []
+        client = get_redis()
+        for difficulty in DIFFICULTIES:
+            # Each call resumes after the players the previous one could not
+            # pair, until the whole queue has been tried
+            offset = 0
+            while offset >= 0:
+                result = await client.eval(
+                    MATCH_SCRIPT, 6,
+                    QUEUE_KEY + difficulty, RATING_KEY + difficulty, ENTRIES_KEY, self.lease.fencing_key, DIRTY_KEY,
+                    HEARTBEAT_KEY,
+                    difficulty, self.lease.token, self.batch_size, self.scan_size, int(time.time() * 1000),
+                    settings.MATCHMAKING_RATING_WINDOW,
+                    settings.MATCHMAKING_RATING_WINDOW_GROWTH,
+                    settings.MATCHMAKING_MAX_RATING_WINDOW,
+                    settings.MATCHMAKING_RTT_CANDIDATES, RTT_KEY,
+                    settings.MATCHMAKING_RTT_LIMIT,
+                    settings.MATCHMAKING_RTT_LIMIT_GROWTH,
+                    settings.MATCHMAKING_RTT_WEIGHT,
+                    settings.GAME_SHARD,
+                    offset
+                )
+                offset = result[0]
+                matches.extend(await self.start_matches(difficulty, result[1:]))
+        return matches
+
+    async def heartbeat(self):
+        """
+        Refreshes the queue entries of the players connected to this
+        process, at most once per heartbeat interval.
+        """
+        now = time.monotonic()
+        if now - self.last_heartbeat < settings.MATCHMAKING_HEARTBEAT_INTERVAL:
+            return
+        self.last_heartbeat = now
+        if not local_players:
+            return
+
+        if settings.MATCHMAKING_BACKEND != 'redis':
+            await heartbeat_in_db(list(local_players))
+            return
+        # XX: only players still waiting, matched or departed ones are not re-added
+        now_ms = int(time.time() * 1000)
+        await get_redis().zadd(HEARTBEAT_KEY, {user_id: now_ms for user_id in local_players}, xx=True)
+
+    async def expire_stale(self):
+        """
+        Expires the queue entries whose heartbeat lapsed, at most once per
+        sweep interval.
+
+        Returns:
+            Number of entries expired
+        """
+        if not self.lease.held:
+            return 0
+        now = time.monotonic()
+        if now - self.last_sweep < settings.MATCHMAKING_SWEEP_INTERVAL:
+            return 0
+        self.last_sweep = now
+
+        if settings.MATCHMAKING_BACKEND != 'redis':
+            expired = await expire_stale_in_db()
+        else:
+            cutoff = int((time.time() - settings.MATCHMAKING_QUEUE_TTL) * 1000)
+            client = get_redis()
+            expired = 0
+            while True:
+                count = await client.eval(
+                    EXPIRE_SCRIPT, 3, HEARTBEAT_KEY, ENTRIES_KEY, DIRTY_KEY,
+                    cutoff, self.scan_size, QUEUE_KEY, RATING_KEY
+                )
+                expired += count
+                if count < self.scan_size:
+                    break
+
+        if expired:
+            metrics.incr('matchmaking.expired', expired)
+            print(f"Expired {expired} stale matchmaking queue entries")
+        return expired
+
+    async def push_queue_status(self):
+        """
+        Sends queue_status_update to every player whose position changed
+        since the last push, coalesced to one push per status interval.
+
+        Returns:
+            Number of players notified
+        """
+        if not self.lease.held or settings.MATCHMAKING_BACKEND != 'redis':
+            return 0
+        now = time.monotonic()
+        if now - self.last_status_push < self.status_interval:
+            return 0
+        self.last_status_push = now
+
+        client = get_redis()
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.zrange(DIRTY_KEY, 0, -1, withscores=True)
+            pipe.delete(DIRTY_KEY)
+            dirty, _ = await pipe.execute()
+
+        channel_layer = get_channel_layer()
+        notified = 0
+        for difficulty, dirty_rank in dirty:
+            previous = self.pushed_queues.get(difficulty, [])
+            # Only players from the lowest changed rank on can have moved;
+            # a new leader without the earlier part reads the whole queue
+            start = int(dirty_rank) if len(previous) >= dirty_rank else 0
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.zrange(QUEUE_KEY + difficulty, start, -1)
+                pipe.zcard(QUEUE_KEY + difficulty)
+                members, total = await pipe.execute()
+            for rank, user_id in enumerate(members, start):
+                if rank < len(previous) and previous[rank] == user_id:
+                    continue
+                await channel_layer.group_send(
+                    f"user_{user_id}",
+                    {
+                        "type": "queue_status_update",
+                        "status": {
+                            "status": "in_queue",
+                            "position": rank + 1,
+                            "total_waiting": total,
+                            "difficulty": difficulty
+                        }
+                    }
+                )
+                notified += 1
+            self.pushed_queues[difficulty] = previous[:start] + members
+
+        metrics.incr('matchmaking.status_pushes', notified)
+        return notified
+
+    async def start_matches(self, difficulty, popped):
+        """
+        Records the pairs popped by one script call and notifies the players.
+
+        Args:
+            difficulty: Difficulty the pairs were popped from
+            popped: Flat list of (entry1, entry2, shard) triples
+
+        Returns:
+            List of match dictionaries
+        """
+        pairs = []
+        for i in range(0, len(popped), 3):
+            entries = [json.loads(raw) for raw in popped[i:i + 2] if raw]
+            if len(entries) < 2:
+                # An entry vanished from the hash, put the other one back
+                await self.requeue(entries)
+                continue
+            pairs.append((entries[0], entries[1], popped[i + 2]))
+        if not pairs:
+            return []
+
+        try:
+            matches = await record_matches(difficulty, pairs)
+        except Exception as e:
+            print(f"Error recording matches: {str(e)}")
+            await self.requeue([entry for entry1, entry2, _ in pairs for entry in (entry1, entry2)])
+            return []
+
+        now_ms = time.time() * 1000
+        for match, (entry1, _, _) in zip(matches, pairs):
+            metrics.incr('matchmaking.matches')
+            metrics.observe('matchmaking.wait_ms', now_ms - entry1['joined_at'])
+            await notify_match(match)
+        return matches
+
+    async def requeue(self, entries):
+        """Puts popped players back at their original place in the queue"""
+        for entry in entries:
+            await queue_entry(entry)
+
+
+# History rows of matched players, with their real join time: joined_at is
+# auto_now_add, which the ORM would overwrite on insert
+MATCHED_ENTRIES_SQL = """
+INSERT INTO {queue}
+    (player_id, joined_at, matched_at, heartbeat_at, difficulty_preference, is_active, status, resulting_game_id)
+VALUES
+""".format(queue=MatchmakingQueue._meta.db_table)
+
+
+@database_sync_to_async(pool='matchmaking')
+def record_matches(difficulty, pairs):
+    """
+    Creates the Games of the pairs popped in one pass and their
+    MatchmakingQueue history rows, with one INSERT each however many pairs.
+
+    Args:
+        difficulty: Difficulty of the games
+        pairs: List of (entry1, entry2, shard) tuples
+
+    Returns:
+        Match dictionaries used for the notifications, in the order of pairs
+    """
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with transaction.atomic():
+        games = Game.objects.bulk_create([
+            Game(
+                player1_id=entry1['user_id'],
+                player2_id=entry2['user_id'],
+                status=StatusChoices.WAITING,
+                difficulty=difficulty,
+            )
+            for entry1, entry2, _ in pairs
+        ])
+
+        rows = []
+        params = []
+        for game, (entry1, entry2, _) in zip(games, pairs):
+            for entry in (entry1, entry2):
+                joined_at = datetime.fromtimestamp(entry['joined_at'] / 1000, tz=dt_timezone.utc)
+                rows.append("(%s, %s, %s, %s, %s, %s, %s, %s)")
+                params.extend([
+                    entry['user_id'],
+                    connection.ops.adapt_datetimefield_value(joined_at),
+                    now,
+                    now,
+                    difficulty,
+                    False,
+                    StatusChoices.QUEUE_MATCHED,
+                    game.id
+                ])
+        with connection.cursor() as cursor:
+            cursor.execute(MATCHED_ENTRIES_SQL + ",\n".join(rows), params)
+
+    return [
+        {
+            'game_id': game.id,
+            'difficulty': difficulty,
+            'player1_id': entry1['user_id'],
+            'player2_id': entry2['user_id'],
+            'player1_username': entry1['username'],
+            'player2_username': entry2['username'],
+            'player1_avatar': entry1['avatar'],
+            'player2_avatar': entry2['avatar'],
+            'shard': shard
+        }
+        for game, (entry1, entry2, shard) in zip(games, pairs)
+    ]
+
+
+@database_sync_to_async(pool='matchmaking')
+def find_matches_in_db():
+    """
+    Finds potential matches among the MatchmakingQueue rows.
+    Only used with MATCHMAKING_BACKEND = 'database'.
+
+    The waiting entries are read with their players in one query and paired
+    in memory, oldest first; the games and the queue entry updates are then
+    written in bulk in a single transaction, so a pass costs a handful of
+    queries however many pairs it makes.
+
+    Returns:
+        List of match dictionaries used for the notifications
+    """
+    with transaction.atomic():
+        # Entries whose heartbeat lapsed are left for the sweeper
+        waiting = list(MatchmakingQueue.objects.filter(
+            is_active=True,
+            status=StatusChoices.QUEUE_WAITING,
+            heartbeat_at__gte=queue_ttl_cutoff()
+        ).select_related('player').order_by('joined_at'))
+        if len(waiting) < 2:
+            return []
+
+        # Players without a profile are not matched as the longest-waiting player
+        profiled = set(PlayerProfile.objects.filter(
+            player_id__in={entry.player_id for entry in waiting}
+        ).values_list('player_id', flat=True))
+
+        by_difficulty = {}
+        for entry in waiting:
+            by_difficulty.setdefault(entry.difficulty_preference, deque()).append(entry)
+
+        pairs = []
+        for difficulty, entries in by_difficulty.items():
+            while len(entries) >= 2:
+                player1_entry = entries.popleft()
+                if player1_entry.player_id not in profiled:
+                    continue
+
+                # The next player who isn't the same as player1; that player's
+                # other entries keep their place in the queue
+                skipped = []
+                while entries and entries[0].player_id == player1_entry.player_id:
+                    skipped.append(entries.popleft())
+                if not entries:
+                    break
+                player2_entry = entries.popleft()
+                entries.extendleft(reversed(skipped))
+                pairs.append((difficulty, player1_entry, player2_entry))
+
+        if not pairs:
+            return []
+
+        games = Game.objects.bulk_create([
+            Game(
+                player1_id=player1_entry.player_id,
+                player2_id=player2_entry.player_id,
+                status=StatusChoices.WAITING,
+                difficulty=difficulty,
+            )
+            for difficulty, player1_entry, player2_entry in pairs
+        ])
+
+        now = timezone.now()
+        matched_entries = []
+        matches_created = []
+        for game, (difficulty, player1_entry, player2_entry) in zip(games, pairs):
+            for entry in (player1_entry, player2_entry):
+                entry.status = StatusChoices.QUEUE_MATCHED
+                entry.is_active = False
+                entry.matched_at = now
+                entry.resulting_game = game
+                matched_entries.append(entry)
+
+            player1, player2 = player1_entry.player, player2_entry.player
+            matches_created.append({
+                'game_id': game.id,
+                'difficulty': difficulty,
+                'player1_id': player1.id,
+                'player2_id': player2.id,
+                'player1_username': player1.username,
+                'player2_username': player2.username,
+                'player1_avatar': getattr(player1, 'avatar', ''),
+                'player2_avatar': getattr(player2, 'avatar', '')
+            })
+
+        MatchmakingQueue.objects.bulk_update(
+            matched_entries,
+            ['status', 'is_active', 'matched_at', 'resulting_game']
+        )
+
+    return matches_created
+
+
+# Queues a player, or refreshes the entry they already have (the
+# unique_active_queue_entry partial index allows one active entry per
+# player), and returns whether it was inserted and its position: one
+# statement per join. The rank subquery sees the table as it was before
+# the upsert, which does not matter as only earlier joins are counted.
+JOIN_SQL = """
+WITH entry AS (
+    INSERT INTO {queue} AS q
+        (player_id, joined_at, matched_at, heartbeat_at, difficulty_preference, is_active, status)
+    VALUES (
+        %(player_id)s, %(now)s, NULL, %(now)s,
+        COALESCE(
+            %(difficulty)s::varchar,
+            (SELECT difficulty FROM {profile} WHERE player_id = %(player_id)s),
+            %(default_difficulty)s
+        ),
+        TRUE, %(waiting)s
+    )
+    ON CONFLICT (player_id) WHERE is_active
+    DO UPDATE SET
+        difficulty_preference = EXCLUDED.difficulty_preference,
+        heartbeat_at = EXCLUDED.heartbeat_at
+    RETURNING q.joined_at, q.difficulty_preference, (q.xmax = 0) AS inserted
+)
+SELECT entry.inserted, 1 + (
+    SELECT COUNT(*) FROM {queue} waiting
+    WHERE waiting.difficulty_preference = entry.difficulty_preference
+        AND waiting.is_active
+        AND waiting.status = %(waiting)s
+        AND waiting.joined_at < entry.joined_at
+)
+FROM entry
+""".format(queue=MatchmakingQueue._meta.db_table, profile=PlayerProfile._meta.db_table)
+
+
+@database_sync_to_async(pool='matchmaking')
+def join_queue_in_db(user_id, difficulty=None, ensure_profile=False):
+    """
+    MatchmakingQueue version of join_queue.
+
+    Args:
+        user_id: The player joining
+        difficulty: Difficulty to queue for, the profile's if None
+        ensure_profile: Create the player's profile if missing, which
+            matching requires; only needed on a connection's first join
+
+    Returns:
+        Queue status dictionary as sent to the client
+    """
+    if ensure_profile:
+        PlayerProfile.objects.get_or_create(player_id=user_id)
+
+    if connection.vendor != 'postgresql':
+        return join_queue_with_orm(user_id, difficulty)
+
+    with connection.cursor() as cursor:
+        cursor.execute(JOIN_SQL, {
+            'player_id': user_id,
+            'difficulty': difficulty,
+            'default_difficulty': PlayerProfile._meta.get_field('difficulty').default,
+            'waiting': StatusChoices.QUEUE_WAITING,
+            'now': timezone.now()
+        })
+        inserted, position = cursor.fetchone()
+    return {"status": "in_queue" if inserted else "already_in_queue", "position": position}
+
+
+def join_queue_with_orm(user_id, difficulty):
+    """join_queue_in_db for databases without INSERT ... ON CONFLICT ... RETURNING in a CTE"""
+    if difficulty is None:
+        difficulty = PlayerProfile.objects.get(player_id=user_id).difficulty
+
+    now = timezone.now()
+    entry = MatchmakingQueue.objects.filter(player_id=user_id, is_active=True).first()
+    status = "already_in_queue"
+    if entry:
+        entry.difficulty_preference = difficulty
+        entry.heartbeat_at = now
+        entry.save(update_fields=['difficulty_preference', 'heartbeat_at'])
+    else:
+        entry = MatchmakingQueue.objects.create(
+            player_id=user_id,
+            difficulty_preference=difficulty,
+            is_active=True,
+            status=StatusChoices.QUEUE_WAITING
+        )
+        status = "in_queue"
+
+    position = MatchmakingQueue.objects.filter(
+        difficulty_preference=entry.difficulty_preference,
+        is_active=True,
+        status=StatusChoices.QUEUE_WAITING,
+        joined_at__lt=entry.joined_at
+    ).count() + 1
+    return {"status": status, "position": position}
+
+
+def queue_ttl_cutoff():
+    """Oldest heartbeat of a MatchmakingQueue entry still considered alive"""
+    return timezone.now() - timedelta(seconds=settings.MATCHMAKING_QUEUE_TTL)
+
+
+@database_sync_to_async(pool='matchmaking')
+def heartbeat_in_db(user_ids):
+    """MatchmakingQueue version of the heartbeat, one UPDATE for all players"""
+    MatchmakingQueue.objects.filter(
+        player_id__in=user_ids,
+        is_active=True
+    ).update(heartbeat_at=timezone.now())
+
+
+@database_sync_to_async(pool='matchmaking')
+def expire_stale_in_db():
+    """
+    Times out the waiting entries whose heartbeat lapsed, in one UPDATE
+    using the (is_active, heartbeat_at) index.
+
+    Returns:
+        Number of entries expired
+    """
+    return MatchmakingQueue.objects.filter(
+        is_active=True,
+        heartbeat_at__lt=queue_ttl_cutoff()
+    ).update(is_active=False, status=StatusChoices.QUEUE_TIMEOUT)
+
+
+async def record_rtt(user_id, rtts):
+    """Stores a player's RTT (ms) to each shard in `rtts` for the matcher"""
+    key = RTT_KEY + str(user_id)
+    async with get_redis().pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping={shard: round(rtt, 1) for shard, rtt in rtts.items()})
+        pipe.expire(key, int(settings.MATCHMAKING_QUEUE_TTL))
+        await pipe.execute()
+
+
+async def notify_match(match):
+    """
+    Sends match_found to both players' user groups. The matchmaking
+    consumers on the game's shard prewarm the game from it.
+    """
+    channel_layer = get_channel_layer()
+    for player, opponent in (('player1', 'player2'), ('player2', 'player1')):
+        await channel_layer.group_send(
+            f"user_{match[f'{player}_id']}",
+            {
+                "type": "match_found",
+                "game_id": match['game_id'],
+                "difficulty": match['difficulty'],
+                "player1_id": match['player1_id'],
+                "player2_id": match['player2_id'],
+                "player1": match['player1_username'],
+                "player2": match['player2_username'],
+                "opponent_avatar": match[f'{opponent}_avatar'],
+                "shard": match.get('shard', settings.GAME_SHARD)
+            }
+        )
+
+
+# Process-wide matcher started by the matchmaking consumers
+matchmaker = Matchmaker()
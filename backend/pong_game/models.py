@@ -57,6 +57,12 @@ class PlayerProfile(models.Model):
     matches_won = models.IntegerField(default=0)
     matches_lost = models.IntegerField(default=0)
     
+    # Aggregates maintained at game finalization
+    points_scored = models.IntegerField(default=0)
+    points_conceded = models.IntegerField(default=0)
+    longest_rally = models.IntegerField(default=0)  # Paddle hits in one point
+    rating = models.IntegerField(default=1000)  # Elo rating, used by matchmaking
+    
     # Achievements (now default to False)
     first_win = models.BooleanField(default=False)  # First match won
     pure_win = models.BooleanField(default=False)  # Win without losing a match
@@ -208,6 +214,8 @@ class MatchmakingQueue(models.Model):
     player = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matchmaking_entries')
     joined_at = models.DateTimeField(auto_now_add=True)
     matched_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed while the player's matchmaking connection is alive
+    heartbeat_at = models.DateTimeField(default=timezone.now)
     
     # Using PlayerProfile's difficulty choices to avoid circular reference
     difficulty_preference = models.CharField(
@@ -227,6 +235,15 @@ class MatchmakingQueue(models.Model):
         indexes = [
             models.Index(fields=['is_active', 'status']),
             models.Index(fields=['difficulty_preference', 'is_active']),
+            models.Index(fields=['is_active', 'heartbeat_at']),
+        ]
+        constraints = [
+            # One active entry per player, also the conflict target of the join upsert
+            models.UniqueConstraint(
+                fields=['player'],
+                condition=models.Q(is_active=True),
+                name='unique_active_queue_entry'
+            ),
         ]
     
     def __str__(self):
@@ -447,4 +464,29 @@ class Match(models.Model):
             # Create next match if needed
             self.game.create_new_match()
             
-        return True
\ No newline at end of file
+        return True
+
+
+class PointEvent(models.Model):
+    """A point scored during a game, recorded in memory and bulk inserted when the game is finalized"""
+    SCORER_CHOICES = [('player1', 'Player 1'), ('player2', 'Player 2')]
+    
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='points')
+    match_number = models.PositiveSmallIntegerField()
+    scorer = models.CharField(max_length=10, choices=SCORER_CHOICES)
+    
+    # Match score right after this point
+    score_player1 = models.PositiveSmallIntegerField()
+    score_player2 = models.PositiveSmallIntegerField()
+    
+    rally_hits = models.PositiveSmallIntegerField(default=0)  # Paddle hits before the point
+    scored_at = models.DateTimeField()
+    
+    class Meta:
+        ordering = ['game', 'match_number', 'scored_at']
+        indexes = [
+            models.Index(fields=['game', 'match_number']),
+        ]
+    
+    def __str__(self):
+        return f"Point for {self.scorer} in match {self.match_number} of Game {self.game_id}"
@@ -0,0 +1,158 @@
+import asyncio
+from collections import deque
+from django.conf import settings
+from backend import metrics
+
+
+class OutboundQueue:
+    """
+    Per-connection outbound buffer drained by one writer task.
+
+    Control messages are delivered reliably and in order. Tick frames are
+    coalesced: a frame still waiting to be sent is dropped when a newer one
+    arrives, so a slow socket gets the latest state instead of a backlog.
+    Channel-layer handlers only enqueue, so nothing piles up in the layer
+    either.
+
+    The server's send() returns as soon as the frame is handed to the
+    transport, so it says nothing about the client keeping up. Frames are
+    numbered instead and every ack_every-th one asks the client for a
+    frame_ack: with max_unacked frames unacknowledged the writer holds the
+    next frame (newer ones replace it), and a socket that acknowledges
+    nothing for stall_timeout is reported as stalled.
+    """
+
+    def __init__(self, send, on_stall=None, high_water=None, stall_timeout=None,
+                 max_unacked=None, ack_every=None):
+        self.send = send
+        self.on_stall = on_stall
+        self.high_water = high_water or settings.GAME_OUTBOUND_HIGH_WATER
+        self.stall_timeout = stall_timeout or settings.GAME_SEND_STALL_TIMEOUT
+        self.max_unacked = max_unacked or settings.GAME_MAX_UNACKED_FRAMES
+        self.ack_every = ack_every or settings.GAME_FRAME_ACK_EVERY
+        # Numbers of the last frame sent and the last one the client acked
+        self.sent_seq = 0
+        self.acked_seq = 0
+        self.acked = asyncio.Event()
+        # Entries are one-item lists so a pending frame can be blanked in place
+        self.entries = deque()
+        self.pending_frame = None
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = None
+        self.stall_task = None
+        self.dropped_frames = 0
+        self.stalled = False
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def put_frame(self, message):
+        """Queues a tick frame, replacing a frame that has not been sent yet"""
+        if self.stalled:
+            return
+        if self.pending_frame is not None:
+            self.dropped_frames += 1
+            metrics.incr('game.frames_dropped')
+            if self.entries and self.entries[-1] is self.pending_frame:
+                # Nothing queued after it, the frame keeps its place
+                self.pending_frame[0] = message
+                return
+            self.pending_frame[0] = None
+        self.pending_frame = [message]
+        self.entries.append(self.pending_frame)
+        if len(self.entries) > self.high_water:
+            self.mark_stalled('outbound queue above high-water mark')
+            return
+        self.idle.clear()
+        self.wakeup.set()
+
+    def put_control(self, message):
+        """Queues a message that must be delivered"""
+        if self.stalled:
+            return
+        self.entries.append([message])
+        if len(self.entries) > self.high_water:
+            self.mark_stalled('outbound queue above high-water mark')
+            return
+        self.idle.clear()
+        self.wakeup.set()
+
+    def on_ack(self, frame_seq):
+        """Records a frame_ack from the client"""
+        if isinstance(frame_seq, int) and self.acked_seq < frame_seq <= self.sent_seq:
+            self.acked_seq = frame_seq
+            self.acked.set()
+
+    async def wait_for_ack(self):
+        """
+        Waits until the client is less than max_unacked frames behind.
+
+        Returns:
+            False if nothing was acknowledged for stall_timeout
+        """
+        while self.sent_seq - self.acked_seq >= self.max_unacked:
+            self.acked.clear()
+            try:
+                await asyncio.wait_for(self.acked.wait(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def mark_stalled(self, reason):
+        self.stalled = True
+        self.entries.clear()
+        self.pending_frame = None
+        self.idle.set()
+        metrics.incr('game.stalled_connections')
+        print(f"Stalled game socket: {reason}")
+        if self.on_stall is not None:
+            self.stall_task = asyncio.get_running_loop().create_task(self.on_stall())
+
+    async def drain(self):
+        """Waits until everything queued so far has been sent"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), self.stall_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Sends queued messages until stopped"""
+        while not self.stalled:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.entries and not self.stalled:
+                if self.entries[0] is self.pending_frame:
+                    # Held in the queue (and coalesced) until the client
+                    # catches up with the frames already sent
+                    if not await self.wait_for_ack():
+                        self.mark_stalled(f"no frame acknowledged for {self.stall_timeout}s")
+                        return
+                    self.pending_frame = None
+                    message = self.entries.popleft()[0]
+                    self.sent_seq += 1
+                    message['frame_seq'] = self.sent_seq
+                    if self.sent_seq % self.ack_every == 0:
+                        message['ack'] = True
+                else:
+                    message = self.entries.popleft()[0]
+                if message is None:
+                    continue
+                try:
+                    await asyncio.wait_for(self.send(message), self.stall_timeout)
+                except asyncio.TimeoutError:
+                    self.mark_stalled(f"send blocked for more than {self.stall_timeout}s")
+                    return
+            if not self.entries:
+                self.idle.set()
@@ -0,0 +1,256 @@
+import asyncio
+import copy
+import json
+import os
+import socket
+import time
+import traceback
+from backend.executors import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from . import game_logic
+from .redis_client import get_redis
+
+
+class InProcessEventQueue:
+    """In-memory queue of game-end events, lost if the process dies"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        # Batches whose write failed, handed out again before new events
+        self.redeliver = []
+
+    async def put(self, event):
+        self.queue.put_nowait(event)
+
+    async def get_batch(self, max_items, timeout):
+        """
+        Waits up to `timeout` seconds for the first event, then takes
+        whatever else is already queued (up to `max_items`).
+
+        Returns:
+            List of (event_id, event) tuples
+        """
+        if self.redeliver:
+            batch = self.redeliver[:max_items]
+            del self.redeliver[:max_items]
+            return batch
+
+        try:
+            first = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        batch = [(None, first)]
+        while len(batch) < max_items and not self.queue.empty():
+            batch.append((None, self.queue.get_nowait()))
+        return batch
+
+    async def ack(self, event_ids):
+        pass
+
+    def release(self, batch):
+        """Returns a batch that could not be written to the queue head"""
+        self.redeliver[:0] = batch
+
+    def size(self):
+        return self.queue.qsize() + len(self.redeliver)
+
+
+class RedisStreamEventQueue:
+    """
+    Game-end events kept in a Redis stream read through a consumer group.
+    Events are only acknowledged once written, so a crashed worker picks
+    its pending events up again on restart, and events left pending by a
+    consumer that never came back are claimed after GAME_RESULTS_CLAIM_IDLE.
+    """
+
+    GROUP = 'game-results'
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.group_ready = False
+        self.pending_checked = False
+        self.next_claim = 0
+        self.claim_cursor = '0-0'
+        self.last_size = 0
+
+    async def ensure_group(self, client):
+        if self.group_ready:
+            return
+        try:
+            await client.xgroup_create(self.stream, self.GROUP, id='0', mkstream=True)
+        except Exception as e:
+            # BUSYGROUP: the group already exists
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.group_ready = True
+
+    async def put(self, event):
+        client = get_redis()
+        await client.xadd(self.stream, {'event': json.dumps(event)})
+
+    async def get_batch(self, max_items, timeout):
+        client = get_redis()
+        await self.ensure_group(client)
+
+        if self.pending_checked and time.monotonic() >= self.next_claim:
+            await self.claim_stale(client, max_items)
+
+        # Redeliver our own unacknowledged events first (after a restart)
+        start_id = '>' if self.pending_checked else '0'
+        response = await client.xreadgroup(
+            self.GROUP,
+            self.consumer,
+            {self.stream: start_id},
+            count=max_items,
+            block=None if start_id == '0' else int(timeout * 1000)
+        )
+        if start_id == '0' and not (response and response[0][1]):
+            self.pending_checked = True
+            return []
+
+        batch = []
+        for _, entries in response or []:
+            for event_id, fields in entries:
+                batch.append((event_id, json.loads(fields['event'])))
+        self.last_size = await client.xlen(self.stream)
+        return batch
+
+    async def claim_stale(self, client, max_items):
+        """
+        Takes over events another consumer read but never acknowledged
+        (a worker that died for good). They become our pending events and
+        are read again from '0'.
+        """
+        self.next_claim = time.monotonic() + settings.GAME_RESULTS_CLAIM_IDLE
+        response = await client.xautoclaim(
+            self.stream,
+            self.GROUP,
+            self.consumer,
+            min_idle_time=int(settings.GAME_RESULTS_CLAIM_IDLE * 1000),
+            start_id=self.claim_cursor,
+            count=max_items
+        )
+        # [next cursor, claimed entries] (and deleted ids on Redis 7)
+        self.claim_cursor = response[0]
+        if response[1]:
+            self.pending_checked = False
+            # More may be left past the cursor, check again on the next read
+            self.next_claim = 0
+
+    async def ack(self, event_ids):
+        if not event_ids:
+            return
+        client = get_redis()
+        await client.xack(self.stream, self.GROUP, *event_ids)
+        await client.xdel(self.stream, *event_ids)
+
+    def release(self, batch):
+        """
+        Gives up on a batch that could not be written. Its events stay
+        pending, so they are read again from '0' on the next call.
+        """
+        self.pending_checked = False
+
+    def size(self):
+        return self.last_size
+
+
+class GameResultWriter:
+    """
+    Write-behind queue for finished games.
+
+    The game loop and consumers only snapshot the in-memory state and
+    enqueue it; a single background task drains the queue and writes the
+    results in batched transactions, one savepoint per game.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or settings.GAME_RESULTS_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.GAME_RESULTS_FLUSH_INTERVAL
+        self.queue = None
+        self.task = None
+        self.written = 0
+        self.failed = 0
+
+    def get_queue(self):
+        if self.queue is None:
+            if settings.GAME_RESULTS_STREAM:
+                self.queue = RedisStreamEventQueue(settings.GAME_RESULTS_STREAM)
+            else:
+                self.queue = InProcessEventQueue()
+        return self.queue
+
+    def ensure_started(self):
+        """Starts the background worker on the running loop if needed"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def enqueue(self, game_id):
+        """
+        Queues the results of a game for persistence.
+
+        Args:
+            game_id: The ID of the game (must still be in active_games)
+
+        Returns:
+            Boolean indicating if an event was queued
+        """
+        if game_id not in game_logic.active_games:
+            return False
+
+        event = {
+            'game_id': game_id,
+            'state': copy.deepcopy(game_logic.active_games[game_id]),
+            'timeline': copy.deepcopy(game_logic.game_timelines.get(game_id))
+        }
+        await self.get_queue().put(event)
+        self.ensure_started()
+        return True
+
+    async def run(self):
+        """Drains the queue forever, one batch per transaction"""
+        queue = self.get_queue()
+        while True:
+            batch = []
+            try:
+                batch = await queue.get_batch(self.batch_size, self.flush_interval)
+                if not batch:
+                    continue
+                await database_sync_to_async(self.write_batch, pool='game')([event for _, event in batch])
+                await queue.ack([event_id for event_id, _ in batch if event_id is not None])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in game results writer: {str(e)}")
+                # Retried on the next pass; finalize_game skips games that
+                # were already written if only the ack failed
+                queue.release(batch)
+                await asyncio.sleep(self.flush_interval)
+
+    def write_batch(self, events):
+        """
+        Writes a batch of game-end events in one transaction.
+        A failing game is rolled back to its savepoint and skipped.
+        """
+        with transaction.atomic():
+            for event in events:
+                try:
+                    # finalize_game runs in its own atomic block (a savepoint here)
+                    if game_logic.finalize_game(event['game_id'], event['state'], event.get('timeline')):
+                        self.written += 1
+                except Exception as e:
+                    self.failed += 1
+                    print(f"Error saving game results for game {event['game_id']}: {str(e)}")
+                    traceback.print_exc()
+
+
+# Process-wide writer used by the game consumers
+game_result_writer = GameResultWriter()
+
+
+async def enqueue_game_result(game_id):
+    """Queues a finished (or abandoned) game for persistence"""
+    return await game_result_writer.enqueue(game_id)
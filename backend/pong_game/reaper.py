@@ -0,0 +1,68 @@
+import asyncio
+import time
+from django.conf import settings
+from backend import metrics
+from . import game_logic
+from .persistence import enqueue_game_result
+
+
+class IdleGameReaper:
+    """
+    Single background task that evicts unattended games from memory.
+
+    Every interval it pops the games whose idle deadline has passed from
+    game_logic's idle index, queues their results (games nobody ever
+    connected to are just dropped) and removes them, in batches.
+    """
+
+    def __init__(self, interval=None, batch_size=None):
+        self.interval = interval or settings.GAME_REAPER_INTERVAL
+        self.batch_size = batch_size or settings.GAME_REAPER_BATCH_SIZE
+        self.task = None
+
+    def ensure_started(self):
+        """Starts the reaper on the running loop if needed"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in idle game reaper: {str(e)}")
+
+    async def reap(self, now=None):
+        """
+        Evicts every expired game, one batch at a time.
+
+        Returns:
+            Number of games evicted
+        """
+        now = now or time.time()
+        total = 0
+        while True:
+            expired = game_logic.pop_expired_games(now, self.batch_size)
+            for game_id in expired:
+                if game_id in game_logic.prewarmed_games:
+                    metrics.incr('game.reaped_prewarmed')
+                else:
+                    await enqueue_game_result(game_id)
+                    metrics.incr('game.reaped')
+                game_logic.remove_game(game_id)
+            total += len(expired)
+
+            if len(expired) < self.batch_size:
+                return total
+            # Let the game loops run between batches
+            await asyncio.sleep(0)
+
+
+# Process-wide reaper started by the game consumers
+idle_game_reaper = IdleGameReaper()
+
+metrics.set_gauge('game.active_games', lambda: len(game_logic.active_games))
+metrics.set_gauge('game.idle_index_size', lambda: len(game_logic.idle_index))
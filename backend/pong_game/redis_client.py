@@ -0,0 +1,35 @@
+import asyncio
+import weakref
+import redis.asyncio as redis
+from django.conf import settings
+
+# One client per event loop, redis.asyncio connections are bound to the
+# loop that created them
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """
+    Returns the shared asyncio Redis client for the running event loop.
+
+    Returns:
+        A redis.asyncio.Redis instance (responses decoded to str)
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = redis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            decode_responses=True
+        )
+        _clients[loop] = client
+    return client
+
+
+def set_redis(client):
+    """
+    Makes get_redis return `client` on the running event loop, e.g. a
+    fakeredis stand-in for a benchmark.
+    """
+    _clients[asyncio.get_running_loop()] = client
@@ -0,0 +1,67 @@
+import asyncio
+
+
+class TimeoutScheduler:
+    """
+    Process-wide scheduler for one-shot timeouts.
+
+    Timeouts sit in the event loop's timer heap, so a waiting connection
+    costs one heap entry instead of a task waking up every second.
+    Callbacks may be plain functions or coroutine functions.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.tasks = set()
+        self.fired = 0
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules `callback(*args)` to run after `delay` seconds.
+
+        Returns:
+            A handle whose cancel() drops the timeout
+        """
+        loop = asyncio.get_running_loop()
+        handle = None
+
+        def fire():
+            self.pending.discard(handle)
+            self.fired += 1
+            try:
+                result = callback(*args)
+                if asyncio.iscoroutine(result):
+                    # Keep a reference so the task is not garbage collected
+                    task = loop.create_task(result)
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+            except Exception as e:
+                print(f"Error in scheduled timeout: {str(e)}")
+
+        handle = ScheduledTimeout(self, loop.call_later(delay, fire))
+        self.pending.add(handle)
+        return handle
+
+    def size(self):
+        return len(self.pending)
+
+
+class ScheduledTimeout:
+    """Handle returned by TimeoutScheduler.call_later"""
+
+    __slots__ = ('scheduler', 'timer')
+
+    def __init__(self, scheduler, timer):
+        self.scheduler = scheduler
+        self.timer = timer
+
+    def cancel(self):
+        self.timer.cancel()
+        self.scheduler.pending.discard(self)
+
+    def cancelled(self):
+        return self.timer.cancelled()
+
+
+# Shared by every consumer in the process
+timeouts = TimeoutScheduler()
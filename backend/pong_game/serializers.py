@@ -9,8 +9,9 @@ class PlayerProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = PlayerProfile
         fields = ['id', 'username', 'avatar', 'theme', 'difficulty',
-                  'experience', 'level',
+                  'experience', 'level', 'rating',
                   'matches_played', 'matches_won', 'matches_lost',
+                  'points_scored', 'points_conceded', 'longest_rally',
                   'first_win', 'pure_win', 'triple_win']
         def validate_theme(self, value):
             valid_themes = dict(PlayerProfile.THEME_CHOICES).keys()
@@ -63,7 +64,7 @@ class MatchSerializer(serializers.ModelSerializer):
         model = Match
         fields = ['id', 'match_number', 'status', 
                   'score_player1', 'score_player2', 
-                  'winner', 'created_at', 'completed_at']
+                  'winner', 'created_at', 'started_at', 'completed_at']
 
 class GameInviteSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(source='sender.player.username', read_only=True)
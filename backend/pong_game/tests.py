@@ -1,3 +1,305 @@
-from django.test import TestCase
+import asyncio
+import json
+import time
+from unittest import skipIf
+from django.test import SimpleTestCase, TestCase
+from authentication.models import User
+from .models import Game, Match, PlayerProfile, StatusChoices
+from . import game_logic, matchmaking
+from .lease import RedisLease
+from .outbound import OutboundQueue
+from .redis_client import set_redis
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+requires_fakeredis = skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+
+
+def finished_state(game, player1_wins, player2_wins):
+    """In-memory state of a game that ended with the given match wins"""
+    game_id = str(game.id)
+    state = game_logic.create_game_state(game_id, {
+        'difficulty': game.difficulty,
+        'player1_id': game.player1_id,
+        'player2_id': game.player2_id,
+        'player1_username': game.player1.username,
+        'player2_username': game.player2.username
+    })
+    state['frame']['match_wins'] = {'player1': player1_wins, 'player2': player2_wins}
+    state['frame']['current_match'] = player1_wins + player2_wins
+    state['frame']['game_status'] = 'gameOver'
+    return state
+
+
+class FinalizeGameTests(TestCase):
+    def setUp(self):
+        self.player1 = User.objects.create(username='p1', email='p1@example.com')
+        self.player2 = User.objects.create(username='p2', email='p2@example.com')
+        self.game = Game.objects.create(player1=self.player1, player2=self.player2, difficulty='medium')
+        self.addCleanup(game_logic.remove_game, str(self.game.id))
+
+    def test_writes_results_and_profiles(self):
+        state = finished_state(self.game, 3, 1)
+
+        self.assertTrue(game_logic.finalize_game(self.game.id, state))
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.status, StatusChoices.COMPLETED)
+        self.assertEqual(self.game.winner_id, self.player1.id)
+        self.assertEqual((self.game.final_score_player1, self.game.final_score_player2), (3, 1))
+
+        winner = PlayerProfile.objects.get(player=self.player1)
+        loser = PlayerProfile.objects.get(player=self.player2)
+        self.assertEqual((winner.matches_played, winner.matches_won, winner.matches_lost), (1, 1, 0))
+        self.assertEqual((loser.matches_played, loser.matches_won, loser.matches_lost), (1, 0, 1))
+        self.assertEqual(winner.experience, game_logic.WIN_EXPERIENCE)
+        self.assertTrue(winner.first_win)
+        self.assertFalse(winner.pure_win)
+
+    def test_rating_moves_from_loser_to_winner(self):
+        PlayerProfile.objects.create(player=self.player1, rating=1000)
+        PlayerProfile.objects.create(player=self.player2, rating=1400)
+        change = game_logic.get_rating_change(1000, 1400)
+
+        game_logic.finalize_game(self.game.id, finished_state(self.game, 3, 0))
+
+        self.assertEqual(PlayerProfile.objects.get(player=self.player1).rating, 1000 + change)
+        self.assertEqual(PlayerProfile.objects.get(player=self.player2).rating, 1400 - change)
+        # An upset is worth more than an expected win
+        self.assertGreater(change, game_logic.get_rating_change(1400, 1000))
+
+    def test_finalizing_twice_is_a_no_op(self):
+        state = finished_state(self.game, 3, 2)
+
+        self.assertTrue(game_logic.finalize_game(self.game.id, state))
+        matches = Match.objects.filter(game=self.game).count()
+        self.assertFalse(game_logic.finalize_game(self.game.id, state))
+
+        self.assertEqual(Match.objects.filter(game=self.game).count(), matches)
+        profile = PlayerProfile.objects.get(player=self.player1)
+        self.assertEqual((profile.matches_played, profile.matches_won), (1, 1))
+
+    def test_won_game_overrides_cancellation(self):
+        Game.objects.filter(id=self.game.id).update(status=StatusChoices.CANCELLED)
+
+        self.assertTrue(game_logic.finalize_game(self.game.id, finished_state(self.game, 1, 3)))
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.status, StatusChoices.COMPLETED)
+        self.assertEqual(self.game.winner_id, self.player2.id)
+
+    def test_unfinished_game_stays_cancelled(self):
+        Game.objects.filter(id=self.game.id).update(status=StatusChoices.CANCELLED)
+        state = finished_state(self.game, 1, 0)
+        state['frame']['game_status'] = 'playing'
+
+        self.assertFalse(game_logic.finalize_game(self.game.id, state))
+        self.assertFalse(PlayerProfile.objects.filter(matches_played__gt=0).exists())
+
+    def test_triple_win_on_third_game_won(self):
+        for won in range(1, game_logic.TRIPLE_WIN_GAMES + 1):
+            game_logic.update_player_profiles(self.player1.id, self.player2.id, 0)
+            profile = PlayerProfile.objects.get(player=self.player1)
+            self.assertEqual(profile.matches_won, won)
+            self.assertEqual(profile.triple_win, won == game_logic.TRIPLE_WIN_GAMES)
+        self.assertTrue(profile.pure_win)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def make_queue(self, **kwargs):
+        self.sent = []
+        self.stalls = []
+
+        async def send(message):
+            self.sent.append(dict(message))
+
+        async def on_stall():
+            self.stalls.append(True)
+
+        options = {'high_water': 64, 'stall_timeout': 1.0, 'max_unacked': 30, 'ack_every': 6}
+        options.update(kwargs)
+        return OutboundQueue(send, on_stall=on_stall, **options)
+
+    async def test_latest_frame_wins(self):
+        queue = self.make_queue()
+        queue.put_control({'type': 'setup'})
+        for tick in range(5):
+            queue.put_frame({'type': 'game_state', 'tick': tick})
+        queue.put_control({'type': 'status'})
+
+        queue.start()
+        await queue.drain()
+        await queue.stop()
+
+        self.assertEqual([message['type'] for message in self.sent], ['setup', 'game_state', 'status'])
+        self.assertEqual(self.sent[1]['tick'], 4)
+        self.assertEqual(self.sent[1]['frame_seq'], 1)
+        self.assertEqual(queue.dropped_frames, 4)
+
+    async def test_frames_wait_for_acks(self):
+        queue = self.make_queue(max_unacked=2, ack_every=2)
+        queue.start()
+        for tick in range(4):
+            queue.put_frame({'type': 'game_state', 'tick': tick})
+            await asyncio.sleep(0.01)
+
+        # Two frames in flight, the newest of the rest is held
+        self.assertEqual([message['tick'] for message in self.sent], [0, 1])
+        self.assertTrue(self.sent[1]['ack'])
+
+        queue.on_ack(2)
+        await queue.drain()
+        await queue.stop()
+        self.assertEqual([message['tick'] for message in self.sent], [0, 1, 3])
+
+    async def test_unacknowledged_socket_stalls(self):
+        queue = self.make_queue(max_unacked=1, ack_every=1, stall_timeout=0.05)
+        queue.start()
+        queue.put_frame({'type': 'game_state'})
+        await asyncio.sleep(0.01)
+        queue.put_frame({'type': 'game_state'})
+        await asyncio.sleep(0.1)
+
+        self.assertTrue(queue.stalled)
+        self.assertEqual(self.stalls, [True])
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_high_water_mark_stalls(self):
+        queue = self.make_queue(high_water=3)
+        for number in range(4):
+            queue.put_control({'type': 'status', 'number': number})
+
+        self.assertTrue(queue.stalled)
+        self.assertEqual(len(queue.entries), 0)
+        await asyncio.sleep(0)
+        self.assertEqual(self.stalls, [True])
+
+
+@requires_fakeredis
+class RedisLeaseTests(SimpleTestCase):
+    async def test_fencing_token_increases_with_each_holder(self):
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        set_redis(client)
+        first = RedisLease('test:lease', 10)
+        second = RedisLease('test:lease', 10)
+
+        self.assertTrue(await first.acquire())
+        self.assertFalse(await second.acquire())
+        self.assertEqual(first.token, 1)
+
+        # The first holder stalls past its TTL and the lease is taken over
+        await client.delete('test:lease')
+        self.assertTrue(await second.acquire())
+        self.assertEqual(second.token, 2)
+        self.assertFalse(await first.renew())
+        self.assertIsNone(first.token)
+
+        await first.release()
+        self.assertEqual(await client.get('test:lease'), second.owner)
+        await second.release()
+        self.assertIsNone(await client.get('test:lease'))
+
+
+@requires_fakeredis
+class MatchmakingScriptTests(SimpleTestCase):
+    async def connect(self):
+        self.client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        set_redis(self.client)
+        self.lease = RedisLease(matchmaking.LEADER_KEY, 10)
+        await self.lease.acquire()
+
+    async def join(self, user_id, rating, difficulty='easy', joined_at=None):
+        return await matchmaking.queue_entry({
+            'user_id': user_id,
+            'username': f'user{user_id}',
+            'avatar': '',
+            'difficulty': difficulty,
+            'rating': rating,
+            'joined_at': joined_at or int(time.time() * 1000)
+        })
+
+    async def match(self, difficulty='easy', offset=0, scan_size=200, token=None):
+        result = await self.client.eval(
+            matchmaking.MATCH_SCRIPT, 6,
+            matchmaking.QUEUE_KEY + difficulty, matchmaking.RATING_KEY + difficulty,
+            matchmaking.ENTRIES_KEY, self.lease.fencing_key, matchmaking.DIRTY_KEY, matchmaking.HEARTBEAT_KEY,
+            difficulty, token or self.lease.token, 50, scan_size, int(time.time() * 1000),
+            100, 0, 100, 4, matchmaking.RTT_KEY, 150, 0, 1.0, 'default', offset
+        )
+        pairs = [
+            (json.loads(result[i])['user_id'], json.loads(result[i + 1])['user_id'], result[i + 2])
+            for i in range(1, len(result), 3)
+        ]
+        return result[0], pairs
+
+    async def test_join_moves_a_waiting_player_and_keeps_join_time(self):
+        await self.connect()
+        self.assertEqual(await self.join(1, 1000, joined_at=1000), 1)
+        self.assertEqual(await self.join(1, 1000, difficulty='hard', joined_at=5000), 0)
+
+        self.assertEqual(await self.client.zcard(matchmaking.QUEUE_KEY + 'easy'), 0)
+        self.assertEqual(await self.client.zscore(matchmaking.QUEUE_KEY + 'hard', '1'), 1000)
+        entry = json.loads(await self.client.hget(matchmaking.ENTRIES_KEY, '1'))
+        self.assertEqual((entry['difficulty'], entry['joined_at']), ('hard', 1000))
+        self.assertEqual(
+            dict(await self.client.zrange(matchmaking.DIRTY_KEY, 0, -1, withscores=True)),
+            {'easy': 0, 'hard': 0}
+        )
+
+    async def test_pairs_players_within_rating_window(self):
+        await self.connect()
+        await self.join(1, 1000, joined_at=1000)
+        await self.join(2, 3000, joined_at=2000)
+        await self.join(3, 1050, joined_at=3000)
+
+        offset, pairs = await self.match()
+
+        self.assertEqual(offset, -1)
+        self.assertEqual(pairs, [(1, 3, 'default')])
+        self.assertEqual(await self.client.zrange(matchmaking.QUEUE_KEY + 'easy', 0, -1), ['2'])
+        self.assertEqual(await self.client.zrange(matchmaking.RATING_KEY + 'easy', 0, -1), ['2'])
+        self.assertEqual(await self.client.hkeys(matchmaking.ENTRIES_KEY), ['2'])
+
+    async def test_scan_resumes_after_unpaired_players(self):
+        await self.connect()
+        for user_id in range(1, 5):
+            await self.join(user_id, user_id * 10000, joined_at=user_id)
+        await self.join(5, 90000, joined_at=5)
+        await self.join(6, 90010, joined_at=6)
+
+        offset, pairs = await self.match(scan_size=2)
+        self.assertEqual((offset, pairs), (2, []))
+        offset, pairs = await self.match(offset=offset, scan_size=2)
+        self.assertEqual((offset, pairs), (4, []))
+        offset, pairs = await self.match(offset=offset, scan_size=2)
+        self.assertEqual(pairs, [(5, 6, 'default')])
+
+    async def test_stale_fencing_token_is_rejected(self):
+        await self.connect()
+        await self.join(1, 1000)
+        await self.join(2, 1000)
+        await self.client.incr(self.lease.fencing_key)
+
+        with self.assertRaisesMessage(Exception, 'stale matchmaker fencing token'):
+            await self.match()
+        self.assertEqual(await self.client.zcard(matchmaking.QUEUE_KEY + 'easy'), 2)
+
+    async def test_expire_removes_players_without_heartbeat(self):
+        await self.connect()
+        await self.join(1, 1000)
+        await self.join(2, 1000)
+        await self.client.zadd(matchmaking.HEARTBEAT_KEY, {'1': 0})
+
+        expired = await self.client.eval(
+            matchmaking.EXPIRE_SCRIPT, 3,
+            matchmaking.HEARTBEAT_KEY, matchmaking.ENTRIES_KEY, matchmaking.DIRTY_KEY,
+            1000, 100, matchmaking.QUEUE_KEY, matchmaking.RATING_KEY
+        )
+
+        self.assertEqual(expired, 1)
+        self.assertEqual(await self.client.zrange(matchmaking.QUEUE_KEY + 'easy', 0, -1), ['2'])
+        self.assertEqual(await self.client.zrange(matchmaking.HEARTBEAT_KEY, 0, -1), ['2'])
+        self.assertEqual(await self.client.hkeys(matchmaking.ENTRIES_KEY), ['2'])
@@ -2,6 +2,7 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from .models import PlayerProfile, Game, Match, GameInvite, StatusChoices
+from . import game_logic
 from .serializers import (PlayerProfileSerializer, GameHistorySerializer, 
                          GameDetailSerializer, MatchSerializer,
                          GameInviteSerializer)
@@ -119,26 +120,26 @@ class GameStateView(APIView):
                 return Response({"error": "You are not a participant in this game"}, 
                                status=status.HTTP_403_FORBIDDEN)
             
-            # Check if game is active in memory (imported from consumers)
-            from .consumers import active_games
+            # Check if game is active in memory
+            active_games = game_logic.active_games
             
             if game_id not in active_games:
                 return Response({"error": "Game is not currently active"}, 
                                status=status.HTTP_404_NOT_FOUND)
             
-            # Return a simplified version of the game state
-            game_state = active_games[game_id]
+            # Return a simplified version of the last published frame
+            frame = active_games[game_id]["published"]
             simplified_state = {
-                "ball_position": [game_state["ball"]["x"], game_state["ball"]["y"]],
-                "left_paddle_position": game_state["left_paddle"]["y"],
-                "right_paddle_position": game_state["right_paddle"]["y"],
+                "ball_position": [frame["ball"]["x"], frame["ball"]["y"]],
+                "left_paddle_position": frame["left_paddle"]["y"],
+                "right_paddle_position": frame["right_paddle"]["y"],
                 "scores": {
-                    "left": game_state["left_paddle"]["score"],
-                    "right": game_state["right_paddle"]["score"]
+                    "left": frame["left_paddle"]["score"],
+                    "right": frame["right_paddle"]["score"]
                 },
-                "match_wins": game_state["match_wins"],
-                "current_match": game_state["current_match"],
-                "status": game_state["game_status"]
+                "match_wins": frame["match_wins"],
+                "current_match": frame["current_match"],
+                "status": frame["game_status"]
             }
             
             return Response(simplified_state)
@@ -151,8 +152,7 @@ class ActiveGamesView(APIView):
     def get(self, request):
         """List all active games the user is participating in"""
         try:
-            # Import active games from consumers
-            from .consumers import active_games
+            active_games = game_logic.active_games
             
             # Filter games where user is a participant
             user_games = []
@@ -171,9 +171,9 @@ class ActiveGamesView(APIView):
                                 "username": game.player2.username if request.user.id == game.player1_id else game.player1.username,
                                 "avatar": game.player2.avatar if request.user.id == game.player1_id else game.player1.avatar
                             },
-                            "status": game_state["game_status"],
-                            "current_match": game_state["current_match"],
-                            "match_wins": game_state["match_wins"],
+                            "status": game_state["published"]["game_status"],
+                            "current_match": game_state["published"]["current_match"],
+                            "match_wins": game_state["published"]["match_wins"],
                             "theme": game_state["theme"],
                             "difficulty": game_state["difficulty"],
                             "created_at": game.created_at
@@ -1,13 +1,13 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from backend.executors import database_sync_to_async
 from authentication.models import User
 from .models import Notification
+from backend import memory
 
 class NotificationsConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        # set user status to online
-        await database_sync_to_async(User.objects.filter(id=self.scope.get('user_id')).update)(status='online')
+        memory.open_connection(self)
 
         self.notification_group_name = None
         user_id = self.scope.get('user_id')
@@ -17,7 +17,8 @@ class NotificationsConsumer(AsyncWebsocketConsumer):
             return
             
         try:
-            self.user = await database_sync_to_async(User.objects.get)(id=user_id)
+            # set user status to online
+            self.user = await self.set_online(user_id)
         except Exception as e:
             await self.close()
             return
@@ -33,19 +34,27 @@ class NotificationsConsumer(AsyncWebsocketConsumer):
         await self.accept()
     
     async def disconnect(self, close_code):
+        memory.close_connection(self)
+        
         # Leave notification group
         if hasattr(self, 'notification_group_name'):
             await self.channel_layer.group_discard(
                 self.notification_group_name,
                 self.channel_name
             )
-        await database_sync_to_async(User.objects.filter(id=self.user.id).update)(status='offline')
+        await database_sync_to_async(User.objects.filter(id=self.user.id).update, pool='notify')(status='offline')
     
     async def receive(self, text_data):
         # We don't expect to receive messages from the client
         pass
     
-    @database_sync_to_async
+    @database_sync_to_async(pool='notify')
+    def set_online(self, user_id):
+        """Marks the user online and loads them in one executor call"""
+        User.objects.filter(id=user_id).update(status='online')
+        return User.objects.get(id=user_id)
+    
+    @database_sync_to_async(pool='notify')
     def save_notification(self, notification_data):
         sender_id = notification_data.get('sender_id')
         sender = None
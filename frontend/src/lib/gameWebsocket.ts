@@ -17,7 +17,16 @@ export default class GameConnection {
   private paddleMoveQueued = false;
   private paddleMovementThreshold = 2; // Only send updates if moved by at least 2px
   private lastSendTime = 0;
-  private minSendInterval = 33; // At most 30 updates per second (33ms)
+  private minSendInterval = 50; // At most 20 updates per second (50ms), own paddle is predicted locally
+  private inputSeq = 0; // Sequence number of the last paddle move sent
+  private ackedSeq = 0; // Last paddle move the server applied
+  private pingInterval: NodeJS.Timeout | null = null;
+  private pingEvery = 2000; // Clock sync exchange every 2 seconds
+  private lastPongReceiveTime: number | null = null;
+
+  // Clock sync estimate (ms): offset is server clock minus local clock
+  private rtt: number | null = null;
+  private clockOffset: number | null = null;
   
   // Callback functions
   private onGameState: GameStateCallback;
@@ -29,6 +38,9 @@ export default class GameConnection {
   // Player information
   private playerNumber: number | null = null;
 
+  // Static game data (players, settings), sent once by the server
+  private setup: any = null;
+
 
   constructor(
     gameId: string, 
@@ -75,12 +87,19 @@ export default class GameConnection {
 
   private handleOpen(event: Event) {
     this.onConnectionChange(true);
+
+    // The server numbers moves per connection
+    this.inputSeq = 0;
+    this.ackedSeq = 0;
     
     // Process any queued messages
     this.processQueuedMessages();
     
     // Start the game loop for sending paddle positions
     this.startGameLoop();
+
+    // Start the clock sync exchange
+    this.startPing();
   }
 
   private handleMessage(event: MessageEvent) {
@@ -96,9 +115,23 @@ export default class GameConnection {
           }
           break;
           
+        case 'game_setup':
+          // Keep the static data, frames only carry what changes
+          this.setup = message.setup;
+          break;
+
+        case 'pong':
+          this.handlePong(message);
+          break;
+
         case 'game_state':
+          // The server holds back frames until we acknowledge the ones it asks for
+          if (message.ack) {
+            this.sendMessage('frame_ack', { frame_seq: message.frame_seq });
+          }
           // Pass game state to callback function
-          this.onGameState(message.state);
+          this.handleAcks(message.state);
+          this.onGameState(this.withSetup(message.state));
           break;
           
         case 'game_status_changed':
@@ -122,7 +155,7 @@ export default class GameConnection {
           
         case 'game_completed':
           // Game has completed, handle the final state before disconnection
-          this.onGameState(message.final_state);
+          this.onGameState(this.withSetup(message.final_state));
           this.onStatusChange('gameOver', 'Game completed');
           
           // Disconnect after a short delay
@@ -136,12 +169,21 @@ export default class GameConnection {
     }
   }
 
+  private withSetup(frame: any) {
+    // Frames do not include the players; add them back from the setup
+    if (!this.setup || !frame) {
+      return frame;
+    }
+    return { ...frame, players: this.setup.players };
+  }
+
   private handleClose(event: CloseEvent) {
     this.onConnectionChange(false);
     this.socket = null;
     
     // Stop game loop
     this.stopGameLoop();
+    this.stopPing();
   }
 
   private handleError(error: Event) {
@@ -185,7 +227,7 @@ export default class GameConnection {
     
     if (significantMove && intervalElapsed) {
       // Send immediately if both conditions are met
-      this.sendMessage('paddle_move', { position });
+      this.sendPaddlePosition(position);
       this.lastSentPaddleY = position;
       this.lastSendTime = now;
       this.paddleMoveQueued = false;
@@ -195,26 +237,103 @@ export default class GameConnection {
     }
   }
 
+  private sendPaddlePosition(position: number) {
+    // Numbered and timestamped so the server can ack and lag-compensate it
+    this.inputSeq += 1;
+    return this.sendMessage('paddle_move', {
+      position,
+      seq: this.inputSeq,
+      client_time: Date.now()
+    });
+  }
+
+  private handleAcks(frame: any) {
+    const ack = frame?.acks?.[`player${this.playerNumber}`];
+    if (typeof ack === 'number') {
+      this.ackedSeq = ack;
+    }
+  }
+
+  // True while the server has not applied our latest paddle move yet
+  hasPendingInput() {
+    return this.ackedSeq < this.inputSeq;
+  }
+
   // Game loop to throttle paddle movement messages
   private startGameLoop() {
     if (this.gameLoopInterval) {
       clearInterval(this.gameLoopInterval);
     }
     
-    // Send paddle position updates at a maximum of 30 per second
+    // Send paddle position updates at a maximum of 20 per second
     this.gameLoopInterval = setInterval(() => {
       const now = Date.now();
       if (this.paddleMoveQueued && this.currentPaddleY !== null && now - this.lastSendTime >= this.minSendInterval) {
-        const sent = this.sendMessage('paddle_move', { position: this.currentPaddleY });
+        const sent = this.sendPaddlePosition(this.currentPaddleY);
         if (sent) {
           this.lastSentPaddleY = this.currentPaddleY;
           this.lastSendTime = now;
           this.paddleMoveQueued = false;
         }
       }
-    },  this.minSendInterval); // 33ms = 30 updates per second
+    },  this.minSendInterval); // 50ms = 20 updates per second
   }
   
+  private startPing() {
+    this.stopPing();
+    this.sendPing();
+    this.pingInterval = setInterval(() => this.sendPing(), this.pingEvery);
+  }
+
+  private stopPing() {
+    if (this.pingInterval) {
+      clearInterval(this.pingInterval);
+      this.pingInterval = null;
+    }
+  }
+
+  private sendPing() {
+    // The server completes the previous exchange with our receive time
+    this.sendMessage('ping', {
+      client_time: Date.now(),
+      last_pong_receive_time: this.lastPongReceiveTime
+    });
+  }
+
+  private handlePong(message: any) {
+    const receivedAt = Date.now();
+    this.lastPongReceiveTime = receivedAt;
+    if (typeof message.client_time !== 'number') {
+      return;
+    }
+
+    const rtt = (receivedAt - message.client_time) - (message.server_send_time - message.server_receive_time);
+    if (rtt < 0) {
+      return;
+    }
+    const offset = ((message.server_receive_time - message.client_time) + (message.server_send_time - receivedAt)) / 2;
+
+    if (this.rtt === null || this.clockOffset === null) {
+      this.rtt = rtt;
+      this.clockOffset = offset;
+      return;
+    }
+    // Samples delayed far beyond the usual RTT give skewed offsets
+    if (rtt <= 2 * this.rtt) {
+      this.clockOffset += 0.25 * (offset - this.clockOffset);
+    }
+    this.rtt += 0.125 * (rtt - this.rtt);
+  }
+
+  // Converts a server timestamp (ms) to the local clock
+  serverToLocalTime(serverTime: number) {
+    return this.clockOffset === null ? serverTime : serverTime - this.clockOffset;
+  }
+
+  getRoundTripTime() {
+    return this.rtt;
+  }
+
   private stopGameLoop() {
     if (this.gameLoopInterval) {
       clearInterval(this.gameLoopInterval);
@@ -263,6 +382,7 @@ export default class GameConnection {
 
   disconnect() {
     this.stopGameLoop();
+    this.stopPing();
     
     if (this.socket) {
       try {
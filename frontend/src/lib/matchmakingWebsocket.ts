@@ -32,6 +32,18 @@ export const initMatchmakingSocket = () => {
             reconnectAttempts = 0;
         };
 
+        // Echo pings straight back so the server can measure our RTT
+        matchmakingSocket.addEventListener('message', (event) => {
+            try {
+                const data = JSON.parse(event.data);
+                if (data.type === 'ping' && matchmakingSocket?.readyState === WebSocket.OPEN) {
+                    matchmakingSocket.send(JSON.stringify({ type: 'pong', sent_at: data.sent_at }));
+                }
+            } catch (error) {
+                // Malformed messages are reported by the component's handler
+            }
+        });
+
         matchmakingSocket.onerror = (error) => {
             console.error('Matchmaking WebSocket error:', error);
         };
@@ -20,6 +20,9 @@ export interface PlayerStatistics {
   matches_played :number;
   matches_won :number;
   matches_lost :number;
+  points_scored :number;
+  points_conceded :number;
+  longest_rally :number;
   
   first_win :boolean;
   pure_win :boolean;